@@ -1,10 +1,25 @@
 
-from archive_db.models.Model import init_db
+from archive_db.models.Model import init_db, open_db, group_commit, checkpoint
+from archive_db.models.DbExecutor import db_executor
+from archive_db.models.SlowQueryLog import slow_query_log
+from archive_db.models.WriterLock import writer_lock
+from archive_db.models.Backup import backup
+from archive_db.models.Tiering import tiering
 from archive_db.handlers.DbHandlers import UploadHandler, VerificationHandler, RemovalHandler, \
-    VersionHandler, RandomUnverifiedArchiveHandler, ViewHandler, QueryHandler
+    VersionHandler, RandomUnverifiedArchiveHandler, ViewHandler, QueryHandler, UploadBatchHandler, \
+    VerificationBatchHandler, VerificationPlanHandler, ChangesHandler, CacheHandler, \
+    MetricsHandler, SlowQueryHandler, BackupHandler
+from archive_db.handlers.ExportHandlers import ExportHandler
+from archive_db.handlers.ResponseCache import response_cache
+from archive_db.handlers.Compression import CompressionTransform
+from archive_db.serialization import serializer
 
 from arteria.web.app import AppService
-from tornado.web import URLSpec as url
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+from tornado.web import Application, URLSpec as url
 
 
 def routes(**kwargs):
@@ -15,27 +30,165 @@ def routes(**kwargs):
     :param: **kwargs will be passed when initializing the routes.
     """
 
-    return [
+    specs = [
         url(r"/api/1.0/version", VersionHandler, name="version"),
         url(r"/api/1.0/upload", UploadHandler, name="upload"),
+        url(r"/api/1.0/upload/batch", UploadBatchHandler, name="upload_batch"),
         url(r"/api/1.0/verification", VerificationHandler, name="verification"),
+        url(r"/api/1.0/verification/batch", VerificationBatchHandler, name="verification_batch"),
         url(r"/api/1.0/randomarchive", RandomUnverifiedArchiveHandler, name="randomarchive"),
+        url(r"/api/1.0/verificationplan", VerificationPlanHandler, name="verificationplan"),
         url(r"/api/1.0/removal", RemovalHandler, name="removal"),
         url(r"/api/1.0/view/?([0-9]*)", ViewHandler, name="view"),
-        url(r"/api/1.0/query", QueryHandler, name="query")
+        url(r"/api/1.0/query", QueryHandler, name="query"),
+        url(r"/api/1.0/export", ExportHandler, name="export"),
+        url(r"/api/1.0/changes", ChangesHandler, name="changes"),
+        url(r"/api/1.0/cache", CacheHandler, name="cache"),
+        url(r"/api/1.0/metrics", MetricsHandler, name="metrics"),
+        url(r"/api/1.0/admin/slowqueries", SlowQueryHandler, name="slowqueries"),
+        url(r"/api/1.0/admin/backup", BackupHandler, name="backup")
     ]
+    for spec in specs:
+        # the route name labels the metrics of the requests to it
+        spec.target_kwargs.setdefault("route", spec.name)
+    return specs
+
+
+def transforms():
+    """
+    The output transforms of the application, compressing the responses
+    """
+    return [CompressionTransform]
+
+
+class ArchiveDbAppService(AppService):
+
+    def start(self, routes, workers=1, setup=None):
+        """
+        Start serving `routes`, from `workers` processes (0 for one per CPU) pre-forked after
+        binding the listening socket, which they share. `setup(task_id)` is called in each
+        process before it starts serving, with the task id of the worker, or None if there's
+        a single process.
+        """
+        routes.extend(self._get_default_routes())
+        self.route_svc.set_routes(routes)
+        sockets = bind_sockets(self._port)
+        self._logger.info("Starting the service on {0} with {1} worker(s) (debug={2})".format(
+            self._port, workers or "one per CPU", self._debug))
+        task_id = None
+        if workers != 1:
+            # returns in the children only, the parent restarts any worker that dies
+            task_id = fork_processes(workers)
+        if setup:
+            setup(task_id)
+        self._tornado = Application(
+            self.route_svc.get_routes(),
+            transforms=transforms(),
+            debug=self._debug,
+            # autoreload restarts a single process, so it can't be combined with workers
+            autoreload=self._debug and workers == 1)
+        HTTPServer(self._tornado).add_sockets(sockets)
+        IOLoop.current().start()
+
+
+def prepare_workers(db_path, pragmas=None):
+    """
+    Set up the database before forking worker processes, which open it with `open_db`.
+
+    The schema is migrated once, here, and the connection and executor threads are closed,
+    since they can't be carried over fork. The writes of the workers are serialized by a lock
+    file next to the database, and their response caches are invalidated together.
+    """
+    if str((pragmas or {}).get("journal_mode", "")).lower() != "wal":
+        raise ValueError("Serving from several workers requires sqlite_pragmas journal_mode: wal")
+    init_db(db_path, pragmas=pragmas).close()
+    db_executor.shutdown(wait=True)
+    writer_lock.configure(db_path + "-writer.lock")
 
 
 def start():
     """
     Start the archive-db-ws app
     """
-    app_svc = AppService.create(__package__)
+    app_svc = ArchiveDbAppService.create(__package__)
+
+    app_config = app_svc.config_svc.get_app_config()
+    db_path = app_config["archive_db_path"]
+    pragmas = app_config.get("sqlite_pragmas")
+    workers = int(app_config.get("workers", 1))
+    if workers != 1:
+        prepare_workers(db_path, pragmas)
+    response_cache.configure(
+        max_entries=app_config.get("response_cache_entries", 256),
+        max_bytes=app_config.get("response_cache_bytes", 64 * 2**20),
+        shared=workers != 1,
+        db_path=db_path)
+    serializer.configure(
+        library=app_config.get("json_library"),
+        timestamps=app_config.get("json_timestamps", "str"))
+    CompressionTransform.configure(
+        enabled=app_config.get("compression", True),
+        min_length=app_config.get("compression_min_length", 1024),
+        gzip_level=app_config.get("compression_gzip_level", 6),
+        brotli_quality=app_config.get("compression_brotli_quality", 4))
+    backup.configure(
+        db_path=db_path,
+        directory=app_config.get("backup_directory"),
+        keep=app_config.get("backup_keep", 7),
+        pages=app_config.get("backup_pages", 1024),
+        sleep=app_config.get("backup_sleep_ms", 10) / 1000,
+        verify=app_config.get("backup_verify", "quick"))
+    tiering.configure(
+        db_path=db_path,
+        horizon_days=app_config.get("tiering_horizon_days"),
+        directory=app_config.get("tiering_directory"),
+        batch_size=app_config.get("tiering_batch_size", 5000),
+        sleep=app_config.get("tiering_sleep_ms", 50) / 1000)
+
+    async def tier():
+        if await IOLoop.current().run_in_executor(None, tiering.scheduled):
+            # responses leaving out the cold tiers have changed
+            response_cache.invalidate()
+
+    def setup(task_id):
+        db_args = dict(
+            read_workers=app_config.get("db_read_workers", 4),
+            write_workers=app_config.get("db_write_workers", 1),
+            pragmas=pragmas)
+        if task_id is None:
+            init_db(db_path, **db_args)
+        else:
+            open_db(db_path, **db_args)
+        group_commit.configure(
+            enabled=app_config.get("group_commit", False),
+            max_items=app_config.get("group_commit_max_items", 100),
+            window_ms=app_config.get("group_commit_window_ms", 10))
+        slow_query_log.configure(
+            threshold_ms=app_config.get("slow_query_threshold_ms"),
+            explain_interval=app_config.get("slow_query_explain_interval", 60),
+            explain_rate=app_config.get("slow_query_explain_rate", 1.0))
+
+        # one process checkpoints the log on behalf of all
+        checkpoint_interval = app_config.get("wal_checkpoint_interval")
+        if checkpoint_interval and not task_id:
+            PeriodicCallback(
+                lambda: db_executor.write(
+                    checkpoint, app_config.get("wal_checkpoint_mode", "PASSIVE")),
+                float(checkpoint_interval) * 1000).start()
+
+        # and takes the scheduled backups, in a thread of its own since they take a while
+        backup_interval = app_config.get("backup_interval")
+        if backup.enabled and backup_interval and not task_id:
+            PeriodicCallback(
+                lambda: IOLoop.current().run_in_executor(None, backup.scheduled),
+                float(backup_interval) * 1000).start()
 
-    db_path = app_svc.config_svc["archive_db_path"]
-    init_db(db_path)
+        # and moves the old events to the cold tiers
+        tiering_interval = app_config.get("tiering_interval")
+        if tiering.enabled and tiering_interval and not task_id:
+            PeriodicCallback(tier, float(tiering_interval) * 1000).start()
 
-    app_svc.start(routes(config=app_svc.config_svc))
+    app_svc.start(routes(config=app_svc.config_svc), workers=workers, setup=setup)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+import io
+import os
+import sys
+
+from argparse import ArgumentParser
+
+from arteria.configuration import ConfigurationService
+
+from archive_db import importer
+from archive_db.export import Export, ExportError, FILTERS, FORMATS, TABLES
+from archive_db.handlers.ResponseCache import ResponseCache
+from archive_db.models.Model import ArchiveState, init_db
+from archive_db.models.Tiering import tiering, TieringError
+from archive_db.models.WriterLock import writer_lock
+
+
+def _add_db_arguments(parser):
+    parser.add_argument(
+        "--db",
+        dest="db", metavar="PATH",
+        help="path to the SQLite database. If omitted, archive_db_path from app.config is used")
+    parser.add_argument(
+        "--configroot",
+        dest="configroot", metavar="CONFIGROOT",
+        default=os.path.join("/etc", "arteria", __package__),
+        help="directory containing app.config")
+
+
+def _db_path(args):
+    if args.db:
+        return args.db
+    app_config = ConfigurationService.read_yaml(os.path.join(args.configroot, "app.config"))
+    return app_config["archive_db_path"]
+
+
+def state(args=None):
+    """
+    Check the archive_state table of an existing database against the event history, or
+    rebuild it from the history
+    """
+    parser = ArgumentParser(description=state.__doc__)
+    parser.add_argument("action", choices=["check", "rebuild"])
+    _add_db_arguments(parser)
+    args = parser.parse_args(args=args)
+
+    db_path = _db_path(args)
+    init_db(db_path)
+
+    if args.action == "rebuild":
+        ArchiveState.rebuild()
+        ResponseCache.touch(db_path)
+        print("archive_state rebuilt from the event history")
+        return 0
+
+    inconsistent = ArchiveState.check()
+    if inconsistent:
+        print(f"archive_state is inconsistent for {len(inconsistent)} archive(s): "
+              f"{', '.join(map(str, inconsistent[:20]))}{', ...' if len(inconsistent) > 20 else ''}")
+        return 1
+    print("archive_state is consistent with the event history")
+    return 0
+
+
+def export(args=None):
+    """
+    Export the archives, or their uploads, verifications or removals, as CSV, newline-delimited
+    JSON or Parquet
+    """
+    parser = ArgumentParser(description=export.__doc__)
+    parser.add_argument(
+        "table", nargs="?", choices=list(TABLES), default="archives",
+        help="the archives with their latest events (default), or all events of a kind")
+    parser.add_argument("--format", choices=list(FORMATS), default="ndjson")
+    parser.add_argument(
+        "--output", metavar="FILE",
+        help="file to write the export to. If omitted, it is written to standard output")
+    for name in FILTERS:
+        parser.add_argument(
+            "--" + name.replace("_", "-"), dest=name,
+            help="false to leave out the uploads and verifications moved to the cold tiers"
+            if name == "cold" else
+            "export only the archives, or events of the archives, matching this criterion, as "
+            "for /api/1.0/query")
+    _add_db_arguments(parser)
+    args = parser.parse_args(args=args)
+
+    init_db(_db_path(args))
+    try:
+        exported = Export(
+            args.table, args.format, **{name: getattr(args, name) for name in FILTERS})
+    except ExportError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in exported.batches():
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+def import_events(args=None):
+    """
+    Import uploads and verifications from CSV or newline-delimited JSON files, with the
+    columns (or members) description, path, host, timestamp and, unless given by --event,
+    event ("upload" or "verification"). An interrupted import is resumed by running it again
+    with the same inputs, and an input imported before is only imported from where it ended,
+    unless its first record has changed.
+    """
+    parser = ArgumentParser(description=import_events.__doc__)
+    parser.add_argument(
+        "inputs", nargs="+", metavar="INPUT",
+        help="file to import, or - for standard input")
+    parser.add_argument(
+        "--format", choices=importer.FORMATS,
+        help="format of the inputs. If omitted, it is told by their extension")
+    parser.add_argument(
+        "--event", choices=list(importer.EVENTS),
+        help="type of the events, for inputs that don't have an event column")
+    parser.add_argument(
+        "--source", metavar="NAME",
+        help="name under which the progress of standard input is checkpointed, required "
+             "when importing from it")
+    parser.add_argument("--batch-size", type=int, default=importer.BATCH_SIZE)
+    parser.add_argument(
+        "--skip-invalid", action="store_true",
+        help="skip invalid records instead of stopping at the first one")
+    _add_db_arguments(parser)
+    args = parser.parse_args(args=args)
+
+    if "-" in args.inputs and not (args.format and args.source):
+        print("Expecting --format and --source when importing from standard input",
+              file=sys.stderr)
+        return 1
+    db_path = _db_path(args)
+    db = init_db(db_path)
+    importer.prepare(db)
+    try:
+        for name in args.inputs:
+            if name == "-":
+                source, format = args.source, args.format
+                stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+            else:
+                source, format = os.path.abspath(name), importer.input_format(name, args.format)
+                stream = open(name, encoding="utf-8", newline="")
+            with stream:
+                counts = importer.import_records(
+                    source, importer.read_records(stream, format), event=args.event,
+                    batch_size=args.batch_size, skip_invalid=args.skip_invalid)
+            print(f"{name}: imported {counts['imported']} event(s), skipped "
+                  f"{counts['invalid']} invalid record(s) and {counts['resumed_after']} "
+                  f"imported before")
+    except (OSError, ValueError) as e:
+        print(f"{e}\nThe import is incomplete, run it again to resume it", file=sys.stderr)
+        return 1
+    finally:
+        # whatever was imported so far is taken into the state and indexes
+        importer.finish(db)
+        # the responses cached by the service are out of date
+        ResponseCache.touch(db_path)
+        print("indexes and archive_state rebuilt")
+    return 0
+
+
+def tier(args=None):
+    """
+    Move the uploads and verifications older than a horizon out of the database, into a cold
+    tier per year. This can run while the service is running, and can be interrupted and run
+    again.
+    """
+    parser = ArgumentParser(description=tier.__doc__)
+    parser.add_argument(
+        "--horizon-days", type=float, required=True,
+        help="move the events that are older than this many days")
+    parser.add_argument(
+        "--directory", metavar="DIR",
+        help="directory of the tiers. If omitted, that of the database")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument(
+        "--sleep-ms", type=float, default=50,
+        help="milliseconds to sleep between batches, letting the service write")
+    _add_db_arguments(parser)
+    args = parser.parse_args(args=args)
+
+    db_path = _db_path(args)
+    # waits for the writes of the service rather than failing, taking turns with its workers
+    # if it runs several
+    init_db(db_path, pragmas={"busy_timeout": 10000})
+    if os.path.exists(db_path + "-writer.lock"):
+        writer_lock.configure(db_path + "-writer.lock")
+    tiering.configure(
+        db_path=db_path, horizon_days=args.horizon_days, directory=args.directory,
+        batch_size=args.batch_size, sleep=args.sleep_ms / 1000)
+    try:
+        info = tiering.run()
+    except TieringError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if info["upload"] or info["verification"]:
+        # responses leaving out the cold tiers have changed
+        ResponseCache.touch(db_path)
+    print(f"moved {info['upload']} upload(s) and {info['verification']} verification(s) "
+          f"older than {info['horizon']} to the cold tiers of "
+          f"{', '.join(map(str, info['years'])) or 'no year'}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(state())
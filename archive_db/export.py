@@ -0,0 +1,264 @@
+"""
+Export of the archive ledger, i.e. the archives with their latest events, and of the full
+event history, as CSV, newline-delimited JSON or Parquet.
+
+The rows are read with a server-side cursor and encoded a batch at a time, so memory use is
+bounded by the batch size rather than by the size of the database. Parquet output needs the
+optional dependency pyarrow (`pip install archive-db[parquet]`), and is written as one row group
+per batch.
+"""
+import csv
+import io
+
+from peewee import fn
+
+from archive_db.handlers.DbHandlers import QueryHandlerBase
+from archive_db.models.Model import Archive, Upload, Verification, Removal, ArchiveState, \
+    ColdTier
+from archive_db.serialization import serializer
+
+BATCH_SIZE = 10000
+
+# filters of the exported archives, as accepted by QueryHandlerBase._filter_query. The uploads
+# and verifications moved to the cold tiers are exported as well, unless cold is false.
+FILTERS = (
+    "path", "description", "host", "path_prefix", "description_prefix", "host_prefix",
+    "uploaded_before", "uploaded_after", "verified", "removed", "cold")
+
+
+class ExportError(ValueError):
+    pass
+
+
+def _archives(filters):
+    return QueryHandlerBase._filter_query(QueryHandlerBase._db_query(), **filters)
+
+
+class _History:
+    """
+    The events of a tiered model in every cold tier, one tier at a time, oldest year first,
+    followed by those in its table, each in order of id. The tiers are attached in turn, and
+    the events are held in place meanwhile, so that none is read twice or missed.
+    """
+
+    def __init__(self, model, query):
+        self.model = model
+        self.query = query
+
+    def iterator(self):
+        with ColdTier.held():
+            # read up front, since a pending statement would keep the tiers from being detached
+            for tier in list(ColdTier.select().order_by(ColdTier.year)):
+                ColdTier.attach([tier])
+                cold = ColdTier.event_model(self.model, tier.year)
+                # leaving out the events that are still in the table while they are moved
+                yield from self.query(cold).where(
+                    ~fn.EXISTS(self.model.select().where(self.model.id == cold.id))
+                ).iterator()
+            yield from self.query(self.model).iterator()
+
+    __iter__ = iterator
+
+
+def _events(model, *fields):
+    def query(filters):
+        def events(model):
+            query = model.select(
+                model.id,
+                Archive.description,
+                Archive.path,
+                Archive.host,
+                *(fields or [model.timestamp])
+            ).join(
+                Archive, on=(model.archive == Archive.id)
+            ).order_by(
+                model.id)
+            if set(filters) - {"cold"}:
+                query = query.where(model.archive.in_(
+                    _archives(filters).select(ArchiveState.archive).order_by()))
+            return query.dicts()
+
+        if model in ColdTier.MODELS and QueryHandlerBase._cold(filters.get("cold")) is not False:
+            return _History(model, events)
+        return events(model)
+    return query
+
+
+# the columns of each table as (name, type), and a function building its query from filters
+TABLES = {
+    "archives": (
+        (("description", "string"), ("path", "string"), ("host", "string"),
+         ("uploaded", "timestamp"), ("verified", "timestamp"), ("removed", "timestamp")),
+        _archives),
+    "uploads": (
+        (("id", "integer"), ("description", "string"), ("path", "string"), ("host", "string"),
+         ("timestamp", "timestamp")),
+        _events(Upload)),
+    "verifications": (
+        (("id", "integer"), ("description", "string"), ("path", "string"), ("host", "string"),
+         ("timestamp", "timestamp")),
+        _events(Verification)),
+    "removals": (
+        (("id", "integer"), ("description", "string"), ("path", "string"), ("host", "string"),
+         ("timestamp_scheduled", "timestamp"), ("timestamp", "timestamp"), ("done", "boolean")),
+        _events(Removal, Removal.timestamp_scheduled, Removal.timestamp, Removal.done)),
+}
+
+
+class CsvEncoder:
+
+    content_type = "text/csv; charset=utf-8"
+
+    def __init__(self, columns):
+        self.names = [name for name, _ in columns]
+
+    def _encode(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode()
+
+    def begin(self):
+        return self._encode([self.names])
+
+    def encode(self, rows):
+        return self._encode(
+            ["" if row[name] is None else row[name] for name in self.names] for row in rows)
+
+    def end(self):
+        return b""
+
+
+class NdjsonEncoder:
+
+    content_type = "application/x-ndjson"
+
+    def __init__(self, columns):
+        self.names = [name for name, _ in columns]
+
+    def begin(self):
+        return b""
+
+    def encode(self, rows):
+        return b"".join(
+            serializer.dumps({name: row[name] for name in self.names}) + b"\n"
+            for row in rows)
+
+    def end(self):
+        return b""
+
+
+class _Sink:
+    """
+    A write-only file collecting what is written to it until it's drained
+    """
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+class ParquetEncoder:
+
+    content_type = "application/vnd.apache.parquet"
+
+    def __init__(self, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError("Exporting to Parquet requires pyarrow to be installed")
+        self._pa = pyarrow
+        types = {
+            "string": pyarrow.string(),
+            "timestamp": pyarrow.timestamp("us"),
+            "integer": pyarrow.int64(),
+            "boolean": pyarrow.bool_()}
+        self.names = [name for name, _ in columns]
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self._sink = _Sink()
+        self._writer = pyarrow.parquet.ParquetWriter(
+            pyarrow.PythonFile(self._sink, mode="w"), self.schema)
+
+    def begin(self):
+        return self._sink.drain()
+
+    def encode(self, rows):
+        self._writer.write_batch(self._pa.RecordBatch.from_pylist(
+            [{name: row[name] for name in self.names} for row in rows], schema=self.schema))
+        return self._sink.drain()
+
+    def end(self):
+        self._writer.close()
+        return self._sink.drain()
+
+
+FORMATS = {
+    "csv": CsvEncoder,
+    "ndjson": NdjsonEncoder,
+    "parquet": ParquetEncoder,
+}
+
+
+class Export:
+    """
+    The query and encoder of an export of `table` in `format`, restricted to the archives
+    matching the `filters`
+    """
+
+    def __init__(self, table="archives", format="ndjson", **filters):
+        if table not in TABLES:
+            raise ExportError("Expecting 'table' to be one of {0}, got {1!r}".format(
+                ", ".join(TABLES), table))
+        if format not in FORMATS:
+            raise ExportError("Expecting 'format' to be one of {0}, got {1!r}".format(
+                ", ".join(FORMATS), format))
+        columns, query = TABLES[table]
+        filters = {
+            name: value for name, value in filters.items()
+            if name in FILTERS and value is not None}
+        try:
+            self.query = query(filters)
+        except (TypeError, ValueError) as e:
+            raise ExportError("Invalid filter: {0}".format(e))
+        self.encoder = FORMATS[format](columns)
+        self.filename = "{0}.{1}".format(table, format)
+
+    def batches(self, batch_size=None):
+        """
+        Read and encode the rows in this thread, `batch_size` (BATCH_SIZE by default) at a time
+
+        :return an iterator over the encoded output
+        """
+        batch_size = batch_size or BATCH_SIZE
+        # the query is executed before anything is output, so that it fails before the response
+        # has begun if it reaches too many cold tiers
+        rows = self.query.iterator()
+        yield self.encoder.begin()
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield self.encoder.encode(batch)
+                batch = []
+        if batch:
+            yield self.encoder.encode(batch)
+        yield self.encoder.end()
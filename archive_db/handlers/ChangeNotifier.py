@@ -0,0 +1,27 @@
+import datetime as dt
+
+from tornado.locks import Condition
+
+
+class ChangeNotifier:
+    """
+    Wakes up the requests long-polling the change feed. The write handlers call `notify` once
+    their write has committed. Writes made by other worker processes, or directly to the
+    database, aren't notified, so the waiting requests also check the feed now and then.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+
+    def notify(self):
+        self._condition.notify_all()
+
+    def wait(self, timeout):
+        """
+        :return an awaitable resolving to True when notified, or to False after `timeout`
+        seconds
+        """
+        return self._condition.wait(timeout=dt.timedelta(seconds=timeout))
+
+
+change_notifier = ChangeNotifier()
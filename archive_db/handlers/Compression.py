@@ -0,0 +1,121 @@
+import zlib
+
+from tornado.web import OutputTransform
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class _Gzip:
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk, finishing):
+        return self._compressor.compress(chunk) + self._compressor.flush(
+            zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+
+
+class _Brotli:
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, chunk, finishing):
+        data = self._compressor.process(chunk)
+        return data + (self._compressor.finish() if finishing else self._compressor.flush())
+
+
+class CompressionTransform(OutputTransform):
+    """
+    Compresses the responses with the content coding preferred by the client among brotli (if
+    the brotli package is installed) and gzip. Like Tornado's own GZipContentEncoding, which it
+    replaces, it leaves out responses shorter than `min_length` written in one go, and types
+    that don't compress, e.g. Parquet. Streamed responses are compressed chunk by chunk.
+    """
+
+    # types beginning with "text/" are compressed as well
+    CONTENT_TYPES = {"application/json", "application/x-ndjson"}
+
+    enabled = True
+    min_length = 1024
+    gzip_level = 6
+    brotli_quality = 4
+
+    @classmethod
+    def configure(cls, enabled=True, min_length=1024, gzip_level=6, brotli_quality=4):
+        cls.enabled = bool(enabled)
+        cls.min_length = max(0, int(min_length))
+        cls.gzip_level = int(gzip_level)
+        cls.brotli_quality = int(brotli_quality)
+
+    @classmethod
+    def encodings(cls):
+        """
+        :return the content codings offered, in order of preference
+        """
+        return ("br", "gzip") if brotli is not None else ("gzip",)
+
+    @classmethod
+    def negotiate(cls, accept_encoding):
+        """
+        :param accept_encoding: the Accept-Encoding header of the request
+        :return the content coding to respond with, or None for no compression
+        """
+        weights = {}
+        for item in accept_encoding.split(","):
+            coding, _, params = item.strip().partition(";")
+            weight = 1.0
+            for param in params.split(";"):
+                name, _, value = param.strip().partition("=")
+                if name.strip() == "q":
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            if coding.strip():
+                weights[coding.strip().lower()] = weight
+        best, best_weight = None, 0.0
+        for coding in cls.encodings():
+            weight = weights.get(coding, weights.get("*", 0.0))
+            if weight > best_weight:
+                best, best_weight = coding, weight
+        return best
+
+    def __init__(self, request):
+        self._encoding = self.negotiate(request.headers.get("Accept-Encoding", "")) \
+            if self.enabled else None
+        self._compressor = None
+
+    def _compressible_type(self, content_type):
+        return content_type.startswith("text/") or content_type in self.CONTENT_TYPES
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if "Vary" in headers:
+            headers["Vary"] += ", Accept-Encoding"
+        else:
+            headers["Vary"] = "Accept-Encoding"
+        content_type = headers.get("Content-Type", "").split(";")[0].strip()
+        if self._encoding and status_code not in (204, 304) and \
+                self._compressible_type(content_type) and \
+                (not finishing or (chunk and len(chunk) >= self.min_length)) and \
+                "Content-Encoding" not in headers:
+            headers["Content-Encoding"] = self._encoding
+            if self._encoding == "br":
+                self._compressor = _Brotli(self.brotli_quality)
+            else:
+                self._compressor = _Gzip(self.gzip_level)
+            chunk = self.transform_chunk(chunk, finishing)
+            if "Content-Length" in headers:
+                if finishing:
+                    headers["Content-Length"] = str(len(chunk))
+                else:
+                    del headers["Content-Length"]
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._compressor is not None:
+            chunk = self._compressor.compress(chunk, finishing)
+        return chunk
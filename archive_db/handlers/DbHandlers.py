@@ -1,21 +1,66 @@
+import base64
+import binascii
+import collections
 import datetime as dt
+import email.utils
+import json
 import os
+import random
+import uuid
 
 from arteria.web.handlers import BaseRestHandler
 
-from archive_db.models.Model import Archive, Upload, Verification, Removal
+from archive_db import metrics
+from archive_db.serialization import serializer
+from archive_db.models.Model import Archive, ArchiveMismatchError, Upload, Verification, Removal, \
+    ArchiveState, ArchiveIndex, VerificationLease, Change, EventHistory, TooManyTiersError, \
+    group_commit, write_transaction, within, as_utc
+from archive_db.models.DbExecutor import db_executor
+from archive_db.models.SlowQueryLog import slow_query_log
+from archive_db.models.Backup import backup, BackupError, BackupRunningError
+from archive_db.handlers.ResponseCache import response_cache
+from archive_db.handlers.ChangeNotifier import change_notifier
 from importlib.metadata import version
 
 from peewee import *
-from tornado import gen
+from tornado.ioloop import IOLoop
 from tornado.web import HTTPError
-from tornado.escape import json_decode
+from tornado.escape import json_decode, json_encode
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
 
 
 class BaseHandler(BaseRestHandler):
     # BaseRestHandler.body_as_object() does not work well
     # in Python 3 due to string vs byte strings.
 
+    def initialize(self, route=None):
+        """
+        :param route: the name of the route, labelling the metrics of the request
+        """
+        self.route = route or type(self).__name__
+        self.response_size = 0
+
+    def prepare(self):
+        metrics.current_route.set(self.route)
+
+    def flush(self, include_footers=False):
+        self.response_size += sum(len(chunk) for chunk in self._write_buffer)
+        return super().flush(include_footers)
+
+    def on_finish(self):
+        metrics.requests.inc(self.route, self.request.method, self.get_status())
+        metrics.request_duration.observe(self.request.request_time(), self.route)
+        metrics.response_size.observe(self.response_size, self.route)
+
+    def write_json(self, obj):
+        """
+        Write `obj` serialized by the configured JSON serializer, or, if it's bytes, as already
+        serialized
+        """
+        self.set_header("Content-Type", "application/json")
+        self.write(obj if isinstance(obj, bytes) else serializer.dumps(obj))
+
     def decode(self, required_members=None):
         obj = json_decode(self.request.body)
 
@@ -25,11 +70,62 @@ class BaseHandler(BaseRestHandler):
                     raise HTTPError(400, "Expecting '{0}' in the JSON body".format(member))
         return obj
 
+    @staticmethod
+    def parse_timestamp(value=None):
+        """
+        :param value: (optional) ISO 8601 timestamp, the current time if not specified
+        :return the timestamp as a naive datetime in UTC
+        :raises ValueError if `value` isn't an ISO 8601 timestamp
+        """
+        if value is None:
+            return dt.datetime.utcnow()
+        try:
+            if isinstance(value, (str, dt.datetime)):
+                return as_utc(value)
+        except ValueError:
+            pass
+        raise ValueError("Expecting 'timestamp' to be an ISO 8601 timestamp, got {0!r}".format(value))
+
+    @staticmethod
+    def _count(count, maximum=None):
+        try:
+            count = int(count)
+        except (ValueError, TypeError):
+            count = 0
+        if count < 1:
+            raise HTTPError(400, "Expecting 'count' to be a positive integer")
+        if maximum is not None and count > maximum:
+            raise HTTPError(400, "Expecting 'count' to be at most {0}".format(maximum))
+        return count
+
+    def decode_timestamp(self, body):
+        try:
+            return self.parse_timestamp(body.get("timestamp"))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    @staticmethod
+    async def record(model, **event):
+        """
+        Write an event of type `model`, coalesced with concurrent writes into a shared
+        transaction if group commit is enabled. Answers 409 if the archive is registered with
+        another path or host.
+        """
+        try:
+            if group_commit.enabled:
+                created = await group_commit.submit(model, event)
+            else:
+                created = await db_executor.write(model.record, **event)
+        except ArchiveMismatchError as e:
+            raise HTTPError(409, str(e))
+        response_cache.invalidate()
+        change_notifier.notify()
+        return created
+
 
 class UploadHandler(BaseHandler):
 
-    @gen.coroutine
-    def post(self):
+    async def post(self):
         """
         Creates a new Upload object in the db, and the associated Archive if it doesn't already exist. 
 
@@ -42,11 +138,13 @@ class UploadHandler(BaseHandler):
         """
 
         body = self.decode(required_members=["path", "description", "host"])
-        tstamp = body.get("timestamp", dt.datetime.utcnow().isoformat())
-        archive, created = Archive.get_or_create(
-            description=body["description"], path=body["path"], host=body["host"])
-
-        upload = Upload.create(archive=archive, timestamp=tstamp)
+        tstamp = self.decode_timestamp(body)
+        upload = await self.record(
+            Upload,
+            description=body["description"],
+            path=body["path"],
+            host=body["host"],
+            timestamp=tstamp)
 
         self.write_json({"status": "created", "upload":
                          {"id": upload.id,
@@ -58,8 +156,7 @@ class UploadHandler(BaseHandler):
 
 class VerificationHandler(BaseHandler):
 
-    @gen.coroutine
-    def post(self):
+    async def post(self):
         """
         Creates a new Verification object in the db, associated to a certain Archive object. 
         If no Archive object matching the input parameters is found one will be created. 
@@ -74,14 +171,14 @@ class VerificationHandler(BaseHandler):
         :return Information about the created object
         """
         body = self.decode(required_members=["description", "path", "host"])
-        tstamp = body.get("timestamp", dt.datetime.utcnow().isoformat())
+        tstamp = self.decode_timestamp(body)
 
-        archive, created = Archive.get_or_create(
+        verification = await self.record(
+            Verification,
             description=body["description"],
+            path=body["path"],
             host=body["host"],
-            path=body["path"])
-
-        verification = Verification.create(archive=archive, timestamp=tstamp)
+            timestamp=tstamp)
 
         self.write_json({"status": "created", "verification":
                         {"id": verification.id,
@@ -91,63 +188,107 @@ class VerificationHandler(BaseHandler):
                          "host": verification.archive.host}})
 
 
-# TODO: We might have to add logic in some of the services
-# that adds a file with the description inside the archive,
-# so we can verify that we're operating on the correct
-# archive before (verifying/)removing.
-
-class RemovalHandler(BaseHandler):
-
-    @gen.coroutine
-    def post(self):
-        """
-        Archive `foo` was either staged for removal or actually just physically removed from local disk, as well 
-        as all its associated files (e.g. runfolder etc). 
-        """
-        pass
-    
-
-        """
-        # This is an example for how one could start implementing the handler that first schedules archives for 
-        # removal. 
+class BatchHandlerBase(BaseHandler):
+    """
+    Registers many events of the type `model` in one request. The events are posted either as a
+    JSON array or, with Content-Type application/x-ndjson, as one JSON object per line.
+    """
 
-        body = self.decode(required_members=["description", "action"])
+    model = None
+    key = None
+    required_members = ["description", "path", "host"]
 
+    def decode_batch(self):
+        content_type = self.request.headers.get("Content-Type", "")
         try:
-            archive = Archive.get(description=body["description"])
-        except Archive.DoesNotExist:
-            msg = "No archive with the unique description {} exists in the database!".format(body["description"])
-            self.set_status(500, msg)
-            self.write_json({"status": msg})
-
-        if body["action"] == "set_removable":
-            removal = Removal.create(archive=archive, timestamp_scheduled=dt.datetime.utcnow())
-
-            self.write_json({"status": "scheduled", "removal":
-                            {"id": removal.id,
-                             "timestamp_scheduled": str(removal.timestamp_scheduled),
-                             "description": removal.archive.description,
-                             "path": removal.archive.path,
-                             "host": removal.archive.host,
-                             "done": removal.done}})
-        elif body["action"] == "set_removed":
-            pass
-        else:
-            msg = "Expecting parameter 'action' to be 'set_removable' or set_removed'."
-            raise HTTPError(400, msg)
+            if "ndjson" in content_type:
+                items = [
+                    json_decode(line)
+                    for line in self.request.body.splitlines() if line.strip()]
+            else:
+                items = json_decode(self.request.body)
+        except ValueError as e:
+            raise HTTPError(400, "Could not decode the request body: {0}".format(e))
+        if not isinstance(items, list):
+            raise HTTPError(400, "Expecting a JSON array or newline-delimited JSON objects")
+        return items
+
+    def validate(self, item):
+        if not isinstance(item, dict):
+            return "Expecting a JSON object"
+        for member in self.required_members:
+            if member not in item:
+                return "Expecting '{0}' in the JSON object".format(member)
+        return None
+
+    async def post(self):
         """
+        Creates a batch of objects in the db, and the associated Archives if they don't already
+        exist. The body is either a JSON array of objects or newline-delimited JSON objects
+        (Content-Type: application/x-ndjson), each with the members:
 
-    @gen.coroutine
-    def get(self):
-        """
-        HTTP GET /removal is in this imagined implementation supposed to return those Archive objects
-        that are removable and are verified. One could probably do this by e.g. 
-
-            - fetch latest date from Verify, which has done == False, and call this X
-            - fetch all Uploads that have has a timestamp older or equal to X
-            - the set of Archives belonging to those Uploads should be OK to remove 
+        :param path: Path to the archive
+        :param description: The unique TSM description of the archive
+        :param host: The host from which the archive was uploaded
+        :param timestamp: (optional) if specified, use this timestamp for the object instead of
+        datetime.datetime.utcnow().isoformat()
+        :return Information about the created objects, or the reason they could not be created,
+        in the same order as in the request. Objects whose archive is registered with another path
+        or host are not created.
         """
-        pass
+        items = self.decode_batch()
+        tstamp = self.parse_timestamp()
+        results = [None] * len(items)
+        valid, events = [], []
+        for i, item in enumerate(items):
+            reason = self.validate(item)
+            if not reason:
+                try:
+                    timestamp = self.parse_timestamp(item.get("timestamp", tstamp))
+                except ValueError as e:
+                    reason = str(e)
+            if reason:
+                results[i] = {"status": "error", "reason": reason}
+                continue
+            valid.append(i)
+            events.append({
+                "description": item["description"],
+                "path": item["path"],
+                "host": item["host"],
+                "timestamp": timestamp})
+
+        recorded = await db_executor.write(self.model.record_many, events)
+        created = [event for event in recorded if not isinstance(event, ArchiveMismatchError)]
+        if created:
+            response_cache.invalidate()
+            change_notifier.notify()
+
+        for i, event in zip(valid, recorded):
+            if isinstance(event, ArchiveMismatchError):
+                results[i] = {"status": "error", "reason": str(event)}
+                continue
+            results[i] = {"status": "created", self.key:
+                          {"id": event.id,
+                           "timestamp": str(event.timestamp),
+                           "description": event.archive.description,
+                           "path": event.archive.path,
+                           "host": event.archive.host}}
+
+        self.write_json({
+            "status": "created" if len(created) == len(items) else "partial",
+            "created": len(created),
+            "failed": len(items) - len(created),
+            "results": results})
+
+
+class UploadBatchHandler(BatchHandlerBase):
+    model = Upload
+    key = "upload"
+
+
+class VerificationBatchHandler(BatchHandlerBase):
+    model = Verification
+    key = "verification"
 
 
 class QueryHandlerBase(BaseHandler):
@@ -162,119 +303,435 @@ class QueryHandlerBase(BaseHandler):
             f"{bool_str} can not be converted to bool")
 
     @staticmethod
-    def _db_query():
+    def _cold(cold):
+        """
+        :return the `cold` parameter of a request as True or False, or None if not given
+        """
+        return None if cold is None else QueryHandlerBase._str_as_bool(cold)
+
+    @staticmethod
+    def _startswith(field, prefix):
+        # A range on the column rather than LIKE 'prefix%', which can't use the index since
+        # LIKE is case-insensitive
+        last = ord(prefix[-1])
+        if last >= 0x10FFFF:
+            return field >= prefix
+        return (field >= prefix) & (field < prefix[:-1] + chr(last + 1))
+
+    @staticmethod
+    def _uploaded_in(window, cold=None):
+        """
+        :return an expression matching the Archives with an upload within the `window`, as
+        returned by `_upload_window`. The uploads are found by a range scan of the
+        upload_timestamp index, and of the same index in the cold tiers the window reaches.
+        """
+        uploads = EventHistory(Upload, *window, cold=cold)
+        return Archive.id.in_(
+            uploads.select(uploads.c.archive_id))
+
+    # The order of archive listings as (field, key in the result rows, descending), ending with
+    # the primary key so that the order is total. It matches the archive_state_listing index.
+    LISTING_ORDER = (
+        (ArchiveState.last_removed, "removed", True),
+        (ArchiveState.last_verified, "verified", True),
+        (ArchiveState.last_uploaded, "uploaded", True),
+        (ArchiveState.path, "path", False),
+        (ArchiveState.archive, "archive", False))
 
-        query = Archive.select(
+    DEFAULT_PAGE_SIZE = 1000
+
+    # number of rows serialized per chunk when streaming
+    STREAM_BATCH_SIZE = 1000
+
+    @staticmethod
+    def _db_query():
+        # The latest events per archive are read from the incrementally maintained
+        # ArchiveState rather than aggregated from the full history
+        query = ArchiveState.select(
             Archive.host,
-            Archive.path,
+            ArchiveState.path,
             Archive.description,
-            Upload.timestamp.alias("uploaded"),
-            Verification.timestamp.alias("verified"),
-            Removal.timestamp.alias("removed")
-        ).join(
-            Upload, JOIN.LEFT_OUTER, on=(Upload.archive_id == Archive.id)
-        ).join(
-            Verification, JOIN.LEFT_OUTER, on=(Verification.archive_id == Archive.id)
+            ArchiveState.last_uploaded.alias("uploaded"),
+            ArchiveState.last_verified.alias("verified"),
+            ArchiveState.last_removed.alias("removed"),
+            ArchiveState.archive
         ).join(
-            Removal, JOIN.LEFT_OUTER, on=(Removal.archive_id == Archive.id)
-        ).order_by(
-            Removal.timestamp.desc(),
-            Verification.timestamp.desc(),
-            Upload.timestamp.desc(),
-            Archive.path.asc())
+            Archive
+        ).order_by(*[
+            field.desc() if descending else field.asc()
+            for field, _, descending in QueryHandlerBase.LISTING_ORDER])
         return query
 
+    @staticmethod
+    def _upload_window(uploaded_before=None, uploaded_after=None):
+        """
+        :return the window of the uploads made within the (inclusive) dates `uploaded_after` and
+        `uploaded_before`, as a tuple of its earliest and latest time, either of which is None
+        if the date isn't given
+        """
+        earliest = latest = None
+        if uploaded_before:
+            latest = dt.datetime.strptime(
+                f"{uploaded_before} 23:59:59",
+                "%Y-%m-%d %H:%M:%S")
+        if uploaded_after:
+            earliest = dt.datetime.strptime(
+                uploaded_after,
+                "%Y-%m-%d")
+        return earliest, latest
+
+    @staticmethod
+    def _unverified_window(body, age, margin):
+        """
+        Restrict the query parameters in `body` to the unverified archives uploaded within the
+        interval [today - age - margin, today - margin], where today is taken from `body` if
+        given there
+
+        :return the window of the uploads within the interval, see `_upload_window`
+        """
+        today = body.get("today", dt.date.today().isoformat())
+        from_timestamp = dt.datetime.fromisoformat(today) - dt.timedelta(days=age+margin)
+        to_timestamp = from_timestamp + dt.timedelta(days=age)
+
+        body["uploaded_before"] = to_timestamp.date().isoformat()
+        body["uploaded_after"] = from_timestamp.date().isoformat()
+        body["verified"] = False
+        return QueryHandlerBase._upload_window(body["uploaded_before"], body["uploaded_after"])
+
+    @staticmethod
+    def _without_window(body):
+        return {key: value for key, value in body.items()
+                if key not in ("uploaded_before", "uploaded_after")}
+
+    @staticmethod
+    def _unverified_as_json(row):
+        return {
+            "timestamp": row["uploaded"],
+            "path": row["path"],
+            "description": row["description"],
+            "host": row["host"],
+            "archive": os.path.basename(os.path.normpath(row["path"]))}
+
     @staticmethod
     def _filter_query(
             query,
             path=None,
             description=None,
             host=None,
+            path_prefix=None,
+            description_prefix=None,
+            host_prefix=None,
             uploaded_before=None,
             uploaded_after=None,
             verified=None,
             removed=None,
+            cold=None,
             **kwargs):
 
-        if path:
-            query = query.where(
-                Archive.path.contains(path))
-        if description:
-            query = query.where(
-                Archive.description.contains(description))
-        if host:
-            query = query.where(
-                Archive.host.contains(host))
-        if uploaded_before:
-            query = query.where(
-                Upload.timestamp <= dt.datetime.strptime(
-                    f"{uploaded_before} 23:59:59",
-                    "%Y-%m-%d %H:%M:%S"))
-        if uploaded_after:
+        for field, substring, prefix in (
+                (Archive.path, path, path_prefix),
+                (Archive.description, description, description_prefix),
+                (Archive.host, host, host_prefix)):
+            if substring:
+                query = query.where(
+                    ArchiveIndex.contains(field, substring))
+            if prefix:
+                query = query.where(
+                    QueryHandlerBase._startswith(field, prefix))
+
+        # both bounds must be satisfied by the same upload, which may have been moved to a
+        # cold tier if the window reaches back far enough
+        window = QueryHandlerBase._upload_window(uploaded_before, uploaded_after)
+        if window != (None, None):
             query = query.where(
-                Upload.timestamp >= dt.datetime.strptime(
-                    uploaded_after,
-                    "%Y-%m-%d"))
+                QueryHandlerBase._uploaded_in(window, QueryHandlerBase._cold(cold)))
+
         if verified is not None:
             query = query.where(
-                Verification.timestamp.is_null(
+                ArchiveState.last_verified.is_null(
                     not QueryHandlerBase._str_as_bool(verified)))
         if removed is not None:
             query = query.where(
-                Removal.timestamp.is_null(
+                ArchiveState.last_removed.is_null(
                     not QueryHandlerBase._str_as_bool(removed)))
 
         return query.dicts()
 
-    def _do_query(self, query):
-        if query:
-            self.write_json({
-                "archives": [{
-                    "host": row["host"],
-                    "path": row["path"],
-                    "description": row["description"],
-                    "uploaded": str(row["uploaded"]) if row["uploaded"] else None,
-                    "verified": str(row["verified"]) if row["verified"] else None,
-                    "removed": str(row["removed"]) if row["removed"] else None}
-                    for row in query
-                ]})
+    @classmethod
+    def _encode_cursor(cls, row):
+        values = [field.db_value(row[key]) for field, key, _ in cls.LISTING_ORDER]
+        return base64.urlsafe_b64encode(json_encode(values).encode()).decode()
+
+    @classmethod
+    def _decode_cursor(cls, cursor):
+        try:
+            values = json_decode(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError, binascii.Error):
+            values = None
+        if not isinstance(values, list) or len(values) != len(cls.LISTING_ORDER) or not all(
+                cls._cursor_value(field, value)
+                for (field, _, _), value in zip(cls.LISTING_ORDER, values)):
+            raise HTTPError(400, "Invalid cursor '{0}'".format(cursor))
+        return values
+
+    @staticmethod
+    def _cursor_value(field, value):
+        """
+        :return whether `value` is a value of `field` as encoded in cursors, i.e. a string for
+        text fields and an integer for the others, which are ids or timestamps
+        """
+        if value is None:
+            return field.null
+        if isinstance(value, bool):
+            return False
+        return isinstance(value, str if isinstance(field, CharField) else int)
+
+    @classmethod
+    def _after(cls, values):
+        """
+        Split the rows following the position `values` in the listing order into disjoint
+        conditions, each of which can be served by a seek in the listing index. The conditions
+        are yielded in listing order.
+        """
+        order = cls.LISTING_ORDER
+        for i in reversed(range(len(order))):
+            equal = [field >> value for (field, _, _), value in zip(order[:i], values[:i])]
+            field, _, descending = order[i]
+            if not descending:
+                yield equal + [field > values[i]]
+            elif values[i] is not None:
+                # NULLs sort last in descending order
+                yield equal + [field < values[i]]
+                yield equal + [field.is_null()]
+
+    @classmethod
+    def _page(cls, query, page_size, cursor=None):
+        """
+        Fetch one page of the listing `query` following the position encoded in `cursor`
+
+        :return a tuple of the rows and the cursor of the following page, if any
+        """
+        branches = cls._after(cursor) if cursor else [[]]
+        rows = []
+        # read all branches from the same snapshot
+        with ArchiveState._meta.database.atomic():
+            for conditions in branches:
+                rows.extend(
+                    query.where(*conditions).limit(page_size + 1 - len(rows)) if conditions
+                    else query.limit(page_size + 1))
+                if len(rows) > page_size:
+                    break
+        if len(rows) > page_size:
+            return rows[:page_size], cls._encode_cursor(rows[page_size - 1])
+        return rows, None
+
+    def _pagination(self, page_size=None, cursor=None):
+        """
+        Validate the pagination parameters of a request
+
+        :return a tuple of the page size, or None if the request is not paginated, and the
+        decoded cursor
+        """
+        if page_size is None and not cursor:
+            return None, None
+        try:
+            page_size = int(page_size or self.DEFAULT_PAGE_SIZE)
+        except (ValueError, TypeError):
+            page_size = 0
+        if page_size < 1:
+            raise HTTPError(400, "Expecting 'page_size' to be a positive integer")
+        return page_size, self._decode_cursor(cursor) if cursor else None
+
+    @staticmethod
+    def _archive_as_json(row):
+        # the timestamps are left to the serializer
+        return {
+            "host": row["host"],
+            "path": row["path"],
+            "description": row["description"],
+            "uploaded": row["uploaded"],
+            "verified": row["verified"],
+            "removed": row["removed"]}
+
+    def _no_entries(self):
+        msg = "no entries matching criteria found in database"
+        self.set_status(204, reason=msg)
+
+    @staticmethod
+    def _cache_key(route, params):
+        """
+        :return the key of the response to `route` with the (normalized) `params`, leaving out
+        those that weren't given
+        """
+        return route, json.dumps(
+            {key: value for key, value in params.items() if value is not None},
+            sort_keys=True, default=str)
+
+    def _not_modified(self):
+        """
+        Set the validators of the current generation of the database on the response, and check
+        them against the conditional headers of a GET or HEAD request
+
+        :return True if the client's copy is current, in which case the status is set to 304
+        """
+        last_modified = response_cache.last_modified
+        self.set_header("Etag", response_cache.etag())
+        self.set_header("Last-Modified", last_modified)
+        if self.request.method not in ("GET", "HEAD"):
+            return False
+        if self.request.headers.get("If-None-Match"):
+            current = self.check_etag_header()
+        else:
+            try:
+                since = email.utils.parsedate_to_datetime(
+                    self.request.headers["If-Modified-Since"])
+            except (KeyError, TypeError, ValueError):
+                return False
+            if since.tzinfo is not None:
+                since = since.astimezone(dt.timezone.utc).replace(tzinfo=None)
+            current = not response_cache.modified_since(since)
+        if current:
+            self.set_status(304)
+        return current
+
+    async def _do_query(self, query, page_size=None, cursor=None, stream=None, cache_key=None):
+        """
+        Write the archives returned by `query`, or the page of them following `cursor` if
+        `page_size` is given. Unpaginated results are streamed if `stream` is true or if the
+        client accepts newline-delimited JSON. Other responses are served from the response
+        cache under `cache_key`, if given, and carry validators for conditional requests.
+        """
+        ndjson = NDJSON_CONTENT_TYPE in self.request.headers.get("Accept", "")
+        if page_size is None and (ndjson or (stream and self._str_as_bool(stream))):
+            await self._stream_query(query, ndjson)
+            return
+
+        if cache_key is not None:
+            if self._not_modified():
+                return
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                self._write_response(*cached)
+                return
+
+        generation = response_cache.generation
+        if page_size:
+            rows, next_cursor = await self._run(db_executor.read, self._page, query, page_size,
+                                                cursor)
         else:
-            msg = "no entries matching criteria found in database"
-            self.set_status(204, reason=msg)
+            rows = await self._run(db_executor.read, list, query)
+        metrics.db_rows.inc(self.route, "read", amount=len(rows))
+        if rows:
+            response = {"archives": [self._archive_as_json(row) for row in rows]}
+            if page_size:
+                response["next_cursor"] = next_cursor
+            status, body = 200, serializer.dumps(response)
+        else:
+            status, body = 204, None
+        if cache_key is not None:
+            response_cache.put(cache_key, generation, status, body)
+        self._write_response(status, body)
+
+    @staticmethod
+    async def _run(run, *args):
+        """
+        Await `run(*args)`, e.g. db_executor.read(fn, ...), answering 400 if its query reaches
+        more cold tiers than can be attached at once
+        """
+        try:
+            return await run(*args)
+        except TooManyTiersError as e:
+            raise HTTPError(400, str(e))
+
+    def _write_response(self, status, body=None):
+        if status == 204:
+            self._no_entries()
+        else:
+            self.write_json(body)
+
+    async def _stream_query(self, query, ndjson=False):
+        """
+        Stream the archives returned by `query` in chunks as they are read from the database,
+        either as the usual JSON document or as one JSON object per line, so that memory use
+        doesn't grow with the size of the result
+        """
+        batches = db_executor.stream(query.iterator, batch_size=self.STREAM_BATCH_SIZE)
+        try:
+            try:
+                # the query reaches the tiers before the first batch
+                batch = await self._run(batches.__anext__)
+            except StopAsyncIteration:
+                self._no_entries()
+                return
+
+            if ndjson:
+                self.set_header("Content-Type", NDJSON_CONTENT_TYPE)
+                separator, prefix, suffix = b"\n", b"", b"\n"
+            else:
+                self.set_header("Content-Type", "application/json")
+                separator, prefix, suffix = b",", b'{"archives":[', b"]}"
+
+            self.write(prefix)
+            while True:
+                metrics.db_rows.inc(self.route, "read", amount=len(batch))
+                self.write(separator.join(
+                    serializer.dumps(self._archive_as_json(row)) for row in batch))
+                await self.flush()
+                try:
+                    batch = await batches.__anext__()
+                except StopAsyncIteration:
+                    break
+                self.write(separator)
+            self.write(suffix)
+        finally:
+            await batches.aclose()
 
 
 class ViewHandler(QueryHandlerBase):
 
-    @gen.coroutine
-    def get(self, limit=None):
+    async def get(self, limit=None):
         """
         GET archives recorded in the database, sorted by upload timestamp (descending) and
         archive path (ascending)
 
         /view returns all archives recorded in the database
         /view/[LIMIT] returns the LIMIT (positive integer) most recent records from database
+        /view?page_size=[N]&cursor=[CURSOR] returns the N archives following CURSOR
 
         :param limit: positive integer specifying the number of rows to limit the results to
-        :return archives recorded in the database as a json object under the key "archives"
+        :param page_size: (optional, query argument) paginate the archives, returning at most this
+        many per page
+        :param cursor: (optional, query argument) return the page following this cursor, as
+        returned under the key "next_cursor" of the previous page
+        :param stream: (optional, query argument) if true, stream the archives in chunks as they
+        are read from the database. Clients accepting application/x-ndjson get the archives
+        streamed as one JSON object per line
+        :return archives recorded in the database as a json object under the key "archives",
+        and if paginated, the cursor of the next page, or null on the last page, under the key
+        "next_cursor"
         """
         try:
             limit = max(1, int(limit))
         except (ValueError, TypeError):
             limit = None
+        page_size, cursor = self._pagination(
+            self.get_argument("page_size", None),
+            self.get_argument("cursor", None))
 
         query = self._db_query()
-        query = (
-            query.limit(
-                limit
-            ).dicts()
-        )
-        self._do_query(query)
+        if page_size is None:
+            query = query.limit(limit)
+        await self._do_query(
+            query.dicts(), page_size, cursor, stream=self.get_argument("stream", None),
+            cache_key=self._cache_key("view", {
+                "limit": limit if page_size is None else None,
+                "page_size": page_size,
+                "cursor": cursor}))
 
 
 class QueryHandler(QueryHandlerBase):
 
-    @gen.coroutine
-    def post(self):
+    async def post(self):
         """
         Retrieve archives recorded in the database, conditioned by the parameters supplied in the
         request body and sorted by upload timestamp (descending) and archive path (ascending).
@@ -284,6 +741,12 @@ class QueryHandler(QueryHandlerBase):
         partially match this string
         :param host: (optional) fetch archives that were uploaded from a host whose hostname fully
         or partially match this string
+        :param path_prefix: (optional) fetch archives whose path starts with this string
+        (case-sensitive)
+        :param description_prefix: (optional) fetch archives whose unique TSM description starts
+        with this string (case-sensitive)
+        :param host_prefix: (optional) fetch archives that were uploaded from a host whose
+        hostname starts with this string (case-sensitive)
         :param uploaded_before: (optional) fetch archives that were uploaded on or before this date,
         formatted as YYYY-MM-DD
         :param uploaded_after: (optional) fetch archives that were uploaded on or after this date,
@@ -294,27 +757,238 @@ class QueryHandler(QueryHandlerBase):
         :param removed: (optional) if True, fetch only archives that have been removed from
         storage. If False, fetch only archives that have not been removed. If omitted, fetch
         archives regardless of removal status
+        :param cold: (optional) if False, leave out the uploads that have been moved to the cold
+        tiers when matching uploaded_before and uploaded_after, which otherwise read the tiers
+        that the dates reach back to
+        :param page_size: (optional) paginate the matching archives, returning at most this many
+        per page
+        :param cursor: (optional) return the page following this cursor, as returned under the key
+        "next_cursor" of the previous page
+        :param stream: (optional) if true, stream the archives in chunks as they are read from the
+        database. Clients accepting application/x-ndjson get the archives streamed as one JSON
+        object per line
         :return archives in the database matching the criteria in the request body as a json object
-        under the key "archives"
+        under the key "archives", and if paginated, the cursor of the next page, or null on the
+        last page, under the key "next_cursor"
         """
         body = self.decode()
+        page_size, cursor = self._pagination(
+            body.get("page_size"),
+            body.get("cursor"))
         query = self._filter_query(
             self._db_query(),
             **body)
-        self._do_query(query)
+        params = {key: value for key, value in body.items() if key != "stream"}
+        params.update(page_size=page_size, cursor=cursor)
+        await self._do_query(
+            query, page_size, cursor, stream=body.get("stream"),
+            cache_key=self._cache_key("query", params))
+
+
+# TODO: We might have to add logic in some of the services
+# that adds a file with the description inside the archive,
+# so we can verify that we're operating on the correct
+# archive before (verifying/)removing.
+
+class RemovalHandler(QueryHandlerBase):
+
+    # removable archives are listed in the order of the archive_state_removable index
+    LISTING_ORDER = (
+        (ArchiveState.archive, "archive", False),)
+
+    ACTIONS = {
+        "set_removable": (Removal.schedule, "scheduled"),
+        "set_removed": (Removal.complete, "removed"),
+    }
+
+    async def post(self):
+        """
+        Archive `foo` was either staged for removal or actually just physically removed from local disk, as well
+        as all its associated files (e.g. runfolder etc).
+
+        :param description: The unique TSM description of the archive
+        :param action: "set_removable" if the archive has been scheduled for removal, or "set_removed" if it
+        has been removed. A removal that wasn't scheduled first is recorded as done right away.
+        :param timestamp: (optional) if specified, use this timestamp for the scheduling or removal instead
+        of datetime.datetime.utcnow().isoformat()
+        :return Information about the scheduled or done removal
+        """
+        body = self.decode(required_members=["description", "action"])
+        if body["action"] not in self.ACTIONS:
+            msg = "Expecting parameter 'action' to be 'set_removable' or 'set_removed'."
+            raise HTTPError(400, msg)
+        record, status = self.ACTIONS[body["action"]]
+        tstamp = self.decode_timestamp(body)
+
+        try:
+            removal = await db_executor.write(record, body["description"], tstamp)
+        except Archive.DoesNotExist:
+            msg = "No archive with the unique description {} exists in the database!".format(
+                body["description"])
+            raise HTTPError(404, msg)
+        response_cache.invalidate()
+        change_notifier.notify()
+
+        self.write_json({"status": status, "removal":
+                         {"id": removal.id,
+                          "timestamp_scheduled": str(removal.timestamp_scheduled)
+                          if removal.timestamp_scheduled else None,
+                          "timestamp": str(removal.timestamp) if removal.timestamp else None,
+                          "done": removal.done,
+                          "description": removal.archive.description,
+                          "path": removal.archive.path,
+                          "host": removal.archive.host}})
+
+    @staticmethod
+    def _removable_query(scheduled=None, verified_before=None):
+        query = ArchiveState.select_removable(
+            Archive.host,
+            ArchiveState.path,
+            Archive.description,
+            ArchiveState.last_uploaded.alias("uploaded"),
+            ArchiveState.last_verified.alias("verified"),
+            ArchiveState.removal_scheduled.alias("scheduled"),
+            ArchiveState.archive
+        ).join(
+            Archive, on=(ArchiveState.archive == Archive.id)
+        ).order_by(
+            ArchiveState.archive)
+        if scheduled is not None:
+            query = query.where(
+                ArchiveState.removal_scheduled.is_null(
+                    not QueryHandlerBase._str_as_bool(scheduled)))
+        if verified_before:
+            query = query.where(
+                ArchiveState.last_verified <= dt.datetime.strptime(
+                    f"{verified_before} 23:59:59",
+                    "%Y-%m-%d %H:%M:%S"))
+        return query.dicts()
+
+    @staticmethod
+    def _archive_as_json(row):
+        return {
+            "host": row["host"],
+            "path": row["path"],
+            "description": row["description"],
+            "uploaded": row["uploaded"],
+            "verified": row["verified"],
+            "scheduled": row["scheduled"]}
+
+    async def get(self):
+        """
+        GET the archives that may be removed, i.e. those that have been verified but not removed,
+        one page at a time
+
+        :param page_size: (optional, query argument) the number of archives per page, 1000 if not
+        specified
+        :param cursor: (optional, query argument) return the page following this cursor, as
+        returned under the key "next_cursor" of the previous page
+        :param scheduled: (optional, query argument) if true, only return the archives that have
+        been scheduled for removal, if false only those that haven't
+        :param verified_before: (optional, query argument) only return the archives last verified
+        on or before this date (YYYY-MM-DD)
+        :return the archives as a json object under the key "archives", with the time they were
+        scheduled for removal if they were, and the cursor of the next page, or null on the last
+        page, under the key "next_cursor"
+        """
+        page_size, cursor = self._pagination(
+            self.get_argument("page_size", self.DEFAULT_PAGE_SIZE),
+            self.get_argument("cursor", None))
+        try:
+            query = self._removable_query(
+                scheduled=self.get_argument("scheduled", None),
+                verified_before=self.get_argument("verified_before", None))
+        except (ValueError, TypeError) as e:
+            raise HTTPError(400, str(e))
+        await self._do_query(query, page_size, cursor)
 
 
 class RandomUnverifiedArchiveHandler(QueryHandlerBase):
 
-    @gen.coroutine
-    def get(self):
+    # random probes to make per requested archive, before the remaining archives are instead
+    # sampled from the full list of matching archives
+    PROBES_PER_ARCHIVE = 16
+    # consecutive probes missing, after which the matching archives are taken to be too sparse
+    # for probing
+    MAX_MISSES = 64
+    MAX_COUNT = 1000
+
+    async def get(self):
         """
         For backwards compability, forward this GET request to the POST handler
         """
-        self.post()
+        await self.post()
 
-    @gen.coroutine
-    def post(self):
+    @classmethod
+    def _sample(cls, query, window, count, rng, cold=None):
+        """
+        Pick up to `count` distinct archives returned by `query` at random, each with the same
+        probability, among those with an upload within the `window`.
+
+        Random ids within the range of the uploads in the window are probed. A probe hits if the
+        upload with that id is in the window, is the first upload of its archive in the window and
+        the archive is returned by `query`. Every matching archive is thus hit by exactly one id.
+        Each probe is a few primary key and index lookups, i.e. O(log n). There are at most as
+        many probes as ids in the range. If too many probes miss, or `MAX_MISSES` in a row, e.g.
+        because nearly all archives in the window have been verified, the remaining archives
+        are sampled from the full list of matching archives instead, as they are when the
+        window reaches into the cold tiers, whose uploads can't be probed.
+
+        :return a list of the rows of the picked archives
+        """
+        conditions = within(Upload.timestamp, *window)
+        with ArchiveState._meta.database.atomic():
+            probes = 0
+            if not EventHistory(Upload, *window, cold=cold).tiers():
+                lo, hi = Upload.select(
+                    fn.MIN(Upload.id),
+                    fn.MAX(Upload.id)
+                ).where(*conditions).scalar(as_tuple=True)
+                if lo is None:
+                    return []
+                probes = min(cls.PROBES_PER_ARCHIVE * count, hi - lo + 1)
+
+            picked = {}
+            misses = 0
+            for _ in range(probes):
+                if len(picked) == count or misses >= cls.MAX_MISSES:
+                    break
+                misses += 1
+                upload_id = rng.randint(lo, hi)
+                archive_id = Upload.select(
+                    Upload.archive
+                ).where(
+                    Upload.id == upload_id,
+                    *conditions
+                ).scalar()
+                if archive_id is None or archive_id in picked:
+                    continue
+                earlier = Upload.select().where(
+                    Upload.archive == archive_id,
+                    Upload.id < upload_id,
+                    *conditions)
+                if earlier.exists():
+                    continue
+                row = query.where(ArchiveState.archive == archive_id).first()
+                if row:
+                    picked[archive_id] = row
+                    misses = 0
+
+            if len(picked) < count:
+                query = query.where(cls._uploaded_in(window, cold))
+                remaining = [
+                    archive_id
+                    for archive_id, in query.select(ArchiveState.archive).tuples()
+                    if archive_id not in picked]
+                sample = rng.sample(remaining, min(count - len(picked), len(remaining)))
+                rows = {
+                    row["archive"]: row
+                    for row in query.where(ArchiveState.archive.in_(sample))}
+                picked.update((archive_id, rows[archive_id]) for archive_id in sample)
+
+        return list(picked.values())
+
+    async def post(self):
         """
         Returns an unverified Archive object that has an associated was Upload object
         within the interval [today - age - margin, today - margin]. The margin value is
@@ -325,7 +999,13 @@ class RandomUnverifiedArchiveHandler(QueryHandlerBase):
         :param safety_margin: Number of days we should use as safety buffer
         :param today: (optional) if specified, use this timestamp for the reference date instead of
         datetime.datetime.utcnow().isoformat()
-        :return A randomly pickedunverified archive within the specified date interval
+        :param count: (optional) if specified, return a list of up to this many distinct archives,
+        at most MAX_COUNT, as "archives" instead of a single "archive"
+        :param seed: (optional) seed for the random picks, the same seed gives the same picks as
+        long as the database is unchanged
+        :param cold: (optional) if False, leave out the uploads that have been moved to the cold
+        tiers
+        :return A randomly picked unverified archive within the specified date interval
         """
         body = self.decode(
             required_members=[
@@ -333,37 +1013,28 @@ class RandomUnverifiedArchiveHandler(QueryHandlerBase):
                 "safety_margin"])
         age = int(body["age"])
         margin = int(body["safety_margin"])
-        today = body.get("today", dt.date.today().isoformat())
-
-        from_timestamp = dt.datetime.fromisoformat(today) - dt.timedelta(days=age+margin)
-        to_timestamp = from_timestamp + dt.timedelta(days=age)
-
-        body["uploaded_before"] = to_timestamp.date().isoformat()
-        body["uploaded_after"] = from_timestamp.date().isoformat()
-        body["verified"] = False
+        multiple = "count" in body
+        count = self._count(body.pop("count", 1), self.MAX_COUNT)
+        rng = random.Random(body.pop("seed", None))
 
+        window = self._unverified_window(body, age, margin)
+        # the window is checked by the sampler
         query = self._filter_query(
             self._db_query(),
-            **body)
+            **self._without_window(body))
 
-        result_len = query.count()
+        uploads = await self._run(
+            db_executor.read, self._sample, query, window, count, rng, self._cold(body.get("cold")))
 
-        if result_len > 0:
-            upload = query.first()
-            archive_name = os.path.basename(
-                os.path.normpath(
-                    upload["path"]
-                )
-            )
+        if uploads and multiple:
+            self.write_json({
+                "status": "unverified",
+                "archives": [self._unverified_as_json(upload) for upload in uploads]
+            })
+        elif uploads:
             self.write_json({
                 "status": "unverified",
-                "archive": {
-                    "timestamp": str(upload["uploaded"]),
-                    "path": upload["path"],
-                    "description": upload["description"],
-                    "host": upload["host"],
-                    "archive": archive_name
-                }
+                "archive": self._unverified_as_json(uploads[0])
             })
         else:
             criteria = ", ".join([f"{k}={v}" for k, v in body.items()])
@@ -374,6 +1045,333 @@ class RandomUnverifiedArchiveHandler(QueryHandlerBase):
             )
 
 
+class VerificationPlanHandler(QueryHandlerBase):
+
+    DEFAULT_PLAN_SIZE = 10
+
+    @staticmethod
+    def _stratum(row):
+        year, week, _ = row["uploaded"].isocalendar()
+        return row["host"], f"{year}-W{week:02d}"
+
+    @staticmethod
+    def _plan_query(window, now, cold=None):
+        """
+        :return a query for the archives uploaded within the `window` which aren't leased at
+        `now`, with the time of their first upload in the window. It is served by a range scan
+        of the upload timestamp index, and of the same index in the cold tiers the window
+        reaches.
+        """
+        uploads = EventHistory(Upload, *window, cold=cold)
+        return Archive.select(
+            uploads.c.archive_id.alias("archive"),
+            Archive.host,
+            Archive.path,
+            Archive.description,
+            fn.MIN(uploads.c.timestamp).python_value(
+                Upload.timestamp.python_value).alias("uploaded")
+        ).from_(
+            uploads
+        ).join(
+            Archive, on=(Archive.id == uploads.c.archive_id)
+        ).join(
+            ArchiveState, on=(ArchiveState.archive == Archive.id)
+        ).where(
+            ~VerificationLease.active(now)
+        ).group_by(
+            uploads.c.archive_id)
+
+    @classmethod
+    def _plan(cls, query, count, rng, lease=None):
+        """
+        Pick up to `count` archives returned by `query`, spread as evenly as possible over the
+        strata of archives sharing host and upload week.
+
+        The query is read in a single pass, keeping a random sample (reservoir) of up to `count`
+        archives per stratum. The strata then take turns, in random order, to add one of their
+        archives to the plan until it is full. A busy host or week thus gets no more archives
+        than a quiet one, unless the quiet one runs out of archives.
+
+        :param lease: optional tuple of token, current time and expiry time. The planned
+        archives are leased in the same transaction as they are picked.
+        :return a tuple of the planned rows and a dict with the number of matching archives per
+        stratum
+        """
+        with write_transaction() if lease else ArchiveState._meta.database.atomic():
+            seen = {}
+            reservoirs = {}
+            for row in query.iterator():
+                stratum = cls._stratum(row)
+                seen[stratum] = seen.get(stratum, 0) + 1
+                reservoir = reservoirs.setdefault(stratum, [])
+                if len(reservoir) < count:
+                    reservoir.append(row)
+                else:
+                    i = rng.randrange(seen[stratum])
+                    if i < count:
+                        reservoir[i] = row
+
+            strata = sorted(reservoirs)
+            for stratum in strata:
+                rng.shuffle(reservoirs[stratum])
+            rng.shuffle(strata)
+            plan = [
+                reservoirs[stratum][i]
+                for i in range(count)
+                for stratum in strata
+                if i < len(reservoirs[stratum])][:count]
+
+            if lease and plan:
+                VerificationLease.reserve([row["archive"] for row in plan], *lease)
+        return plan, seen
+
+    async def post(self):
+        """
+        Plans a batch of unverified archives to verify, among those that were uploaded within the
+        interval [today - age - margin, today - margin] like for /randomarchive. The archives are
+        spread as evenly as possible over the hosts and upload weeks, rather than picked in
+        proportion to how many archives each host uploaded.
+
+        :param age: Number of days we should look back when picking unverified archives
+        :param safety_margin: Number of days we should use as safety buffer
+        :param today: (optional) if specified, use this date as the reference date instead of today
+        :param count: (optional) the number of archives to plan, 10 if not specified
+        :param seed: (optional) seed for the random picks
+        :param lease: (optional) number of seconds to reserve the planned archives for. Reserved
+        archives are left out of other plans until the lease expires or they are verified.
+        :param cold: (optional) if False, leave out the uploads that have been moved to the cold
+        tiers
+        :return the planned archives, the number of matching and planned archives per host and
+        upload week and, if requested, the token and expiry time of the lease
+        """
+        body = self.decode(
+            required_members=[
+                "age",
+                "safety_margin"])
+        age = int(body["age"])
+        margin = int(body["safety_margin"])
+        count = self._count(body.pop("count", self.DEFAULT_PLAN_SIZE))
+        rng = random.Random(body.pop("seed", None))
+        lease = body.pop("lease", None)
+        now = dt.datetime.utcnow()
+
+        window = self._unverified_window(body, age, margin)
+        query = self._filter_query(
+            self._plan_query(window, now, self._cold(body.get("cold"))),
+            **self._without_window(body))
+
+        if lease is None:
+            reservation = None
+            plan, seen = await self._run(db_executor.read, self._plan, query, count, rng)
+        else:
+            try:
+                seconds = float(lease)
+            except (ValueError, TypeError):
+                seconds = 0
+            if seconds <= 0:
+                raise HTTPError(400, "Expecting 'lease' to be a positive number of seconds")
+            reservation = (uuid.uuid4().hex, now, now + dt.timedelta(seconds=seconds))
+            # picking and leasing in a single write transaction keeps concurrent plans from
+            # picking the same archives
+            plan, seen = await self._run(
+                db_executor.write, self._plan, query, count, rng, reservation)
+
+        if not plan:
+            criteria = ", ".join([f"{k}={v}" for k, v in body.items()])
+            msg = f"No archives matching criteria {criteria} were found!"
+            self.set_status(
+                204,
+                reason=msg
+            )
+            return
+
+        planned = collections.Counter(map(self._stratum, plan))
+        response = {
+            "status": "planned",
+            "archives": [
+                {**self._unverified_as_json(row), "week": self._stratum(row)[1]}
+                for row in plan],
+            "strata": [
+                {"host": host, "week": week, "unverified": unverified,
+                 "planned": planned[(host, week)]}
+                for (host, week), unverified in sorted(seen.items())]
+        }
+        if reservation:
+            response["lease"] = {
+                "token": reservation[0],
+                "expires": str(reservation[2])}
+        self.write_json(response)
+
+
+class ChangesHandler(BaseHandler):
+
+    DEFAULT_LIMIT = 1000
+    MAX_LIMIT = 10000
+    MAX_TIMEOUT = 300
+    # while waiting, how often to check for changes that weren't notified, i.e. those written
+    # by other worker processes or directly to the database
+    POLL_INTERVAL = 1.0
+
+    def initialize(self, route=None):
+        super().initialize(route)
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+
+    def _argument(self, name, convert, default, low, high=None):
+        try:
+            value = convert(self.get_argument(name, default))
+        except ValueError:
+            value = None
+        if value is None or value < low or (high is not None and value > high):
+            raise HTTPError(400, "Expecting '{0}' to be a number {1}".format(
+                name, f"from {low} to {high}" if high is not None else f"of at least {low}"))
+        return value
+
+    async def get(self):
+        """
+        GET the uploads, verifications and removals recorded after a given change, in the order
+        they were recorded. If there are none yet, wait for them, up to a timeout.
+
+        :param since: (optional, query argument) the sequence number of the last change seen,
+        0 (the default) to read the feed from its beginning
+        :param limit: (optional, query argument) the maximum number of changes to return, 1000
+        by default
+        :param timeout: (optional, query argument) the number of seconds to wait for changes if
+        there are none, at most 300. By default, the request returns right away.
+        :return the changes as a json object under the key "changes", each with its sequence
+        number "seq", the event ("upload", "verification", "removal_scheduled" or "removal"),
+        the timestamp of the event and the description, path and host of the archive, and
+        under the key "last_seq" the sequence number to pass as `since` to get the following
+        changes
+        """
+        since = self._argument("since", int, 0, 0)
+        limit = self._argument("limit", int, self.DEFAULT_LIMIT, 1, self.MAX_LIMIT)
+        timeout = self._argument("timeout", float, 0, 0, self.MAX_TIMEOUT)
+        deadline = IOLoop.current().time() + timeout
+
+        while True:
+            changes = await db_executor.read(Change.since, since, limit)
+            remaining = deadline - IOLoop.current().time()
+            if changes or remaining <= 0 or self.closed:
+                break
+            await change_notifier.wait(min(remaining, self.POLL_INTERVAL))
+        if self.closed:
+            return
+        metrics.db_rows.inc(self.route, "read", amount=len(changes))
+        self.write_json({
+            "changes": changes,
+            "last_seq": changes[-1]["seq"] if changes else since})
+
+
+class CacheHandler(BaseHandler):
+
+    def get(self):
+        """
+        Statistics of the cache of /view and /query responses
+
+        :return the number of cache hits, misses and evictions, the number of entries and bytes
+        held, the configured bounds, and the current generation of the database
+        """
+        self.write_json(response_cache.stats())
+
+
+class SlowQueryHandler(BaseHandler):
+
+    DEFAULT_COUNT = 10
+
+    def get(self):
+        """
+        The slowest shapes of SQL statements that have exceeded the slow query threshold since
+        the service started
+
+        :param count: (optional, query argument) the number of shapes to list, 10 by default
+        :return the threshold in milliseconds under the key "threshold_ms", or null if the slow
+        query log is disabled, and under the key "queries" the shapes sorted by their slowest
+        statement, with the number of slow statements, their total, mean and maximum duration,
+        the number of rows and the parameters of the slowest one, and the last captured query
+        plan
+        """
+        count = self._count(self.get_argument("count", self.DEFAULT_COUNT))
+        threshold = slow_query_log.threshold
+        self.write_json({
+            "threshold_ms": threshold * 1000 if threshold is not None else None,
+            "queries": slow_query_log.top(count)})
+
+
+class BackupHandler(BaseHandler):
+
+    def get(self):
+        """
+        The snapshots taken by the online backups
+
+        :return the backup directory, the number of snapshots kept, the last backup taken by
+        this process, or null, and the snapshots, latest first, with their file and size and
+        the files of their cold tiers
+        """
+        self.write_json({
+            "directory": backup.directory,
+            "keep": backup.keep,
+            "last": backup.last,
+            "snapshots": backup.snapshots()})
+
+    async def post(self):
+        """
+        Take a backup now, copying the database a few pages at a time while it keeps serving,
+        verify the snapshot and drop the snapshots beyond those kept
+
+        :return under the key "backup" the file and size of the snapshot, the files of its cold
+        tiers, the duration in seconds of the backup and of its longest step, the longest time
+        in seconds a write waited for the database lock meanwhile, and the files removed. 400
+        if backups aren't configured, 409 if another backup is running.
+        """
+        if not backup.enabled:
+            raise HTTPError(400, "Backups are not configured, see backup_directory")
+        try:
+            info = await IOLoop.current().run_in_executor(None, backup.run)
+        except BackupRunningError as e:
+            raise HTTPError(409, str(e))
+        except BackupError as e:
+            raise HTTPError(500, str(e))
+        self.write_json({"status": "created", "backup": info})
+
+
+class MetricsHandler(BaseHandler):
+
+    def get(self):
+        """
+        Metrics of the service in the Prometheus text format: the number of requests, their
+        latency and response sizes per route, the time spent in the database per route,
+        including waiting for a database thread and for the write lock, the number of archives
+        listed and rows written, and the state of the response cache and of group commit
+
+        :return the metrics as text/plain
+        """
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.write(metrics.exposition())
+
+
+metrics.register(metrics.Collected(
+    "archive_db_response_cache_events_total",
+    "Hits, misses and evictions of the response cache",
+    lambda: {
+        ("hit",): response_cache.hits,
+        ("miss",): response_cache.misses,
+        ("eviction",): response_cache.evictions},
+    ("event",), type="counter"))
+metrics.register(metrics.Collected(
+    "archive_db_response_cache_size",
+    "Number of entries and bytes held by the response cache",
+    lambda: {("entries",): len(response_cache), ("bytes",): response_cache.size},
+    ("unit",)))
+metrics.register(metrics.Collected(
+    "archive_db_group_commit_total",
+    "Transactions committed by group commit, and the events written in them",
+    lambda: {("batches",): group_commit.batches, ("items",): group_commit.items},
+    ("count",), type="counter"))
+
+
 class VersionHandler(BaseHandler):
 
     """
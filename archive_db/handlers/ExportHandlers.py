@@ -0,0 +1,59 @@
+from archive_db.export import Export, ExportError
+from archive_db.handlers.DbHandlers import BaseHandler
+from archive_db.models.DbExecutor import db_executor
+from archive_db.models.Model import TooManyTiersError
+
+from tornado.web import HTTPError
+
+
+class ExportHandler(BaseHandler):
+
+    async def get(self):
+        """
+        Export the archives, or their uploads, verifications or removals, streamed as CSV,
+        newline-delimited JSON or Parquet. The parameters are given as query arguments.
+
+        :param table: (optional) "archives" (default) for the archives with their latest upload,
+        verification and removal, or "uploads", "verifications" or "removals" for all events of
+        that kind
+        :param format: (optional) "ndjson" (default), "csv" or "parquet" (if pyarrow is
+        installed)
+        :param path, description, host, path_prefix, description_prefix, host_prefix,
+        uploaded_before, uploaded_after, verified, removed: (optional) export only the archives,
+        or events of the archives, matching these criteria, as for /query
+        :param cold: (optional) if false, the uploads and verifications moved to the cold tiers
+        are left out of their export
+        :return the exported rows as a file attachment
+        """
+        await self._export({
+            name: self.get_argument(name) for name in self.request.query_arguments})
+
+    async def post(self):
+        """
+        Export the archives, or their uploads, verifications or removals, streamed as CSV,
+        newline-delimited JSON or Parquet. Takes the same parameters as GET, in the JSON body.
+        """
+        await self._export(self.decode())
+
+    async def _export(self, params):
+        try:
+            export = Export(**params)
+        except ExportError as e:
+            raise HTTPError(400, str(e))
+
+        self.set_header("Content-Type", export.encoder.content_type)
+        self.set_header(
+            "Content-Disposition", 'attachment; filename="{0}"'.format(export.filename))
+        # encoded on the read thread, and handed over a chunk at a time
+        chunks = db_executor.stream(export.batches, batch_size=1)
+        try:
+            async for batch in chunks:
+                for chunk in batch:
+                    if chunk:
+                        self.write(chunk)
+                        await self.flush()
+        except TooManyTiersError as e:
+            # the queries of the exports reach the tiers before anything is written
+            raise HTTPError(400, str(e))
+        finally:
+            await chunks.aclose()
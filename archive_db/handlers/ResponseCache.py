@@ -0,0 +1,208 @@
+import collections
+import datetime as dt
+import multiprocessing
+import os
+import time
+import uuid
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized read responses, bounded by the number of entries and by the total
+    size of the cached bodies.
+
+    Entries are tagged with the generation of the database they were read from. The write
+    handlers call `invalidate` once their write has committed, which bumps the generation and
+    drops all entries. A response read while a write was committing is stored under the
+    generation the read started in, so it is never served once the write has been
+    acknowledged.
+
+    When the service runs several worker processes, the cache is configured as `shared` before
+    they are forked. The generation and its time of modification are then kept in shared
+    memory, so that a write through any worker invalidates the entries of all of them, and
+    they all hand out the same entity tags.
+
+    Writers outside the service, e.g. the import and tiering commands, can't reach the cache
+    itself. They `touch` a stamp file next to the database instead, which the cache, given its
+    path by `configure`, checks before serving anything, and is invalidated when it has changed.
+
+    The time of modification has a resolution of seconds, so it can't tell apart the
+    generations started within the same second. Only the first of them can be validated by date,
+    the later ones only by entity tag.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 2**20):
+        self.configure(max_entries, max_bytes)
+
+    def configure(self, max_entries=256, max_bytes=64 * 2**20, shared=False, db_path=None):
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        # distinguishes the entity tags of this run of the service from those of earlier ones
+        self._instance = uuid.uuid4().hex[:8]
+        # the generation, the POSIX time it started at and the first generation started within
+        # the same second, shared with the forked workers
+        self._shared = multiprocessing.Array("q", 3) if shared else None
+        self._generation = 0
+        self._dated_generation = 0
+        self._last_modified = self._now()
+        if shared:
+            self._shared[:] = [0, self._posix(self._last_modified), 0]
+        self._stamp_path = self.stamp_path(db_path) if db_path else None
+        self._stamp = self._read_stamp()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _now():
+        # HTTP dates have a resolution of seconds
+        return dt.datetime.utcnow().replace(microsecond=0)
+
+    @staticmethod
+    def _posix(timestamp):
+        return int(timestamp.replace(tzinfo=dt.timezone.utc).timestamp())
+
+    @property
+    def generation(self):
+        self._sync()
+        return self._generation
+
+    @property
+    def last_modified(self):
+        self._sync()
+        return self._last_modified
+
+    @staticmethod
+    def stamp_path(db_path):
+        return db_path + "-cache.stamp"
+
+    @classmethod
+    def touch(cls, db_path):
+        """
+        Invalidate the caches of the service running on the database `db_path`, from another
+        process
+        """
+        path = cls.stamp_path(db_path)
+        with open(path, "a"):
+            pass
+        # the clock of the file system may be too coarse to tell two writes apart
+        stamp = max(time.time_ns(), os.stat(path).st_mtime_ns + 1)
+        os.utime(path, ns=(stamp, stamp))
+
+    def _read_stamp(self):
+        if self._stamp_path is None:
+            return None
+        try:
+            return os.stat(self._stamp_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _sync(self):
+        stamp = self._read_stamp()
+        if stamp != self._stamp:
+            # written by another process
+            self._stamp = stamp
+            self.invalidate()
+        if self._shared is None:
+            return
+        with self._shared.get_lock():
+            generation, modified, dated_generation = self._shared[:]
+        if generation != self._generation:
+            # another worker has written
+            self._generation = generation
+            self._dated_generation = dated_generation
+            self._last_modified = dt.datetime.utcfromtimestamp(modified)
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def invalidate(self):
+        # the time of modification never goes back, even if the clock does
+        if self._shared is None:
+            now = max(self._now(), self._last_modified)
+            self._generation += 1
+            if now != self._last_modified:
+                self._dated_generation = self._generation
+        else:
+            with self._shared.get_lock():
+                generation, modified, dated_generation = self._shared[:]
+                now = max(self._posix(self._now()), modified)
+                generation += 1
+                if now != modified:
+                    dated_generation = generation
+                self._shared[:] = [generation, now, dated_generation]
+                self._generation, self._dated_generation = generation, dated_generation
+            now = dt.datetime.utcfromtimestamp(now)
+        self._last_modified = now
+        self._clear()
+
+    def modified_since(self, since):
+        """
+        :param since: naive datetime in UTC, the Last-Modified date of a client's copy
+        :return False if the copy was read from the current generation, True if it might not
+        have been
+        """
+        self._sync()
+        return self._last_modified > since or self._generation != self._dated_generation
+
+    def etag(self):
+        """
+        :return the entity tag of any response read from the current generation. It is weak,
+        since the response is sent in whichever content coding the client accepts, which varies
+        its bytes but not its contents.
+        """
+        return 'W/"{0}-{1}"'.format(self._instance, self.generation)
+
+    def get(self, key):
+        """
+        :return a tuple of the status and body cached for `key`, or None
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != self.generation:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1:]
+
+    def put(self, key, generation, status, body=None):
+        """
+        Cache the `status` and `body` of the response to `key`, read from `generation`. Responses
+        from an earlier generation, and responses larger than the whole cache, are not stored.
+        """
+        size = len(body) if body else 0
+        if generation != self.generation or size > self.max_bytes or not self.max_entries:
+            return
+        if key in self._entries:
+            self.size -= self._size(self._entries.pop(key))
+        self._entries[key] = (generation, status, body)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self.size -= self._size(entry)
+            self.evictions += 1
+
+    @staticmethod
+    def _size(entry):
+        return len(entry[2]) if entry[2] else 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "bytes": self.size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "generation": self.generation}
+
+
+response_cache = ResponseCache()
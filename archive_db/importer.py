@@ -0,0 +1,192 @@
+"""
+Bulk import of uploads and verifications, e.g. backfilled from TSM logs, written straight to
+the database rather than posted one by one.
+
+The records are inserted in batches, each with a single lookup of its archives, which are
+deduplicated by description and created if they don't exist, and a single insert per event
+type. While importing, the triggers maintaining ArchiveState and ArchiveIndex are dropped, as
+are the secondary indexes of the event tables. They are all rebuilt once the inputs have been
+imported, or the import stops, so the service should preferably be stopped during an import.
+An import that is killed before it can rebuild them leaves the triggers missing, and init_db
+rebuilds the state and index when it finds them so.
+
+Each batch is committed together with the number of records of its input read so far. An
+input is recognized by its name and its first record, so an interrupted import continues
+after the last committed batch when it's run again with the same inputs, and only the records
+added to an input since it was imported are imported again, while a new input under the name
+of an earlier one is imported from its start.
+"""
+import csv
+import hashlib
+import itertools
+import json
+import logging
+import os
+
+from peewee import chunked
+
+from archive_db.models.Model import Archive, Upload, Verification, ArchiveState, ArchiveIndex, \
+    ImportCheckpoint, create_triggers, write_transaction, as_utc
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+EVENTS = {"upload": Upload, "verification": Verification}
+FORMATS = ("csv", "ndjson")
+
+
+def input_format(name, format=None):
+    """
+    :return `format`, or the format of the input `name` guessed from its extension
+    """
+    if format:
+        return format
+    extension = os.path.splitext(name)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".ndjson", ".jsonl", ".json"):
+        return "ndjson"
+    raise ValueError(f"Can't tell the format of {name}, expecting .csv or .ndjson")
+
+
+def read_records(stream, format):
+    """
+    :param stream: a text stream, opened with newline=""
+    :return an iterator over the records of `stream`, as dicts for CSV, and as the lines for
+    NDJSON, which are decoded by `parse` so that a malformed line is just an invalid record
+    """
+    if format == "csv":
+        return csv.DictReader(stream)
+    return (line for line in stream if line.strip())
+
+
+def parse(record, event=None):
+    """
+    :param event: the type of the event, unless given by the record itself
+    :return a tuple of the model of the event and the event, as accepted by `record_many`
+    :raises ValueError if the record is invalid
+    """
+    if isinstance(record, str):
+        record = json.loads(record)
+    if not isinstance(record, dict):
+        raise ValueError("Expecting a JSON object")
+    event = record.get("event") or event
+    if event not in EVENTS:
+        raise ValueError(f"Expecting 'event' to be 'upload' or 'verification', got {event!r}")
+    for member in ("description", "path", "host", "timestamp"):
+        if not record.get(member):
+            raise ValueError(f"Expecting '{member}' in the record")
+    return EVENTS[event], {
+        "description": record["description"],
+        "path": record["path"],
+        "host": record["host"],
+        "timestamp": as_utc(record["timestamp"])}
+
+
+def _event_indexes(db):
+    return [
+        name for name, in db.execute_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+            "AND tbl_name IN (?, ?)",
+            (Upload._meta.table_name, Verification._meta.table_name))]
+
+
+def prepare(db):
+    """
+    Drop the triggers and indexes that are rebuilt by `finish`
+    """
+    db.create_tables([ImportCheckpoint], safe=True)
+    with db.atomic():
+        for name in {**ArchiveState.triggers(), **ArchiveIndex.triggers()}:
+            db.execute_sql(f"DROP TRIGGER IF EXISTS {name}")
+        for name in _event_indexes(db):
+            db.execute_sql(f"DROP INDEX IF EXISTS {name}")
+
+
+def finish(db):
+    """
+    Recreate the triggers and indexes dropped by `prepare`, and rebuild the state and
+    substring index from the imported history
+    """
+    db.create_tables([Upload, Verification], safe=True)
+    create_triggers(db, ArchiveState.triggers())
+    ArchiveState.rebuild()
+    if ArchiveIndex.enabled:
+        create_triggers(db, ArchiveIndex.triggers())
+        ArchiveIndex.rebuild()
+
+
+def _fingerprint(records):
+    """
+    :return a digest of the first of the `records`, which stays the same as records are added
+    to an input, and an iterator over all of them
+    """
+    records = iter(records)
+    head = list(itertools.islice(records, 1))
+    digest = hashlib.sha256(json.dumps(head, sort_keys=True).encode())
+    return digest.hexdigest()[:16], itertools.chain(head, records)
+
+
+def import_records(source, records, event=None, batch_size=None, skip_invalid=False):
+    """
+    Import the `records` read from the input named `source`, continuing after its last
+    checkpoint, which is kept under its name and a digest of its first record
+
+    :param event: the type of the events, unless given by each record
+    :param skip_invalid: if True, skip invalid records instead of failing
+    :return a dict with the number of records imported, skipped as invalid, and skipped as
+    imported before
+    :raises ValueError if a record is invalid, or its archive is registered with another path or
+    host, and `skip_invalid` is False
+    """
+    fingerprint, records = _fingerprint(records)
+    source = f"{source}#{fingerprint}"
+    checkpoint, _ = ImportCheckpoint.get_or_create(source=source)
+    counts = {"imported": 0, "invalid": 0, "resumed_after": checkpoint.position}
+    if checkpoint.done:
+        log.info("%s has been imported before, importing any records added since", source)
+    position = checkpoint.position
+
+    for batch in chunked(_skip(records, position), batch_size or BATCH_SIZE):
+        events = {}
+        for record in batch:
+            position += 1
+            try:
+                model, parsed = parse(record, event)
+            except (ValueError, TypeError) as e:
+                if not skip_invalid:
+                    raise ValueError(f"{source}, record {position}: {e}")
+                log.warning("Skipping %s, record %d: %s", source, position, e)
+                counts["invalid"] += 1
+                continue
+            events.setdefault(model, []).append((position, parsed))
+
+        with write_transaction():
+            archives = Archive.lookup(
+                parsed for parsed_events in events.values() for _, parsed in parsed_events)
+            for model, parsed_events in events.items():
+                rows = []
+                for at, parsed in parsed_events:
+                    archive = archives[parsed["description"]]
+                    mismatch = Archive.mismatch(archive, parsed)
+                    if mismatch:
+                        if not skip_invalid:
+                            raise ValueError(f"{source}, record {at}: {mismatch}")
+                        log.warning("Skipping %s, record %d: %s", source, at, mismatch)
+                        counts["invalid"] += 1
+                        continue
+                    rows.append({"archive": archive, "timestamp": parsed["timestamp"]})
+                if rows:
+                    model.insert_many(rows).execute()
+                counts["imported"] += len(rows)
+            ImportCheckpoint.update(position=position).where(
+                ImportCheckpoint.source == source).execute()
+
+    ImportCheckpoint.update(done=True).where(ImportCheckpoint.source == source).execute()
+    return counts
+
+
+def _skip(records, count):
+    for i, record in enumerate(records):
+        if i >= count:
+            yield record
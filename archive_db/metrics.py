@@ -0,0 +1,232 @@
+"""
+Counters and histograms of the service, exposed in the Prometheus text format at /api/1.0/metrics.
+
+The metrics are recorded from the IOLoop as well as from the database threads, so each of them
+holds a lock. Only the few dictionary updates of an observation are done under the lock, and
+the exposition is rendered on demand.
+"""
+import bisect
+import contextvars
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The name of the route serving the current request. Handlers set it when a request starts,
+# and the database executor carries it over to its threads, so that database work is
+# attributed to the route it was done for.
+current_route = contextvars.ContextVar("current_route", default="")
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1, 5)
+BACKUP_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+# bytes
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+
+class _Metric:
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def _format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            '{0}="{1}"'.format(name, self._escape(value)) for name, value in pairs) + "}"
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.documentation),
+            "# TYPE {0} {1}".format(self.name, self.type)]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield "{0}{1} {2}".format(self.name, self._format_labels(labels), value)
+
+
+class Histogram(_Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one count per bucket, the +Inf bucket, and the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        for labels, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "{0}_bucket{1} {2}".format(
+                    self.name, self._format_labels(labels, [("le", bound)]), cumulative)
+            yield "{0}_sum{1} {2}".format(self.name, self._format_labels(labels), counts[-1])
+            yield "{0}_count{1} {2}".format(self.name, self._format_labels(labels), cumulative)
+
+
+class Peak:
+    """
+    The largest value observed since the last reset, e.g. the longest lock wait during a backup
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._value = max(self._value, value)
+
+    def reset(self):
+        """
+        :return the largest value observed since the last reset
+        """
+        with self._lock:
+            value, self._value = self._value, 0.0
+        return value
+
+
+class Collected(_Metric):
+    """
+    Values kept elsewhere, read from `collect`, a callable returning a dict from tuples of
+    label values to values, each time the metrics are exposed
+    """
+
+    def __init__(self, name, documentation, collect, labels=(), type="gauge"):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+        self.type = type
+
+    def _samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield "{0}{1} {2}".format(self.name, self._format_labels(labels), value)
+
+
+requests = Counter(
+    "archive_db_requests_total",
+    "Requests served, by route, method and status",
+    ("route", "method", "status"))
+request_duration = Histogram(
+    "archive_db_request_duration_seconds",
+    "Time from receiving a request to finishing its response, by route",
+    ("route",))
+response_size = Histogram(
+    "archive_db_response_size_bytes",
+    "Size of the response bodies, by route",
+    ("route",), buckets=SIZE_BUCKETS)
+db_statement_duration = Histogram(
+    "archive_db_db_statement_duration_seconds",
+    "Time spent executing SQL statements, by route",
+    ("route",), buckets=DB_BUCKETS)
+db_task_duration = Histogram(
+    "archive_db_db_task_duration_seconds",
+    "Time spent on the database threads, including fetching the rows, by route and pool",
+    ("route", "pool"), buckets=DB_BUCKETS)
+db_executor_wait = Histogram(
+    "archive_db_db_executor_wait_seconds",
+    "Time database work waited for a thread, and thereby a connection, by pool",
+    ("pool",), buckets=DB_BUCKETS)
+db_lock_wait = Histogram(
+    "archive_db_db_lock_wait_seconds",
+    "Time spent beginning transactions, i.e. waiting for the database lock, by route",
+    ("route",), buckets=DB_BUCKETS)
+db_writer_lock_wait = Histogram(
+    "archive_db_db_writer_lock_wait_seconds",
+    "Time write transactions waited for the writer lock shared by the worker processes, "
+    "by route",
+    ("route",), buckets=DB_BUCKETS)
+db_rows = Counter(
+    "archive_db_db_rows_total",
+    "Archives listed by the query handlers, and rows written, by route",
+    ("route", "operation"))
+backups = Counter(
+    "archive_db_backups_total",
+    "Backups taken, by outcome",
+    ("status",))
+backup_duration = Histogram(
+    "archive_db_backup_duration_seconds",
+    "Time taken by the backups, including their verification",
+    buckets=BACKUP_BUCKETS)
+backup_writer_stall = Histogram(
+    "archive_db_backup_writer_stall_seconds",
+    "Longest time a write transaction of this process waited for the database lock during "
+    "each backup",
+    buckets=DB_BUCKETS)
+
+# the longest wait for the database lock, or the writer lock, since it was last reset
+lock_wait_peak = Peak()
+
+REGISTRY = [
+    requests, request_duration, response_size, db_statement_duration, db_task_duration,
+    db_executor_wait, db_lock_wait, db_writer_lock_wait, db_rows, backups, backup_duration,
+    backup_writer_stall]
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def observe_statement(sql, duration, rowcount):
+    """
+    Record the execution of the statement `sql`, which took `duration` seconds and, if it
+    modified the database, affected `rowcount` rows
+    """
+    route = current_route.get()
+    if sql.startswith("BEGIN"):
+        db_lock_wait.observe(duration, route)
+        lock_wait_peak.observe(duration)
+    else:
+        db_statement_duration.observe(duration, route)
+        if rowcount > 0:
+            db_rows.inc(route, "written", amount=rowcount)
+
+
+def exposition():
+    """
+    :return all registered metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
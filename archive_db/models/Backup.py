@@ -0,0 +1,234 @@
+import datetime as dt
+import fcntl
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from archive_db import metrics
+from archive_db.models.Model import ColdTier
+
+log = logging.getLogger(__name__)
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupRunningError(BackupError):
+    pass
+
+
+class Backup:
+    """
+    Online backups of the database, taken with SQLite's backup API into timestamped snapshot
+    files, of which the latest few are kept.
+
+    The pages are copied a few at a time, sleeping in between. In WAL mode, the whole copy is
+    read from a single read transaction, so the snapshot is consistent and writers are never
+    blocked, they just can't checkpoint the log past the snapshot until the backup is done. In
+    the other journal modes each step holds a shared lock, which writers have to wait for, and
+    the copy starts over whenever another connection writes, so small steps keep the writers'
+    waits short. The longest wait of a write transaction of this process during the backup is
+    reported along with its duration.
+
+    The cold tiers of the database are copied along with it, in the same way, into files
+    named after the snapshot and their year, which are rotated with it. Tiering runs are held
+    off meanwhile, so the snapshot and its tiers hold every event exactly once.
+
+    Each snapshot is verified with an integrity check before it takes the place of the
+    previous ones, and backups are taken one at a time, also across worker processes.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, db_path=None, directory=None, keep=7, pages=1024, sleep=0.01,
+                  verify="quick"):
+        """
+        :param db_path: the database to back up
+        :param directory: the directory of the snapshots, or None to disable backups
+        :param keep: the number of snapshots to keep
+        :param pages: the number of pages copied per step
+        :param sleep: the number of seconds to sleep between steps
+        :param verify: "quick" or "full", for PRAGMA quick_check or integrity_check, or None
+        """
+        if verify not in ("quick", "full", None):
+            raise ValueError(f"Expecting verify to be 'quick', 'full' or None, got {verify!r}")
+        self.db_path = db_path
+        self.directory = directory
+        self.keep = max(1, int(keep))
+        self.pages = max(1, int(pages))
+        self.sleep = max(0.0, float(sleep))
+        self.verify = verify
+        self.last = None
+
+    @property
+    def enabled(self):
+        return bool(self.db_path and self.directory and self.db_path != ":memory:")
+
+    def _pattern(self):
+        stem = re.escape(os.path.splitext(os.path.basename(self.db_path))[0])
+        return re.compile(rf"({stem}-\d{{8}}T\d{{12}}Z)(?:-cold-(\d+))?\.db")
+
+    @staticmethod
+    def _tier_file(path, year):
+        return f"{os.path.splitext(path)[0]}-cold-{year}.db"
+
+    def snapshots(self):
+        """
+        :return the snapshots, latest first, as dicts with their file, size in bytes and the
+        files of their cold tiers, in order of year
+        """
+        if not self.enabled or not os.path.isdir(self.directory):
+            return []
+        pattern = self._pattern()
+        snapshots, tiers = [], {}
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            match = pattern.fullmatch(name)
+            if not match:
+                continue
+            path = os.path.join(self.directory, name)
+            if match.group(2):
+                tiers.setdefault(match.group(1), []).append((int(match.group(2)), path))
+            else:
+                snapshots.append((match.group(1), path))
+        return [
+            {"file": path,
+             "bytes": os.path.getsize(path),
+             "tiers": [tier for _, tier in sorted(tiers.get(stem, []))]}
+            for stem, path in snapshots]
+
+    def run(self):
+        """
+        Take a backup, verify it and drop the snapshots beyond the latest `keep`
+
+        :return a dict with the file and size of the snapshot, the files of its cold tiers, the
+        duration of the backup and its longest step, and the longest time a writer waited for
+        the database lock meanwhile
+        :raises BackupRunningError if another backup is running, and BackupError if backups
+        aren't configured or the snapshot fails verification
+        """
+        if not self.enabled:
+            raise BackupError("Backups are not configured, see backup_directory")
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".backup.lock"), "a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise BackupRunningError("Another backup is running")
+            try:
+                info = self._run()
+            except Exception:
+                metrics.backups.inc("failed")
+                raise
+        metrics.backups.inc("ok")
+        metrics.backup_duration.observe(info["seconds"])
+        metrics.backup_writer_stall.observe(info["longest_writer_stall"])
+        self.last = info
+        log.info("Backed up %s to %s in %.1fs", self.db_path, info["file"], info["seconds"])
+        return info
+
+    def scheduled(self):
+        """
+        Take a backup, logging rather than raising any failure
+        """
+        try:
+            self.run()
+        except Exception:
+            log.exception("Scheduled backup of %s failed", self.db_path)
+
+    def _copy(self, source, path, progress):
+        """
+        Copy the database of the connection `source` to `path`, and verify the copy
+        """
+        target = sqlite3.connect(path)
+        try:
+            source.backup(target, pages=self.pages, progress=progress, sleep=self.sleep)
+            # a snapshot in a single file
+            target.execute("PRAGMA journal_mode = delete")
+            if self.verify:
+                check = "quick_check" if self.verify == "quick" else "integrity_check"
+                result = [row[0] for row in target.execute(f"PRAGMA {check}")]
+                if result != ["ok"]:
+                    raise BackupError(
+                        f"The snapshot {path} failed {check}: {'; '.join(result[:10])}")
+        finally:
+            target.close()
+
+    def _run(self):
+        now = dt.datetime.utcnow()
+        stem = os.path.splitext(os.path.basename(self.db_path))[0]
+        path = os.path.join(self.directory, f"{stem}-{now:%Y%m%dT%H%M%S%f}Z.db")
+
+        metrics.lock_wait_peak.reset()
+        started = time.perf_counter()
+        steps = {"count": 0, "longest": 0.0, "last": started}
+
+        def progress(status, remaining, total):
+            # called after each step, which follows the sleep after the previous one
+            now = time.perf_counter()
+            elapsed = now - steps["last"] - (self.sleep if steps["count"] else 0.0)
+            steps["count"] += 1
+            steps["longest"] = max(steps["longest"], elapsed)
+            steps["last"] = now
+
+        # the snapshot and its tiers, as copied and once in place
+        copies = [(path + ".partial", path)]
+        with ColdTier.held(self.db_path):
+            source = sqlite3.connect(self.db_path, isolation_level=None)
+            try:
+                wal = source.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+                if wal:
+                    # read every step from the same snapshot
+                    source.execute("BEGIN")
+                    source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                self._copy(source, copies[0][0], progress)
+                tiers = []
+                if source.execute(
+                        "SELECT 1 FROM sqlite_master WHERE name = 'cold_tier'").fetchone():
+                    tiers = source.execute("SELECT year, file FROM cold_tier").fetchall()
+                if wal:
+                    source.execute("COMMIT")
+                directory = os.path.dirname(os.path.abspath(self.db_path))
+                for year, file in tiers:
+                    file = os.path.join(directory, file)
+                    if not os.path.exists(file):
+                        raise BackupError(f"The cold tier of {year}, {file}, is missing")
+                    tier = sqlite3.connect(file)
+                    copy = self._tier_file(path, year)
+                    copies.append((copy + ".partial", copy))
+                    try:
+                        self._copy(tier, copies[-1][0], progress)
+                    finally:
+                        tier.close()
+            except Exception:
+                for partial, _ in copies:
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                raise
+            finally:
+                source.close()
+        # the snapshot last, so that it is only listed once its tiers are in place
+        for partial, copy in reversed(copies):
+            os.replace(partial, copy)
+        seconds = time.perf_counter() - started
+
+        removed = []
+        for snapshot in self.snapshots()[self.keep:]:
+            for file in [snapshot["file"], *snapshot["tiers"]]:
+                os.remove(file)
+                removed.append(file)
+        return {
+            "file": path,
+            "bytes": os.path.getsize(path),
+            "tiers": [copy for _, copy in copies[1:]],
+            "created": now.isoformat(),
+            "seconds": round(seconds, 3),
+            "steps": steps["count"],
+            "longest_step": round(steps["longest"], 6),
+            "longest_writer_stall": round(metrics.lock_wait_peak.reset(), 6),
+            "removed": removed}
+
+backup = Backup()
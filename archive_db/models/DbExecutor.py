@@ -0,0 +1,257 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop
+
+from archive_db import metrics
+
+
+class DbExecutor:
+    """
+    Runs blocking database work on dedicated thread pools, so that the Tornado IOLoop stays
+    responsive while SQLite is busy.
+
+    Reads and writes are routed to separate pools. SQLite only allows one writer at a time, so
+    writes are funneled through a single thread by default while reads can be served in
+    parallel. Each worker thread holds its own database connection.
+    """
+
+    def __init__(self, read_workers=4, write_workers=1):
+        self._read_pool = None
+        self._write_pool = None
+        self.configure(read_workers=read_workers, write_workers=write_workers)
+
+    def configure(self, read_workers=4, write_workers=1, shared=False):
+        """
+        (Re)create the thread pools.
+
+        :param read_workers: number of threads serving read queries
+        :param write_workers: number of threads serving write transactions
+        :param shared: if True, route reads and writes to one single thread. This is required
+        for in-memory databases, which can only be reached through a single connection.
+        """
+        self.shutdown()
+        if shared:
+            self._read_pool = self._write_pool = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="archive-db")
+        else:
+            self._read_pool = ThreadPoolExecutor(
+                max_workers=max(1, int(read_workers)), thread_name_prefix="archive-db-read")
+            self._write_pool = ThreadPoolExecutor(
+                max_workers=max(1, int(write_workers)), thread_name_prefix="archive-db-write")
+
+    def shutdown(self, wait=False):
+        for pool in {self._read_pool, self._write_pool} - {None}:
+            pool.shutdown(wait=wait)
+        self._read_pool = self._write_pool = None
+
+    @staticmethod
+    def _submit(pool, name, fn, *args, **kwargs):
+        # run in a copy of the caller's context, so that the work is attributed to its route
+        context = contextvars.copy_context()
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            metrics.db_executor_wait.observe(started - submitted, name)
+            try:
+                return context.run(fn, *args, **kwargs)
+            finally:
+                metrics.db_task_duration.observe(
+                    time.perf_counter() - started, context.get(metrics.current_route, ""), name)
+
+        return IOLoop.current().run_in_executor(pool, run)
+
+    def read(self, fn, *args, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` on the read pool and return an awaitable with its result
+        """
+        return self._submit(self._read_pool, "read", fn, *args, **kwargs)
+
+    def write(self, fn, *args, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` on the write pool and return an awaitable with its result
+        """
+        return self._submit(self._write_pool, "write", fn, *args, **kwargs)
+
+    async def stream(self, fn, *args, batch_size=1000, **kwargs):
+        """
+        Iterate over the items of the iterable returned by `fn(*args, **kwargs)`, in batches of
+        at most `batch_size` items.
+
+        The iterable is consumed on a single thread of the read pool, since database cursors
+        can't move between threads, and handed over to the IOLoop one batch at a time. At most
+        a couple of batches are buffered, so memory use is bounded by the batch size rather
+        than by the number of items. If the consumer stops early, the producer stops as well.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=2)
+        stopped = threading.Event()
+
+        def put(item):
+            if stopped.is_set():
+                return False
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=0.1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if stopped.is_set():
+                        future.cancel()
+                        return False
+
+        def produce():
+            try:
+                batch = []
+                for item in fn(*args, **kwargs):
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+                if batch and not put(batch):
+                    return
+                put(_StreamEnd())
+            except Exception as e:
+                put(_StreamEnd(e))
+
+        self.read(produce)
+        try:
+            while True:
+                batch = await queue.get()
+                if isinstance(batch, _StreamEnd):
+                    if batch.error is not None:
+                        raise batch.error
+                    return
+                yield batch
+        finally:
+            stopped.set()
+            while not queue.empty():
+                queue.get_nowait()
+
+
+class _StreamEnd:
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+db_executor = DbExecutor()
+
+
+class GroupCommitWriter:
+    """
+    Coalesces concurrent writes into shared transactions. Submitted events are queued on the
+    IOLoop and committed together, by a single call to `commit` on the write pool, as soon as
+    `max_items` events are waiting or `window_ms` milliseconds have passed since the first one
+    arrived. Each submitter is answered once the transaction holding its event has committed.
+    """
+
+    def __init__(self, executor, commit):
+        """
+        :param executor: the DbExecutor whose write pool runs the commits
+        :param commit: callable taking a list of (model, event) tuples, writing them in one
+        transaction and returning the created objects in the same order, or an exception in place
+        of each event that was rejected
+        """
+        self.executor = executor
+        self.commit = commit
+        self.enabled = False
+        self.max_items = 100
+        self.window_ms = 10
+        self.batches = 0
+        self.items = 0
+        self._pending = []
+        self._timer = None
+
+    def configure(self, enabled=False, max_items=100, window_ms=10):
+        if self._timer is not None:
+            IOLoop.current().remove_timeout(self._timer)
+        self._pending = []
+        self._timer = None
+        self.batches = 0
+        self.items = 0
+        self.enabled = bool(enabled)
+        self.max_items = max(1, int(max_items))
+        self.window_ms = max(0, float(window_ms))
+
+    def submit(self, model, event):
+        """
+        Queue `event` to be written as a `model`
+
+        :return an awaitable resolving to the created object once it has been committed
+        """
+        loop = IOLoop.current()
+        future = loop.asyncio_loop.create_future()
+        self._pending.append((model, event, future))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            IOLoop.current().remove_timeout(self._timer)
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            write = self.executor.write(self._commit, batch)
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        IOLoop.current().add_future(write, functools.partial(self._written, batch))
+
+    def _written(self, batch, write):
+        if write.exception() is not None:
+            self._fail(batch, write.exception())
+
+    @staticmethod
+    def _fail(batch, error):
+        # the write failed before it could answer the submitters, e.g. the pool was shut down
+        # or _commit itself raised
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def _commit(self, batch):
+        events = [(model, event) for model, event, _ in batch]
+        try:
+            results = [self._outcome(result) for result in self.commit(events)]
+        except Exception:
+            # don't let one bad event fail the others, retry them in separate transactions
+            results = []
+            for event in events:
+                try:
+                    results.extend(self._outcome(result) for result in self.commit([event]))
+                except Exception as e:
+                    results.append((None, e))
+        self.batches += 1
+        self.items += len(batch)
+        loop = batch[0][2].get_loop()
+        for (_, _, future), (result, error) in zip(batch, results):
+            loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+    @staticmethod
+    def _outcome(result):
+        if isinstance(result, Exception):
+            return None, result
+        return result, None
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
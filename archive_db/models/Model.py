@@ -1,18 +1,335 @@
+import contextlib
+import datetime as dt
+import fcntl
+import functools
+import logging
+import operator
+import os
+import sqlite3
+import time
+
 from peewee import *
+from peewee import Expression, NodeList, OP, Source, SCOPE_COLUMN, SCOPE_SOURCE
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import AutoIncrementField, FTS5Model, SearchField
+
+from archive_db import metrics
+from archive_db.models.DbExecutor import db_executor, GroupCommitWriter
+from archive_db.models.SlowQueryLog import slow_query_log
+from archive_db.models.WriterLock import writer_lock
 
 # For schema migrations, see http://docs.peewee-orm.com/en/latest/peewee/database.html#schema-migrations
 # and http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#migrate
 #
 # Make sure that we *always*, as extra security, take a backup of the previous
-# db before doing a migration. We should also take continous backups
+# db before doing a migration. Continuous backups are taken by archive_db.models.Backup,
+# see backup_directory and backup_interval in app.config, or POST /api/1.0/admin/backup
+
+log = logging.getLogger(__name__)
 
 db_proxy = Proxy()
 
 
-def init_db(mydb="archives.db"):
-    db = SqliteDatabase(mydb)
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    """
+    Times the execution of every statement, attributing it to the route of the current
+    request. Beginning a transaction is timed separately, since that's where a writer waits
+    for the database lock. Slow statements are handed to the slow query log, if enabled.
+    """
+
+    def execute_sql(self, sql, params=None, commit=None):
+        start = time.perf_counter()
+        rowcount = -1
+        try:
+            cursor = super().execute_sql(sql, params, commit)
+            rowcount = cursor.rowcount
+        finally:
+            duration = time.perf_counter() - start
+            metrics.observe_statement(sql, duration, rowcount)
+        if slow_query_log.enabled:
+            return slow_query_log.track(self, cursor, sql, params, duration)
+        return cursor
+
+
+def init_db(mydb="archives.db", read_workers=4, write_workers=1, pragmas=None):
+    """
+    Open the database, create any missing tables and set up the executor that the handlers
+    use to run their queries off the IOLoop.
+
+    An in-memory database only exists within a single connection, so in that case all
+    threads share one connection and the executor serializes all work on a single thread.
+
+    :param pragmas: dict of SQLite pragmas, e.g. {"journal_mode": "wal"}, applied to every
+    connection when it is opened
+    """
+    db = open_db(mydb, read_workers=read_workers, write_workers=write_workers, pragmas=pragmas)
+    # an import that stopped before it could finish leaves the state and index without their
+    # triggers (see archive_db.importer), so they may be missing the imported events
+    triggers = {name for name, in db.execute_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    state_exists = ArchiveState.table_exists() and set(ArchiveState.triggers()) <= triggers
+    index_exists = not ArchiveIndex.table_exists() or set(ArchiveIndex.triggers()) <= triggers
+    migrate_db(db)
+    db.create_tables(
+        [Archive, Upload, Verification, Removal, ArchiveState, VerificationLease, Change,
+         ColdTier],
+        safe=True)
+    create_triggers(
+        db, {**ArchiveState.triggers(), **VerificationLease.triggers(), **Change.triggers()})
+    if not state_exists:
+        # an existing database is being upgraded, or an import was interrupted, derive the
+        # state from its history
+        ArchiveState.rebuild()
+    ArchiveIndex.setup(rebuild=not index_exists)
+    return db
+
+
+def open_db(mydb="archives.db", read_workers=4, write_workers=1, pragmas=None):
+    """
+    Open a database that has already been set up by `init_db`, e.g. in a worker process forked
+    after the parent initialized it, and set up the executor.
+    """
+    in_memory = mydb == ":memory:"
+    pragmas = dict(pragmas or {})
+    if in_memory:
+        db = InstrumentedSqliteDatabase(
+            mydb, pragmas=pragmas, thread_safe=False, check_same_thread=False)
+    else:
+        db = InstrumentedSqliteDatabase(mydb, pragmas=pragmas)
     db_proxy.initialize(db)
-    db.create_tables([Archive, Upload, Verification, Removal], safe=True)
+    db_executor.configure(
+        read_workers=read_workers,
+        write_workers=write_workers,
+        shared=in_memory)
+    return db
+
+
+@contextlib.contextmanager
+def write_transaction():
+    """
+    Start a transaction, or a savepoint within the current one, which takes the write lock of
+    the database right away (BEGIN IMMEDIATE), after the writer lock shared by the worker
+    processes, if there are several.
+
+    A deferred transaction only takes the lock at its first write and can't wait for it if it
+    has read anything first, it fails with "database is locked" straight away when another
+    connection is writing. This includes transactions writing archives, since the FTS5 index
+    reads its configuration before it is written to by the triggers.
+    """
+    with writer_lock, db_proxy.atomic("IMMEDIATE") as transaction:
+        yield transaction
+
+
+def create_triggers(db, triggers):
+    """
+    (Re)create triggers, so that databases created by older versions get the current definitions
+
+    :param triggers: dict with the name and definition (everything following the name) of each
+    trigger
+    """
+    with db.atomic():
+        for name, body in triggers.items():
+            db.execute_sql(f"DROP TRIGGER IF EXISTS {name}")
+            db.execute_sql(f"CREATE TRIGGER {name} {body}")
+
+
+def _add_archive_state_path(db, migrator):
+    if "archive_state" not in db.get_tables() or \
+            "path" in [column.name for column in db.get_columns("archive_state")]:
+        return
+    migrate(migrator.add_column("archive_state", "path", CharField(default="")))
+    db.execute_sql(
+        "UPDATE archive_state SET path = (SELECT path FROM archive WHERE id = archive_id)")
+
+
+def _add_removal_lifecycle(db, migrator):
+    tables = db.get_tables()
+    if "removal" in tables and \
+            "done" not in [column.name for column in db.get_columns("removal")]:
+        # the removals recorded so far are all done
+        migrate(
+            migrator.add_column("removal", "done", BooleanField(default=True)),
+            migrator.add_column("removal", "timestamp_scheduled", DateTimeField(null=True)),
+            migrator.drop_not_null("removal", "timestamp"))
+    if "archive_state" in tables and \
+            "removal_scheduled" not in [column.name for column in db.get_columns("archive_state")]:
+        migrate(
+            migrator.add_column("archive_state", "removal_scheduled", DateTimeField(null=True)))
+
+
+# timestamp columns that are stored as text by databases created by older versions
+TIMESTAMP_COLUMNS = {
+    "upload": ["timestamp"],
+    "verification": ["timestamp"],
+    "removal": ["timestamp", "timestamp_scheduled"],
+    "archive_state": ["last_uploaded", "last_verified", "last_removed", "removal_scheduled"],
+    "verification_lease": ["expires"],
+}
+
+
+def _rewrite_timestamps(db, table, column, batch_size=10000):
+    last = 0
+    while True:
+        rows = db.execute_sql(
+            f"SELECT rowid, {column} FROM {table} "
+            f"WHERE rowid > ? AND typeof({column}) = 'text' ORDER BY rowid LIMIT ?",
+            (last, batch_size)).fetchall()
+        if not rows:
+            return
+        updates = []
+        for rowid, value in rows:
+            try:
+                updates.append((to_epoch_us(value), rowid))
+            except ValueError:
+                raise ValueError(
+                    f"Can't convert {table}.{column} = {value!r} of row {rowid} to a timestamp")
+        db.cursor().executemany(f"UPDATE {table} SET {column} = ? WHERE rowid = ?", updates)
+        last = rows[-1][0]
+
+
+def _epoch_timestamps(db, migrator):
+    tables = db.get_tables()
+    for table, columns in TIMESTAMP_COLUMNS.items():
+        if table in tables:
+            for column in columns:
+                _rewrite_timestamps(db, table, column)
+    # superseded by the (archive_id, timestamp) indexes
+    for table in ("upload", "verification", "removal"):
+        db.execute_sql(f"DROP INDEX IF EXISTS {table}_archive_id")
+    if "archive_state" in tables:
+        # the latest events were picked by the triggers comparing the timestamps as text, by
+        # which e.g. "2023-06-01T10:00" came after "2023-06-01 11:00"
+        ArchiveState.rebuild()
+
+
+def _autoincrement_event_ids(db, migrator):
+    # the tables of the tiered events are rebuilt with AUTOINCREMENT ids, since SQLite would
+    # otherwise reuse the ids of the latest events once they have been moved to a tier, and
+    # the events in flight are told apart from those still in the database by id
+    tables = db.get_tables()
+    for model in ColdTier.MODELS:
+        table = model._meta.table_name
+        if table not in tables:
+            continue
+        sql, = db.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        if "AUTOINCREMENT" in sql.upper():
+            continue
+        for index in db.get_indexes(table):
+            db.execute_sql(f'DROP INDEX "{index.name}"')
+        db.execute_sql(f'ALTER TABLE "{table}" RENAME TO "{table}_old"')
+        model.create_table()
+        columns = ", ".join(f'"{field.column_name}"' for field in model._meta.sorted_fields)
+        db.execute_sql(
+            f'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM "{table}_old"')
+        db.execute_sql(f'DROP TABLE "{table}_old"')
+        # the latest events may have been moved to a tier already
+        latest = max([0] + [ColdTier.max_id(tier, model) for tier in ColdTier.select()]) \
+            if "cold_tier" in tables else 0
+        db.execute_sql(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (latest, table))
+        db.execute_sql(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+            (table, latest, table))
+
+
+# Schema migrations of existing databases, applied in order. The index of the last applied
+# migration is stored as the user_version of the database. Migrations must check whether they
+# apply, since tables created from scratch already have the current schema.
+MIGRATIONS = [
+    _add_archive_state_path,
+    _add_removal_lifecycle,
+    _epoch_timestamps,
+    _autoincrement_event_ids,
+]
+
+
+def migrate_db(db):
+    """
+    Apply the schema migrations that haven't been applied to the database yet
+    """
+    version = db.pragma("user_version")
+    if version >= len(MIGRATIONS):
+        return
+    # Tables may be rebuilt by the migrations, which doesn't work with triggers referring to
+    # them. All triggers are recreated by init_db once the schema is up to date.
+    for name, in db.execute_sql("SELECT name FROM sqlite_master WHERE type = 'trigger'"):
+        db.execute_sql(f"DROP TRIGGER IF EXISTS {name}")
+    migrator = SqliteMigrator(db)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        log.info(f"Applying schema migration {number}: {migration.__name__}")
+        with db.atomic():
+            migration(db, migrator)
+            db.pragma("user_version", number)
+
+
+def checkpoint(mode="PASSIVE"):
+    """
+    Checkpoint the write-ahead log into the database file. This is a no-op unless the database
+    is in WAL mode.
+
+    :param mode: one of PASSIVE, FULL, RESTART or TRUNCATE, see
+    https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+    :return a tuple (busy, log pages, checkpointed pages)
+    """
+    mode = mode.upper()
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"Unknown checkpoint mode {mode}")
+    return db_proxy.execute_sql(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+
+EPOCH = dt.datetime(1970, 1, 1)
+
+
+def as_utc(value):
+    """
+    :param value: a datetime, a date or an ISO 8601 string. Values without a time zone are taken
+    to be in UTC, like the timestamps generated by the service.
+    :return `value` as a naive datetime in UTC
+    :raises ValueError if `value` is a string that isn't an ISO 8601 timestamp
+    """
+    if isinstance(value, str):
+        value = value.strip()
+        # fromisoformat only understands Z from Python 3.11 on
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        value = dt.datetime.fromisoformat(value)
+    elif not isinstance(value, dt.datetime):
+        value = dt.datetime.combine(value, dt.time())
+    if value.tzinfo is not None:
+        value = value.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def to_epoch_us(value):
+    """
+    :param value: anything accepted by `as_utc`
+    :return the number of microseconds from the epoch to `value`
+    """
+    return (as_utc(value) - EPOCH) // dt.timedelta(microseconds=1)
+
+
+def from_epoch_us(value):
+    return EPOCH + dt.timedelta(microseconds=value)
+
+
+class EpochTimestampField(BigIntegerField):
+    """
+    A naive UTC datetime, stored as an integer number of microseconds since the epoch. Unlike
+    text, this compares and sorts correctly whichever format the timestamps were given in, and is
+    compact in the indexes. Integers are taken to be in microseconds since the epoch already.
+    """
+
+    def db_value(self, value):
+        if value is None or isinstance(value, int):
+            return value
+        return to_epoch_us(value)
+
+    def python_value(self, value):
+        if value is None or not isinstance(value, int):
+            return value
+        return from_epoch_us(value)
 
 
 class BaseModel(Model):
@@ -21,11 +338,152 @@ class BaseModel(Model):
         database = db_proxy
 
 
+class ArchiveIndex(FTS5Model):
+    """
+    Trigram full-text index over the searchable columns of Archive, which lets substring
+    searches use an index instead of scanning the table with LIKE '%...%'.
+
+    This is an external content table reading its values from Archive, kept in sync by
+    triggers. It requires SQLite 3.34 or newer built with FTS5. Otherwise `enabled` is False
+    and `contains` falls back to LIKE.
+    """
+
+    path = SearchField()
+    description = SearchField()
+    host = SearchField()
+
+    enabled = False
+
+    class Meta:
+        database = db_proxy
+        table_name = "archive_index"
+        options = {
+            "content": "archive",
+            "content_rowid": "id",
+            "tokenize": "trigram"}
+
+    @classmethod
+    def triggers(cls):
+        index = cls._meta.table_name
+        columns = "path, description, host"
+        new = "NEW.path, NEW.description, NEW.host"
+        old = "OLD.path, OLD.description, OLD.host"
+        insert = f"INSERT INTO {index} (rowid, {columns}) VALUES (NEW.id, {new});"
+        delete = (f"INSERT INTO {index} ({index}, rowid, {columns}) "
+                  f"VALUES ('delete', OLD.id, {old});")
+        return {
+            "archive_index_insert": f"AFTER INSERT ON archive BEGIN {insert} END",
+            "archive_index_delete": f"AFTER DELETE ON archive BEGIN {delete} END",
+            # archives are "updated" without changes when they are upserted
+            "archive_index_update":
+                f"AFTER UPDATE ON archive WHEN ({old}) IS NOT ({new}) "
+                f"BEGIN {delete} {insert} END",
+        }
+
+    @classmethod
+    def setup(cls, rebuild=False):
+        """
+        Create the index and its triggers if they don't exist, and populate it from Archive
+        when it is first created, or if `rebuild`
+        """
+        database = cls._meta.database
+        exists = cls.table_exists()
+        try:
+            cls.create_table(safe=True)
+        except OperationalError as e:
+            log.warning(f"Substring searches will not be indexed: {e}")
+            cls.enabled = False
+            return
+        create_triggers(database, cls.triggers())
+        if not exists or rebuild:
+            cls.rebuild()
+        cls.enabled = True
+
+    @classmethod
+    def contains(cls, field, substring):
+        """
+        :param field: one of the indexed Archive fields
+        :param substring: the string to search for
+        :return an expression matching the Archives whose `field` contains `substring`,
+        case-insensitively, like `field.contains(substring)`
+        """
+        # trigrams can't find substrings shorter than three characters
+        if not cls.enabled or len(substring) < 3:
+            return field.contains(substring)
+        phrase = '"{}"'.format(substring.replace('"', '""'))
+        return Archive.id.in_(
+            cls.select(cls.rowid).where(getattr(cls, field.name).match(phrase)))
+
+
+class ArchiveMismatchError(ValueError):
+    """
+    Raised for an event whose path or host differ from those of the Archive already registered
+    under its description
+    """
+
+    def __init__(self, archive, path, host):
+        super().__init__(
+            "Archive '{0}' is registered with path '{1}' on host '{2}', got path '{3}' on "
+            "host '{4}'".format(archive.description, archive.path, archive.host, path, host))
+        self.archive = archive
+
+
 class ChildModel(BaseModel):
 
     def __repr__(self):
         return "ID: {}, Archive ID: {}, Timestamp: {}".format(self.id, self.archive, self.timestamp)
 
+    @classmethod
+    def record(cls, description, path, host, timestamp):
+        """
+        Create a new event for the Archive with the unique `description`, creating the Archive
+        as well if it doesn't already exist. This takes one statement for the Archive and one for
+        the event, in a single transaction.
+
+        :return the created event, with its associated Archive already fetched
+        :raises ArchiveMismatchError if the Archive exists with another path or host
+        """
+        event = {"description": description, "path": path, "host": host}
+        with write_transaction():
+            archive = Archive.lookup([event])[description]
+            mismatch = Archive.mismatch(archive, event)
+            if mismatch:
+                raise mismatch
+            event = cls.create(archive=archive, timestamp=timestamp)
+        return event
+
+    @classmethod
+    def record_many(cls, events, chunk_size=500):
+        """
+        Create events in bulk. Archives are looked up by their unique description in a single
+        query per chunk, those that don't exist are created, and the events are inserted with
+        one statement. Each chunk is committed in its own transaction.
+
+        :param events: list of dicts with the keys description, path, host and timestamp
+        :param chunk_size: number of events to insert per transaction
+        :return the created events in the same order as `events`, with their associated
+        Archive already fetched, and an ArchiveMismatchError in place of each event whose path
+        or host differ from those of its existing Archive, which isn't created
+        """
+        created = []
+        for chunk in chunked(events, chunk_size):
+            with write_transaction():
+                archives = Archive.lookup(chunk)
+                results = [
+                    Archive.mismatch(archives[event["description"]], event) for event in chunk]
+                rows = [
+                    {"archive": archives[event["description"]], "timestamp": event["timestamp"]}
+                    for event, mismatch in zip(chunk, results) if not mismatch]
+                if rows:
+                    # the order of the rows returned by RETURNING is unspecified, but the ids
+                    # are assigned in the order of insertion
+                    ids = iter(sorted(cls.insert_many(rows).returning(cls.id).tuples().execute()))
+                    rows = iter(rows)
+                    results = [
+                        mismatch or cls(id=next(ids)[0], **next(rows)) for mismatch in results]
+                created.extend(results)
+        return created
+
 
 class Archive(BaseModel):
 
@@ -34,30 +492,793 @@ class Archive(BaseModel):
 
     description = CharField(index=True, unique=True)
     path = CharField(index=True)
-    host = CharField()
+    host = CharField(index=True)
+
+    @classmethod
+    def lookup(cls, archives):
+        """
+        Fetch the archives with the given descriptions, creating those that don't exist yet
+
+        This is a single INSERT ... ON CONFLICT (description) DO UPDATE ... RETURNING statement,
+        so there's no window between looking an archive up and creating it in which a concurrent
+        writer could create it first. Existing archives keep their path and host, the update
+        doesn't change anything and is only there to have them returned, see `mismatch` for
+        the events that don't agree with them.
+
+        :param archives: iterable of dicts with the keys description, path and host
+        :return a dict mapping each description to its Archive
+        """
+        wanted = {}
+        for archive in archives:
+            wanted.setdefault(archive["description"], {
+                "description": archive["description"],
+                "path": archive["path"],
+                "host": archive["host"]})
+        if not wanted:
+            return {}
+        query = cls.insert_many(
+            list(wanted.values())
+        ).on_conflict(
+            conflict_target=[cls.description],
+            update={cls.description: EXCLUDED.description}
+        ).returning(cls)
+        return {archive.description: archive for archive in query.execute()}
+
+    @staticmethod
+    def mismatch(archive, event):
+        """
+        :param archive: the Archive returned by `lookup` for `event`
+        :param event: a dict with the keys description, path and host
+        :return an ArchiveMismatchError if `archive` has another path or host than `event`,
+        otherwise None
+        """
+        if (archive.path, archive.host) != (event["path"], event["host"]):
+            return ArchiveMismatchError(archive, event["path"], event["host"])
+        return None
 
 
 class Upload(ChildModel):
-    archive = ForeignKeyField(Archive, related_name="uploads")
-    timestamp = DateTimeField()
+    # never reused, see ColdTier
+    id = AutoIncrementField()
+    archive = ForeignKeyField(Archive, related_name="uploads", index=False)
+    timestamp = EpochTimestampField()
 
 
 class Verification(ChildModel):
-    archive = ForeignKeyField(Archive, related_name="verifications")
-    timestamp = DateTimeField()
+    id = AutoIncrementField()
+    archive = ForeignKeyField(Archive, related_name="verifications", index=False)
+    timestamp = EpochTimestampField()
 
 
 class Removal(ChildModel):
-    archive = ForeignKeyField(Archive, related_name="removals")
-    timestamp = DateTimeField()
+    """
+    Removal of an archive from local disk. An archive can first be scheduled for removal, in
+    which case `done` is False and `timestamp_scheduled` is set, and is marked as done once it
+    has actually been removed, at `timestamp`.
+    """
+    archive = ForeignKeyField(Archive, related_name="removals", index=False)
+    timestamp = EpochTimestampField(null=True)
+    done = BooleanField(default=True)
+    timestamp_scheduled = EpochTimestampField(null=True)
+
+    @classmethod
+    def schedule(cls, description, timestamp):
+        """
+        Schedule the Archive with the unique `description` for removal, unless it already is
+
+        :return the scheduled removal, with its associated Archive already fetched
+        :raises Archive.DoesNotExist if there's no such archive
+        """
+        with write_transaction():
+            archive = Archive.get(Archive.description == description)
+            removal = cls.get_or_none(cls.archive == archive, cls.done == False)
+            if removal is None:
+                removal = cls.create(archive=archive, done=False, timestamp_scheduled=timestamp)
+        removal.archive = archive
+        return removal
+
+    @classmethod
+    def complete(cls, description, timestamp):
+        """
+        Mark the scheduled removal of the Archive with the unique `description` as done, or
+        record a removal that wasn't scheduled
 
+        :return the removal, with its associated Archive already fetched
+        :raises Archive.DoesNotExist if there's no such archive
+        """
+        with write_transaction():
+            archive = Archive.get(Archive.description == description)
+            removal = cls.get_or_none(cls.archive == archive, cls.done == False)
+            if removal is None:
+                removal = cls.create(archive=archive, timestamp=timestamp)
+            else:
+                removal.done = True
+                removal.timestamp = timestamp
+                removal.save()
+        removal.archive = archive
+        return removal
+
+
+# The events of an archive in time order, and the events within a time range together with their
+# archives, can both be read from the indexes alone
+for _event in (Upload, Verification, Removal):
+    _event.add_index(
+        _event.index(
+            _event.archive,
+            _event.timestamp,
+            name=f"{_event._meta.table_name}_archive_timestamp"))
+    _event.add_index(
+        _event.index(
+            _event.timestamp,
+            _event.archive,
+            name=f"{_event._meta.table_name}_timestamp"))
+
+
+def within(field, earliest=None, latest=None):
+    """
+    :return a list of conditions on the timestamp `field` selecting the (inclusive) window from
+    `earliest` to `latest`, either of which may be None for an open end
+    """
+    conditions = []
+    if earliest is not None:
+        conditions.append(field >= earliest)
+    if latest is not None:
+        conditions.append(field <= latest)
+    return conditions
+
+
+class TooManyTiersError(ValueError):
+    """
+    Raised for a query reaching more cold tiers than can be attached at once
+    """
+
+
+class ColdTier(BaseModel):
+    """
+    Catalogue of the cold tiers of the event history. The uploads and verifications older than
+    the tiering horizon are moved out of the database, by archive_db.models.Tiering, into a
+    database file per year, which a connection attaches (as the schema cold_<year>) the first
+    time it reads from it.
+
+    `earliest` and `latest` bound the timestamps of the events in the tier. They are extended
+    before any event is moved into it, so that a reader can tell from the catalogue alone which
+    tiers its window reaches. A relative `file` is relative to the directory of the database.
+
+    The events keep their ids in the tiers, and the ids of the event tables are AUTOINCREMENT,
+    so that an event that is in both a tier and the database, while it's being moved, is
+    recognized by its id.
+    """
+    year = IntegerField(primary_key=True)
+    file = CharField()
+    earliest = EpochTimestampField(null=True)
+    latest = EpochTimestampField(null=True)
+
+    class Meta:
+        table_name = "cold_tier"
+
+    # the event tables that are tiered
+    MODELS = (Upload, Verification)
+
+    # SQLite's default limit, for Pythons that can't tell the limit of the connection
+    MAX_ATTACHED = 10
+
+    _models = {}
+
+    @staticmethod
+    def schema(year):
+        return f"cold_{year}"
+
+    @classmethod
+    def event_model(cls, model, year):
+        """
+        :return a model of the table of `model` (Upload or Verification) in the tier of `year`,
+        with the same columns and indexes
+        """
+        key = (model, year)
+        if key not in cls._models:
+            table = model._meta.table_name
+            cold = type(f"{model.__name__}{year}", (BaseModel,), {
+                "archive": IntegerField(column_name="archive_id"),
+                "timestamp": EpochTimestampField(),
+                "Meta": type("Meta", (), {"table_name": table, "schema": cls.schema(year)})})
+            cold.add_index(cold.index(
+                cold.archive, cold.timestamp, name=f"{table}_archive_timestamp"))
+            cold.add_index(cold.index(cold.timestamp, cold.archive, name=f"{table}_timestamp"))
+            cls._models.setdefault(key, cold)
+        return cls._models[key]
+
+    @classmethod
+    def max_id(cls, tier, model):
+        """
+        :return the largest id of the events of `model` in `tier`, read without attaching it,
+        or 0 if there are none
+        """
+        directory = os.path.dirname(os.path.abspath(cls._meta.database.database))
+        path = os.path.join(directory, tier.file)
+        if not os.path.exists(path):
+            return 0
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            latest, = connection.execute(
+                f'SELECT MAX(id) FROM "{model._meta.table_name}"').fetchone()
+        except sqlite3.OperationalError:
+            # the tier was created, but not its tables
+            latest = None
+        finally:
+            connection.close()
+        return latest or 0
+
+    @classmethod
+    def lock_path(cls, db_path=None):
+        """
+        :return the lock file of the tiers of the database `db_path`, that of the current
+        database by default, or None for an in-memory database, which has no tiers
+        """
+        db_path = db_path or cls._meta.database.database
+        return None if db_path == ":memory:" else db_path + "-tiering.lock"
+
+    @classmethod
+    @contextlib.contextmanager
+    def held(cls, db_path=None):
+        """
+        Keep the events of the database `db_path`, the current one by default, where they are,
+        in their table or in a tier, for the duration. A tiering run takes the lock file
+        exclusively, so this waits for a run in progress to finish, and runs can't start until
+        it's done.
+        """
+        path = cls.lock_path(db_path)
+        if path is None:
+            yield
+            return
+        with open(path, "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+            yield
+
+    @classmethod
+    def reaching(cls, earliest=None, latest=None):
+        """
+        :return the tiers holding events within the (inclusive) window from `earliest` to
+        `latest`, either of which may be None for an open end, in order of year
+        """
+        return list(cls.select().where(
+            cls.earliest.is_null(False),
+            *([cls.latest >= earliest] if earliest is not None else []),
+            *([cls.earliest <= latest] if latest is not None else [])
+        ).order_by(cls.year))
+
+    @classmethod
+    def attach(cls, tiers):
+        """
+        Attach the database files of the `tiers` to the connection of the current thread, unless
+        they already are. Tiers attached for earlier queries are detached, if need be, to stay
+        within SQLite's limit on the number of attached databases.
+
+        :raises TooManyTiersError if there are more `tiers` than can be attached at once
+        """
+        database = cls._meta.database
+        attached = [name for _, name, _ in database.execute_sql("PRAGMA database_list")]
+        missing = [tier for tier in tiers if cls.schema(tier.year) not in attached]
+        if not missing:
+            return
+        connection = database.connection()
+        limit = connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) \
+            if hasattr(connection, "getlimit") else cls.MAX_ATTACHED
+        if len(tiers) > limit:
+            raise TooManyTiersError(
+                f"The query reaches {len(tiers)} cold tiers, more than the {limit} that can be "
+                f"attached at once, narrow its date range")
+        wanted = {cls.schema(tier.year) for tier in tiers}
+        spare = [name for name in attached if name.startswith("cold_") and name not in wanted]
+        excess = len([name for name in attached if name not in ("main", "temp")]) + \
+            len(missing) - limit
+        for name in spare[:max(0, excess)]:
+            try:
+                database.execute_sql(f'DETACH DATABASE "{name}"')
+            except OperationalError:
+                # still in use by the current transaction
+                pass
+        directory = os.path.dirname(os.path.abspath(database.database))
+        for tier in missing:
+            database.execute_sql(
+                "ATTACH DATABASE ? AS ?",
+                (os.path.join(directory, tier.file), cls.schema(tier.year)))
+
+
+class EventHistory(Source):
+    """
+    The events of `model` from the (inclusive) time `earliest` to `latest`, either of which may
+    be None for an open end, read from its table and from the cold tiers the window reaches, as
+    rows of id, archive_id and timestamp. It is selected from like a subquery, e.g.
+    `Archive.id.in_(history.select(history.c.archive_id))`.
+
+    The tiers are looked up, and attached, by the thread executing the query, each time it is
+    executed. A window without any bound stays within the table, unless `cold` is True, and
+    with `cold` False the tiers are left out whatever the window. A window reaching more tiers
+    than can be attached at once fails, see ColdHistory and archive_db.export for the readers
+    of the full history.
+    """
+
+    def __init__(self, model, earliest=None, latest=None, cold=None):
+        super().__init__(alias=f"{model._meta.table_name}_history")
+        self.model = model
+        self.earliest = earliest
+        self.latest = latest
+        self.cold = cold
+
+    def tiers(self):
+        """
+        :return the cold tiers to read the events from
+        """
+        if self.model not in ColdTier.MODELS or self.cold is False or \
+                (self.cold is None and self.earliest is None and self.latest is None):
+            return []
+        return ColdTier.reaching(self.earliest, self.latest)
+
+    def query(self):
+        tiers = self.tiers()
+        ColdTier.attach(tiers)
+        queries = []
+        for model in [self.model] + [
+                ColdTier.event_model(self.model, tier.year) for tier in tiers]:
+            query = model.select(model.id, model.archive, model.timestamp)
+            conditions = within(model.timestamp, self.earliest, self.latest)
+            queries.append(query.where(*conditions) if conditions else query)
+        return functools.reduce(operator.add, queries)
+
+    def __sql__(self, ctx):
+        if ctx.scope == SCOPE_COLUMN:
+            return self.apply_column(ctx)
+        query = self.query()
+        if ctx.scope == SCOPE_SOURCE:
+            query = query.alias(self._alias)
+        return ctx.sql(query)
+
+
+
+class ColdHistory(BaseModel):
+    """
+    The time of the latest event, and the number of events, of each archive in each cold tier,
+    by type of event, collected into a temporary table of the connection by `collect`. The
+    readers of the full history aggregate it from here rather than from the tiers themselves,
+    since only so many tiers can be attached at once.
+    """
+    archive = IntegerField(column_name="archive_id")
+    event = CharField()
+    latest = EpochTimestampField()
+    count = IntegerField()
+
+    class Meta:
+        table_name = "cold_history"
+        primary_key = False
+
+    @classmethod
+    def collect(cls):
+        """
+        (Re)create the table from the tiers, attaching them one at a time. The events that are
+        still in their table, while they are being moved, are left out.
+
+        Call it within ColdTier.held(), so that no events are moved until the table has been
+        read, and outside of a transaction, so that the tiers can be detached in turn.
+        """
+        cls.drop_table(safe=True)
+        cls.create_table(temporary=True)
+        if not ColdTier.table_exists():
+            # a database being migrated from before tiering
+            return
+        # read up front, since a pending statement would keep the tiers from being detached
+        for tier in list(ColdTier.select().order_by(ColdTier.year)):
+            ColdTier.attach([tier])
+            with cls._meta.database.atomic():
+                for model in ColdTier.MODELS:
+                    cold = ColdTier.event_model(model, tier.year)
+                    cls.insert_from(
+                        cold.select(
+                            cold.archive,
+                            Value(model._meta.table_name),
+                            fn.MAX(cold.timestamp),
+                            fn.COUNT(cold.id)
+                        ).where(
+                            ~fn.EXISTS(model.select().where(model.id == cold.id))
+                        ).group_by(cold.archive),
+                        [cls.archive, cls.event, cls.latest, cls.count]).execute()
+
+
+ColdHistory.add_index(ColdHistory.index(
+    ColdHistory.archive, ColdHistory.event, name="cold_history_archive"))
+
+class ArchiveState(BaseModel):
     """
-    To let archive-remove better support archives staged/marked/scheduled for removal I envision that
-    one could modify this to something like the following instead: 
+    Denormalized summary of the event history of each Archive, so that reads don't have to
+    aggregate the Upload, Verification and Removal tables.
 
-        archive = ForeignKeyField(Archive, related_name="removals")
-        done = BooleanField(default=False)      # False = archive has been scheduled for removal; True = archive has been removed.
-        timestamp_scheduled = DateTimeField()   # Or one can just let the queries look to see which timestamp has been filled with a value.
-        timestamp_done = DateTimeField()
+    The table is maintained by triggers on the Archive and event tables, which means that it is
+    updated in the same transaction as the event that changed it, whichever way the event was
+    written. Use `ArchiveState.check()` and `ArchiveState.rebuild()` to verify or recreate it
+    from the history.
     """
 
+    archive = ForeignKeyField(Archive, primary_key=True, backref="state", on_delete="CASCADE")
+    # copied from Archive, so that listings can be ordered by an index on this table alone
+    path = CharField()
+    last_uploaded = EpochTimestampField(null=True)
+    last_verified = EpochTimestampField(null=True)
+    last_removed = EpochTimestampField(null=True)
+    upload_count = IntegerField(default=0)
+    verification_count = IntegerField(default=0)
+    removal_count = IntegerField(default=0)
+    # when the archive was scheduled for removal, if the removal isn't done yet
+    removal_scheduled = EpochTimestampField(null=True)
+
+    class Meta:
+        table_name = "archive_state"
+
+    # event model -> (timestamp column, count column)
+    EVENT_COLUMNS = {
+        Upload: ("last_uploaded", "upload_count"),
+        Verification: ("last_verified", "verification_count"),
+        Removal: ("last_removed", "removal_count"),
+    }
+
+    @classmethod
+    def triggers(cls):
+        """
+        :return a dict with the name and body of each trigger maintaining the table
+        """
+        state = cls._meta.table_name
+        archive = Archive._meta.table_name
+        triggers = {
+            "archive_state_archive_insert":
+                f"AFTER INSERT ON {archive} BEGIN "
+                f"INSERT OR IGNORE INTO {state} "
+                f"(archive_id, path, upload_count, verification_count, removal_count) "
+                f"VALUES (NEW.id, NEW.path, 0, 0, 0); END",
+            "archive_state_archive_update":
+                f"AFTER UPDATE OF path ON {archive} BEGIN "
+                f"UPDATE {state} SET path = NEW.path WHERE archive_id = NEW.id; END",
+        }
+        for model, (last, count) in cls.EVENT_COLUMNS.items():
+            counts = ", ".join(
+                "1" if other == count else "0"
+                for _, other in cls.EVENT_COLUMNS.values())
+            upsert = (
+                f"INSERT INTO {state} "
+                f"(archive_id, path, {last}, upload_count, verification_count, removal_count) "
+                f"VALUES (NEW.archive_id, "
+                f"(SELECT path FROM {archive} WHERE id = NEW.archive_id), "
+                f"NEW.timestamp, {counts}) "
+                f"ON CONFLICT (archive_id) DO UPDATE SET "
+                f"{last} = CASE WHEN {last} IS NULL OR excluded.{last} > {last} "
+                f"THEN excluded.{last} ELSE {last} END, "
+                f"{count} = {count} + 1;")
+            if model is not Removal:
+                triggers[f"archive_state_{model._meta.table_name}_insert"] = (
+                    f"AFTER INSERT ON {model._meta.table_name} BEGIN {upsert} END")
+                continue
+            # removals only count once they are done, which is either when they are recorded
+            # or when a scheduled removal is marked as done
+            removal = model._meta.table_name
+            scheduled = (
+                f"UPDATE {state} SET removal_scheduled = ("
+                f"SELECT MAX(timestamp_scheduled) FROM {removal} "
+                f"WHERE archive_id = NEW.archive_id AND NOT done) "
+                f"WHERE archive_id = NEW.archive_id;")
+            triggers[f"archive_state_{removal}_insert"] = (
+                f"AFTER INSERT ON {removal} WHEN NEW.done BEGIN {upsert} END")
+            triggers[f"archive_state_{removal}_done"] = (
+                f"AFTER UPDATE OF done ON {removal} WHEN NEW.done AND NOT OLD.done "
+                f"BEGIN {upsert} {scheduled} END")
+            triggers[f"archive_state_{removal}_scheduled"] = (
+                f"AFTER INSERT ON {removal} WHEN NOT NEW.done BEGIN {scheduled} END")
+        return triggers
+
+    @classmethod
+    def select_removable(cls, *columns):
+        """
+        :return a query selecting `columns` of the archives that have been verified but not
+        removed, which is served by the partial archive_state_removable index. Without
+        statistics SQLite prefers the archive_state_listing index, so the index is named.
+        """
+        return cls.select(
+            *columns
+        ).from_(
+            NodeList((cls, SQL("INDEXED BY archive_state_removable")))
+        ).where(
+            # written out with literal NULLs, so that SQLite can tell that it matches the
+            # condition of the index
+            NodeList((cls.last_verified, SQL("IS NOT NULL"))),
+            NodeList((cls.last_removed, SQL("IS NULL"))))
+
+    @staticmethod
+    def _history(model):
+        """
+        :return the queries for the time of the latest event of `model` of the current
+        Archive, and for the number of its events, in its table and, if it's tiered, in the
+        cold tiers, as collected by ColdHistory.collect()
+        """
+        history = model.select().where(model.archive == Archive.id)
+        if model is Removal:
+            history = history.where(Removal.done == True)
+        queries = [(history.select(fn.MAX(model.timestamp)), history.select(fn.COUNT(model.id)))]
+        if model in ColdTier.MODELS:
+            cold = ColdHistory.select().where(
+                ColdHistory.archive == Archive.id,
+                ColdHistory.event == model._meta.table_name)
+            queries.append((
+                cold.select(fn.MAX(ColdHistory.latest)),
+                cold.select(fn.IFNULL(fn.SUM(ColdHistory.count), 0))))
+        return queries
+
+    # sorts before any timestamp, standing in for the latest event of an archive that has none
+    NO_TIMESTAMP = -2 ** 63
+
+    @classmethod
+    def _latest(cls, queries):
+        """
+        :return the time of the latest of the events of the `queries` of `_history`
+        """
+        latest = [query for query, _ in queries]
+        if len(latest) == 1:
+            return latest[0]
+        # the MAX of several values is NULL if any of them is
+        return fn.NULLIF(
+            fn.MAX(*[fn.IFNULL(query, cls.NO_TIMESTAMP) for query in latest]),
+            cls.NO_TIMESTAMP)
+
+    @staticmethod
+    def _count(queries):
+        """
+        :return the number of the events of the `queries` of `_history`
+        """
+        return functools.reduce(
+            lambda total, count: Expression(total, OP.ADD, count),
+            [query for _, query in queries])
+
+    @classmethod
+    def from_history(cls):
+        """
+        :return a query computing the state of every Archive from its full event history,
+        with the same columns as the table. The history in the cold tiers is read from
+        ColdHistory, which must have been collected on the connection of the current thread.
+        """
+        columns = [Archive.id.alias("archive_id"), Archive.path]
+        for model, (last, count) in cls.EVENT_COLUMNS.items():
+            history = cls._history(model)
+            columns.extend([
+                cls._latest(history).alias(last),
+                cls._count(history).alias(count)])
+        columns.append(
+            Removal.select(
+                fn.MAX(Removal.timestamp_scheduled)
+            ).where(
+                Removal.archive == Archive.id,
+                Removal.done == False
+            ).alias("removal_scheduled"))
+        return Archive.select(*columns)
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recreate the table from the event history
+        """
+        fields = [cls.archive, cls.path]
+        for last, count in cls.EVENT_COLUMNS.values():
+            fields.extend([getattr(cls, last), getattr(cls, count)])
+        fields.append(cls.removal_scheduled)
+        with ColdTier.held():
+            ColdHistory.collect()
+            with write_transaction():
+                cls.delete().execute()
+                cls.insert_from(cls.from_history(), fields).execute()
+
+    @classmethod
+    def check(cls):
+        """
+        Compare the table with the state derived from the event history
+
+        :return a list with the ids of the archives whose state is missing, orphaned or
+        differs from their history
+        """
+        history = cls.from_history().alias("history")
+        mismatch = cls.archive.is_null() | (cls.path != history.c.path)
+        for last, count in cls.EVENT_COLUMNS.values():
+            for column in (last, count):
+                mismatch |= ~(getattr(cls, column) >> getattr(history.c, column))
+        mismatch |= ~(cls.removal_scheduled >> history.c.removal_scheduled)
+        with ColdTier.held():
+            ColdHistory.collect()
+            inconsistent = [
+                row[0] for row in
+                Select(
+                    from_list=[history],
+                    columns=[history.c.archive_id]
+                ).join(
+                    cls, JOIN.LEFT_OUTER, on=(cls.archive == history.c.archive_id)
+                ).where(
+                    mismatch
+                ).bind(cls._meta.database).tuples()]
+        orphaned = cls.select(
+            cls.archive
+        ).join(
+            Archive, JOIN.LEFT_OUTER, on=(cls.archive == Archive.id)
+        ).where(
+            Archive.id.is_null()
+        ).tuples()
+        return inconsistent + [row[0] for row in orphaned]
+
+
+ArchiveState.add_index(
+    ArchiveState.index(
+        ArchiveState.last_removed.desc(),
+        ArchiveState.last_verified.desc(),
+        ArchiveState.last_uploaded.desc(),
+        ArchiveState.path,
+        ArchiveState.archive,
+        name="archive_state_listing"))
+
+# the archives that have been verified but not removed, in the order they're listed by
+# GET /removal, with all the columns of the listing, see ArchiveState.select_removable
+ArchiveState.add_index(
+    ArchiveState.index(
+        ArchiveState.archive,
+        ArchiveState.path,
+        ArchiveState.last_uploaded,
+        ArchiveState.last_verified,
+        ArchiveState.removal_scheduled,
+        ArchiveState.last_removed,
+        name="archive_state_removable"
+    ).where(
+        # SQLite doesn't allow parameters here
+        SQL("last_verified IS NOT NULL AND last_removed IS NULL")))
+
+
+class VerificationLease(BaseModel):
+    """
+    Reservation of an archive by a verifier, so that parallel verifiers don't plan to verify the
+    same archive. A lease ends when it expires or when the archive is verified.
+    """
+    archive = ForeignKeyField(Archive, primary_key=True, backref="lease", on_delete="CASCADE")
+    token = CharField(index=True)
+    expires = EpochTimestampField()
+
+    class Meta:
+        table_name = "verification_lease"
+
+    @classmethod
+    def triggers(cls):
+        lease = cls._meta.table_name
+        verification = Verification._meta.table_name
+        return {
+            "verification_lease_release":
+                f"AFTER INSERT ON {verification} BEGIN "
+                f"DELETE FROM {lease} WHERE archive_id = NEW.archive_id; END",
+        }
+
+    @classmethod
+    def active(cls, now):
+        """
+        :return an expression matching the Archives that hold a lease which hasn't expired at `now`
+        """
+        return fn.EXISTS(
+            cls.select(
+                cls.archive
+            ).where(
+                cls.archive == Archive.id,
+                cls.expires > now))
+
+    @classmethod
+    def reserve(cls, archive_ids, token, now, expires):
+        """
+        Lease the archives until `expires`, dropping the leases that have expired at `now`
+        """
+        with write_transaction():
+            cls.delete().where(cls.expires <= now).execute()
+            cls.insert_many(
+                [{"archive": archive_id, "token": token, "expires": expires}
+                 for archive_id in archive_ids]
+            ).on_conflict_replace().execute()
+
+
+class Change(BaseModel):
+    """
+    Append-only feed of the events, in the order they were committed. The rows are appended by
+    triggers on the event tables, so that every write is recorded however it is made, and
+    `seq` is never reused, so that a consumer can read the changes following the last one it
+    has seen.
+    """
+    seq = AutoIncrementField()
+    event = CharField()
+    archive = ForeignKeyField(Archive, backref="changes", index=False, on_delete="CASCADE")
+    timestamp = EpochTimestampField(null=True)
+
+    # the writes recorded as each event, as the model and operation, the condition on the row
+    # written, and the column holding the time of the event
+    EVENTS = {
+        "upload": (Upload, "INSERT", None, "timestamp"),
+        "verification": (Verification, "INSERT", None, "timestamp"),
+        "removal_scheduled": (Removal, "INSERT", "NOT NEW.done", "timestamp_scheduled"),
+        "removal": (Removal, "INSERT", "NEW.done", "timestamp"),
+        "removal_done": (Removal, "UPDATE OF done", "NEW.done AND NOT OLD.done", "timestamp"),
+    }
+
+    class Meta:
+        table_name = "change_feed"
+
+    @classmethod
+    def triggers(cls):
+        feed = cls._meta.table_name
+        triggers = {}
+        for event, (model, operation, condition, timestamp) in cls.EVENTS.items():
+            when = f"WHEN {condition} " if condition else ""
+            # a scheduled removal is recorded as a removal once it's done
+            name = "removal" if event == "removal_done" else event
+            triggers[f"change_feed_{event}"] = (
+                f"AFTER {operation} ON {model._meta.table_name} {when}BEGIN "
+                f"INSERT INTO {feed} (event, archive_id, timestamp) "
+                f"VALUES ('{name}', NEW.archive_id, NEW.{timestamp}); END")
+        return triggers
+
+    @classmethod
+    def since(cls, seq, limit):
+        """
+        :return the first `limit` changes following `seq`, as dicts with the sequence number,
+        event and timestamp of each change and the description, path and host of its archive
+        """
+        return list(cls.select(
+            cls.seq,
+            cls.event,
+            cls.timestamp,
+            Archive.description,
+            Archive.path,
+            Archive.host
+        ).join(
+            Archive, on=(cls.archive == Archive.id)
+        ).where(
+            cls.seq > seq
+        ).order_by(
+            cls.seq
+        ).limit(limit).dicts())
+
+    @classmethod
+    def last(cls):
+        """
+        :return the sequence number of the latest change, or 0 if there are none
+        """
+        return cls.select(fn.MAX(cls.seq)).scalar() or 0
+
+
+class ImportCheckpoint(BaseModel):
+    """
+    Progress of a bulk import of an input, as the number of its records that have been
+    committed, so that an interrupted import can be resumed. The input is identified by its
+    name followed by # and a digest of its first record, see archive_db.importer.
+    """
+    source = CharField(primary_key=True)
+    position = BigIntegerField(default=0)
+    done = BooleanField(default=False)
+
+    class Meta:
+        table_name = "import_checkpoint"
+
+
+def record_events(events):
+    """
+    Write events of possibly different types in a single transaction
+
+    :param events: list of (model, event) tuples, where model is a ChildModel subclass and event
+    a dict as accepted by `ChildModel.record_many`
+    :return the created events, in the same order as `events`, with an ArchiveMismatchError in
+    place of each event rejected by `ChildModel.record_many`
+    """
+    by_model = {}
+    for i, (model, event) in enumerate(events):
+        by_model.setdefault(model, []).append((i, event))
+    created = [None] * len(events)
+    with write_transaction():
+        for model, indexed in by_model.items():
+            results = model.record_many([event for _, event in indexed], chunk_size=len(indexed))
+            for (i, _), result in zip(indexed, results):
+                created[i] = result
+    return created
+
+
+group_commit = GroupCommitWriter(db_executor, record_events)
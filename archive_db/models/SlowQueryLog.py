@@ -0,0 +1,216 @@
+import logging
+import random
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# lists of parameters, e.g. of IN (?, ?, ?), are folded so that they don't make new shapes
+_PARAMETER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+class SlowQueryLog:
+    """
+    Logs the SQL statements that take longer than a threshold, along with their parameters,
+    duration, number of rows and, sampled, their query plan. The slowest statements are also
+    aggregated by shape, i.e. by their SQL text, which peewee keeps free of literal values.
+
+    The duration of a statement returning rows includes fetching them, but not the time the
+    caller spends between fetches.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, threshold_ms=None, explain_interval=60, explain_rate=1.0,
+                  max_shapes=1000):
+        """
+        :param threshold_ms: log statements taking longer than this many milliseconds, or
+        nothing if None
+        :param explain_interval: capture the query plan of a shape at most once per this many
+        seconds
+        :param explain_rate: the fraction of the slow statements, outside the interval, whose
+        query plan is captured
+        :param max_shapes: the number of shapes to keep, dropping the fastest ones
+        """
+        self.threshold = None if threshold_ms is None else float(threshold_ms) / 1000
+        self.explain_interval = float(explain_interval)
+        self.explain_rate = float(explain_rate)
+        self.max_shapes = max(1, int(max_shapes))
+        self._lock = threading.Lock()
+        self._shapes = {}
+
+    @property
+    def enabled(self):
+        return self.threshold is not None
+
+    @staticmethod
+    def shape(sql):
+        return _PARAMETER_LIST.sub("?, ...", sql)
+
+    def track(self, db, cursor, sql, params, duration):
+        """
+        Track the statement `sql`, which `cursor` has begun executing in `duration` seconds
+
+        :return the cursor to hand over to the caller
+        """
+        if cursor.description is None:
+            # the statement doesn't return any rows, so it has run to completion
+            self.observe(db, sql, params, duration, max(cursor.rowcount, 0))
+            return cursor
+        return _TrackedCursor(self, db, cursor, sql, params, duration)
+
+    def observe(self, db, sql, params, duration, rows, explain=True):
+        """
+        :param explain: if False, the query plan isn't captured, e.g. when the statement is
+        observed during garbage collection, possibly on another thread than the one owning the
+        connection
+        """
+        if self.threshold is None or duration < self.threshold:
+            return
+        shape = self.shape(sql)
+        now = time.monotonic()
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                if len(self._shapes) >= self.max_shapes:
+                    del self._shapes[min(self._shapes, key=lambda s: self._shapes[s]["max"])]
+                stats = self._shapes[shape] = {
+                    "count": 0, "total": 0.0, "max": 0.0, "explained": None, "plan": None}
+            explain = (
+                explain
+                and sql.lstrip().upper().startswith(_EXPLAINABLE)
+                and (stats["explained"] is None
+                     or now - stats["explained"] >= self.explain_interval)
+                and random.random() < self.explain_rate)
+            if explain:
+                stats["explained"] = now
+            stats["count"] += 1
+            stats["total"] += duration
+            if duration >= stats["max"]:
+                stats.update(max=duration, params=_truncate(params), rows=rows)
+
+        plan = self._explain(db, sql, params) if explain else None
+        if plan is not None:
+            with self._lock:
+                stats["plan"] = plan
+        log.warning(
+            "Slow query (%.1f ms, %d rows): %s; params: %s%s",
+            duration * 1000, rows, sql, _truncate(params),
+            "".join("\n  " + line for line in plan) if plan else "")
+
+    @staticmethod
+    def _explain(db, sql, params):
+        """
+        :return the query plan of `sql` as indented lines, or None if it couldn't be explained
+        """
+        try:
+            # a raw cursor, so that the EXPLAIN isn't tracked itself
+            rows = db.cursor().execute("EXPLAIN QUERY PLAN " + sql, params or ()).fetchall()
+        except Exception as e:
+            log.debug("Could not explain %s: %s", sql, e)
+            return None
+        depth = {0: -1}
+        lines = []
+        for node, parent, _, detail in rows:
+            depth[node] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[node] + detail)
+        return lines
+
+    def top(self, count=10):
+        """
+        :return the `count` slowest shapes, by the duration of their slowest statement
+        """
+        with self._lock:
+            shapes = sorted(self._shapes.items(), key=lambda item: -item[1]["max"])[:count]
+            return [{
+                "shape": shape,
+                "count": stats["count"],
+                "total_ms": round(stats["total"] * 1000, 3),
+                "mean_ms": round(stats["total"] * 1000 / stats["count"], 3),
+                "max_ms": round(stats["max"] * 1000, 3),
+                "max_rows": stats["rows"],
+                "max_params": stats["params"],
+                "plan": stats["plan"]} for shape, stats in shapes]
+
+    def clear(self):
+        with self._lock:
+            self._shapes = {}
+
+
+def _truncate(params, length=1000):
+    text = repr(tuple(params or ()))
+    return text if len(text) <= length else text[:length] + "..."
+
+
+class _TrackedCursor:
+    """
+    Wraps a cursor returning rows, counting them and the time spent fetching them, and hands
+    the statement to the log once all rows have been fetched or the cursor is closed
+    """
+
+    def __init__(self, slow_query_log, db, cursor, sql, params, duration):
+        self._log = slow_query_log
+        self._db = db
+        self._cursor = cursor
+        self._sql = sql
+        self._params = params
+        self._duration = duration
+        self._rows = 0
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _finish(self, explain=True):
+        if not self._done:
+            self._done = True
+            self._log.observe(
+                self._db, self._sql, self._params, self._duration, self._rows, explain)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._duration += time.perf_counter() - start
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(self._cursor.arraysize if size is None else size)
+        self._duration += time.perf_counter() - start
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._duration += time.perf_counter() - start
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    def __del__(self):
+        # e.g. peewee's scalar() only fetches the first row. Only its timing is recorded, no SQL
+        # is run from the garbage collector.
+        try:
+            self._finish(explain=False)
+        except Exception:
+            pass
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,168 @@
+import datetime as dt
+import fcntl
+import logging
+import os
+import time
+
+from archive_db.models.Model import ColdTier, db_proxy, write_transaction
+
+log = logging.getLogger(__name__)
+
+
+class TieringError(Exception):
+    pass
+
+
+class Tiering:
+    """
+    Moves the uploads and verifications older than a horizon out of the database, into a cold
+    tier per year (see ColdTier), so that the tables and indexes read by the service keep to the
+    recent history. The queries whose upload window reaches back past the horizon read the
+    tiers as well.
+
+    The events are moved while the service is running, oldest first, a batch at a time. Each
+    batch is first copied to its tier, in a transaction of the tier alone, and then deleted from
+    the database in a write transaction of its own, so that the writes of the service wait for
+    one batch at most. An interrupted run leaves at worst events that are in both, which the
+    readers tolerate and the next run deletes. Runs are taken one at a time, also across
+    processes, and not while the full history is read tier by tier.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, db_path=None, horizon_days=None, directory=None, batch_size=5000,
+                  sleep=0.05):
+        """
+        :param db_path: the database to move the events out of
+        :param horizon_days: the age in days of the events to move, or None to disable tiering
+        :param directory: the directory of the tiers, that of the database by default
+        :param batch_size: the number of events moved per transaction
+        :param sleep: the number of seconds to sleep between batches
+        """
+        self.db_path = db_path
+        self.horizon_days = horizon_days
+        self.directory = directory
+        self.batch_size = max(1, int(batch_size))
+        self.sleep = max(0.0, float(sleep))
+        self.last = None
+
+    @property
+    def enabled(self):
+        return bool(self.db_path and self.db_path != ":memory:" and self.horizon_days)
+
+    def tier_file(self, year):
+        """
+        :return the file of the tier of `year`, as stored in the catalogue, i.e. relative to
+        the directory of the database unless the tiers are kept elsewhere
+        """
+        stem = os.path.splitext(os.path.basename(self.db_path))[0]
+        name = f"{stem}-cold-{year}.db"
+        return os.path.join(os.path.abspath(self.directory), name) if self.directory else name
+
+    def run(self, now=None):
+        """
+        Move the events older than the horizon to the cold tiers
+
+        :param now: the time the horizon is counted back from, utcnow() by default
+        :return a dict with the number of uploads and verifications moved, the years of the
+        tiers they were moved to, and the duration of the run
+        :raises TieringError if tiering isn't configured, or another run or a reader holding
+        the events in place (see ColdTier.held) is in progress
+        """
+        if not self.enabled:
+            raise TieringError("Tiering is not configured, see tiering_horizon_days")
+        horizon = (now or dt.datetime.utcnow()) - dt.timedelta(days=float(self.horizon_days))
+        with open(ColdTier.lock_path(self.db_path), "a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise TieringError(
+                    "Another tiering run, or a reader of the full history, is in progress")
+            started = time.perf_counter()
+            info = {"horizon": horizon.isoformat(), "years": set()}
+            for model in ColdTier.MODELS:
+                info[model._meta.table_name] = self._move(model, horizon, info["years"])
+        info["years"] = sorted(info["years"])
+        info["seconds"] = round(time.perf_counter() - started, 3)
+        self.last = info
+        log.info(
+            "Moved %s to the cold tiers of %s in %.1fs", ", ".join(
+                f"{info[model._meta.table_name]} {model._meta.table_name}(s)"
+                for model in ColdTier.MODELS),
+            info["years"] or "no year", info["seconds"])
+        return info
+
+    def scheduled(self):
+        """
+        Move the events older than the horizon, logging rather than raising any failure
+
+        :return the number of events moved
+        """
+        try:
+            info = self.run()
+        except Exception:
+            log.exception("Scheduled tiering of %s failed", self.db_path)
+            return 0
+        return sum(info[model._meta.table_name] for model in ColdTier.MODELS)
+
+    def _tier(self, year, earliest, latest):
+        """
+        Create the tier of `year` if need be, attach it, and extend its bounds to the window
+        from `earliest` to `latest`, before any event within it is moved there
+        """
+        tier = ColdTier.get_or_none(ColdTier.year == year)
+        if tier is None:
+            tier = ColdTier(year=year, file=self.tier_file(year))
+            ColdTier.attach([tier])
+            # readers of a tier in WAL mode aren't held up while events are moved into it
+            if db_proxy.journal_mode == "wal":
+                db_proxy.execute_sql(f'PRAGMA "{ColdTier.schema(year)}".journal_mode = wal')
+            for model in ColdTier.MODELS:
+                ColdTier.event_model(model, year).create_table(safe=True)
+        else:
+            ColdTier.attach([tier])
+        if tier.earliest is not None and tier.earliest <= earliest and tier.latest >= latest:
+            return
+        with write_transaction():
+            ColdTier.insert(
+                year=year,
+                file=tier.file,
+                earliest=min(earliest, tier.earliest or earliest),
+                latest=max(latest, tier.latest or latest)
+            ).on_conflict_replace().execute()
+
+    def _move(self, model, horizon, years):
+        moved = 0
+        while True:
+            rows = list(model.select(
+                model.id,
+                model.archive,
+                model.timestamp
+            ).where(
+                model.timestamp < horizon
+            ).order_by(
+                model.timestamp
+            ).limit(self.batch_size).tuples())
+            if not rows:
+                return moved
+            by_year = {}
+            for row in rows:
+                by_year.setdefault(row[2].year, []).append(row)
+            for year, events in by_year.items():
+                self._tier(year, events[0][2], events[-1][2])
+                cold = ColdTier.event_model(model, year)
+                # the copy is committed before the events are deleted from the database
+                with db_proxy.atomic():
+                    cold.insert_many(
+                        events, fields=[cold.id, cold.archive, cold.timestamp]
+                    ).on_conflict_ignore().execute()
+                years.add(year)
+            with write_transaction():
+                model.delete().where(model.id.in_([row[0] for row in rows])).execute()
+            moved += len(rows)
+            if self.sleep:
+                time.sleep(self.sleep)
+
+
+tiering = Tiering()
@@ -0,0 +1,76 @@
+import fcntl
+import os
+import threading
+import time
+
+from archive_db import metrics
+
+
+class WriterLock:
+    """
+    Serializes the write transactions of the worker processes sharing a database.
+
+    SQLite lets a writer that finds the database locked retry with sleeps of growing length,
+    up to busy_timeout, so under contention between processes the lock often sits free while
+    the waiting writers sleep, and throughput collapses. Instead, each write transaction first
+    takes an exclusive flock on a lock file next to the database. The kernel queues the waiting
+    processes and wakes the next one as soon as the lock is released, so the writes go one
+    after another, and the transaction begins without ever finding the database locked.
+
+    The lock is reentrant within a thread, since write transactions nest as savepoints, and the
+    lock file is reopened in every process, since a lock taken through a descriptor inherited
+    across fork would be shared with the parent.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, path=None):
+        """
+        :param path: the lock file, or None to leave the writes to SQLite's own locking
+        """
+        self.path = path
+        self._pid = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _descriptor(self):
+        if self._pid != os.getpid():
+            self._file = open(self.path, "a")
+            self._pid = os.getpid()
+        return self._file.fileno()
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        depth = getattr(self._local, "depth", 0)
+        if not depth:
+            started = time.perf_counter()
+            # the flock is held by the process, so the threads of a process queue on a lock first
+            self._lock.acquire()
+            try:
+                fcntl.flock(self._descriptor(), fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+            waited = time.perf_counter() - started
+            metrics.db_writer_lock_wait.observe(waited, metrics.current_route.get())
+            metrics.lock_wait_peak.observe(waited)
+        self._local.depth = depth + 1
+        return self
+
+    def __exit__(self, *exc):
+        if not self.enabled:
+            return
+        self._local.depth -= 1
+        if not self._local.depth:
+            fcntl.flock(self._descriptor(), fcntl.LOCK_UN)
+            self._lock.release()
+
+
+writer_lock = WriterLock()
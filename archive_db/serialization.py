@@ -0,0 +1,67 @@
+"""
+JSON serialization of the responses, with orjson when it's installed (`pip install
+archive-db[speedups]`), and with the standard library otherwise.
+
+Timestamps are serialized by the library rather than converted to strings beforehand. By
+default they are written as `str` writes them, e.g. "2023-06-01 12:00:00.500000", as the
+service always has. With `timestamps="iso"` they are written in ISO 8601 (RFC 3339) form
+instead, e.g. "2023-06-01T12:00:00.500000", which orjson encodes natively, without calling back
+into Python for every timestamp.
+"""
+import datetime as dt
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LIBRARIES = ("orjson", "json")
+TIMESTAMPS = ("str", "iso")
+
+
+def _iso(value):
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class JsonSerializer:
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, library=None, timestamps="str"):
+        """
+        :param library: "orjson" or "json", or None for orjson if it's installed
+        :param timestamps: "str" or "iso", see above
+        :raises ValueError if the library isn't installed, or the options are unknown
+        """
+        if library is None:
+            library = "orjson" if orjson is not None else "json"
+        if library not in LIBRARIES:
+            raise ValueError("Expecting the JSON library to be one of {0}, got {1!r}".format(
+                ", ".join(LIBRARIES), library))
+        if library == "orjson" and orjson is None:
+            raise ValueError("The JSON library orjson is not installed")
+        if timestamps not in TIMESTAMPS:
+            raise ValueError("Expecting timestamps to be one of {0}, got {1!r}".format(
+                ", ".join(TIMESTAMPS), timestamps))
+        self.library = library
+        self.timestamps = timestamps
+
+    def dumps(self, obj):
+        """
+        :return `obj` serialized to JSON, as bytes. Values of other types than those of JSON,
+        and datetimes, are written as strings.
+        """
+        if self.library == "orjson":
+            if self.timestamps == "iso":
+                return orjson.dumps(obj, default=str)
+            return orjson.dumps(obj, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return json.dumps(
+            obj, default=_iso if self.timestamps == "iso" else str,
+            separators=(",", ":")).encode()
+
+
+serializer = JsonSerializer()
@@ -0,0 +1,11 @@
+"""
+Benchmarks of archive-db. Run the suite on a generated history with
+
+    python -m benchmarks run --archives 300000 --output results.json
+
+and compare the results of two versions with
+
+    python -m benchmarks compare before.json after.json
+
+The bench_* modules compare alternative implementations of single features.
+"""
@@ -0,0 +1,170 @@
+"""
+Generate synthetic archive histories, benchmark every route on them, and compare results.
+
+    python -m benchmarks generate --db /tmp/bench.db --archives 300000
+    python -m benchmarks run --archives 300000 --requests 200 --concurrency 16 --output new.json
+    python -m benchmarks compare old.json new.json
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from importlib.metadata import version
+
+from archive_db.models.DbExecutor import db_executor
+from archive_db.models.Model import Upload, Change, init_db, db_proxy
+from peewee import fn
+
+from benchmarks import history, load
+
+PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "temp_store": "memory",
+    "busy_timeout": 5000}
+
+
+def _add_history_arguments(parser):
+    for name, default in history.DEFAULTS.items():
+        parser.add_argument(
+            "--" + name.replace("_", "-"), type=type(default), default=default, dest=name)
+
+
+def _history_params(args):
+    return {name: getattr(args, name) for name in history.DEFAULTS}
+
+
+def _generate(db_path, params):
+    init_db(db_path, pragmas=PRAGMAS)
+    started = time.perf_counter()
+    counts = history.generate(**params)
+    return counts, round(time.perf_counter() - started, 3)
+
+
+def generate(args):
+    if os.path.exists(args.db):
+        sys.exit("{0} already exists".format(args.db))
+    counts, seconds = _generate(args.db, _history_params(args))
+    print(json.dumps({"counts": counts, "seconds": seconds}, indent=2))
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        params = _history_params(args)
+        result = {
+            "archive_db": version("archive-db"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "started": dt.datetime.utcnow().isoformat(),
+            "history": params}
+        db_path = args.db or os.path.join(tmpdir, "bench.db")
+        if os.path.exists(db_path):
+            init_db(db_path, pragmas=PRAGMAS)
+        else:
+            result["counts"], result["generate_seconds"] = _generate(db_path, params)
+
+        descriptions, hosts = load.sample_archives(seed=args.seed)
+        end = Upload.select(fn.MAX(Upload.timestamp)).scalar()
+        loads = load.workloads(descriptions, hosts, end, Change.last())
+        load.check_workloads(loads)
+        if args.routes:
+            loads = {route: loads[route] for route in args.routes.split(",")}
+
+        if "in-process" in args.modes:
+            result["in_process"] = {
+                "results": load.run_in_process(
+                    loads.values(), args.requests, seed=args.seed),
+                "peak_rss_kib": load.peak_rss_kib()}
+        db_executor.shutdown(wait=True)
+        db_proxy.close()
+
+        if "http" in args.modes:
+            results, peak_rss = load.run_http(
+                loads.values(), db_path, PRAGMAS, args.requests, args.concurrency,
+                read_workers=args.read_workers, workers=args.workers, seed=args.seed + 1)
+            result["http"] = {
+                "concurrency": args.concurrency,
+                "workers": args.workers,
+                "results": results,
+                "peak_rss_kib": peak_rss}
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(args):
+    """
+    Print the change in throughput and p99 latency of each route between two result files,
+    and exit with status 1 if any of them got worse by more than the tolerance
+    """
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    regressions = 0
+    for mode in ("in_process", "http"):
+        if mode not in before or mode not in after:
+            continue
+        old = {result["route"]: result for result in before[mode]["results"]}
+        for new in after[mode]["results"]:
+            if new["route"] not in old:
+                continue
+            throughput = new["throughput"] / old[new["route"]]["throughput"] - 1
+            p99 = new["p99_ms"] / old[new["route"]]["p99_ms"] - 1
+            worse = throughput < -args.tolerance or p99 > args.tolerance
+            regressions += worse
+            print("{0:10s} {1:20s} throughput {2:+7.1%}  p99 {3:+7.1%}{4}".format(
+                mode, new["route"], throughput, p99, "  REGRESSION" if worse else ""))
+        print("{0:10s} {1:20s} peak RSS {2:+7.1%}".format(
+            mode, "", after[mode]["peak_rss_kib"] / before[mode]["peak_rss_kib"] - 1))
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_generate = commands.add_parser("generate", help="write a history to a new database")
+    parser_generate.add_argument("--db", required=True)
+    _add_history_arguments(parser_generate)
+    parser_generate.set_defaults(func=generate)
+
+    parser_run = commands.add_parser(
+        "run", help="benchmark every route, on a generated history or an existing database")
+    parser_run.add_argument(
+        "--db", help="database to benchmark, generated if it doesn't exist, and written to")
+    _add_history_arguments(parser_run)
+    parser_run.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser_run.add_argument("--concurrency", type=int, default=16)
+    parser_run.add_argument("--read-workers", type=int, default=4)
+    parser_run.add_argument(
+        "--workers", type=int, default=1, help="server processes in the http mode")
+    parser_run.add_argument("--modes", default="in-process,http")
+    parser_run.add_argument("--routes", help="comma-separated route names, all by default")
+    parser_run.add_argument("--output", help="write the results to this JSON file")
+    parser_run.set_defaults(func=run)
+
+    parser_compare = commands.add_parser("compare", help="compare two result files")
+    parser_compare.add_argument("before")
+    parser_compare.add_argument("after")
+    parser_compare.add_argument("--tolerance", type=float, default=0.1)
+    parser_compare.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compare the throughput of registering uploads one by one through /upload, with and without
+group commit, with registering them through /upload/batch.
+
+    python benchmarks/bench_ingest.py --events 2000 --concurrency 32
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from tornado import gen
+from tornado.escape import json_encode
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.queues import Queue
+from tornado.web import Application
+
+from archive_db.app import routes
+from archive_db.models.Model import init_db, group_commit
+
+
+def events(num_events, prefix):
+    for i in range(num_events):
+        yield {
+            "description": f"{prefix}-archive-descr-{i}",
+            "path": f"/data/host-{i % 4}/runfolders/{prefix}-archive-{i}",
+            "host": f"host-{i % 4}"}
+
+
+async def single(base_url, num_events, concurrency, prefix):
+    client = AsyncHTTPClient(max_clients=concurrency)
+    queue = Queue()
+    for event in events(num_events, prefix):
+        queue.put_nowait(event)
+
+    async def worker():
+        while queue.qsize():
+            event = queue.get_nowait()
+            await client.fetch(f"{base_url}/upload", method="POST", body=json_encode(event))
+
+    await gen.multi([worker() for _ in range(concurrency)])
+
+
+async def batch(base_url, num_events, batch_size):
+    client = AsyncHTTPClient()
+    items = list(events(num_events, "batch"))
+    for i in range(0, len(items), batch_size):
+        await client.fetch(
+            f"{base_url}/upload/batch",
+            method="POST",
+            body=json_encode(items[i:i + batch_size]),
+            request_timeout=600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--group-commit-window-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_db(os.path.join(tmpdir, "bench.db"))
+        sockets = bind_sockets(0, "127.0.0.1")
+        server = HTTPServer(Application(routes()))
+        server.add_sockets(sockets)
+        base_url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/api/1.0"
+
+        def with_group_commit(enabled, run):
+            def configured():
+                group_commit.configure(
+                    enabled=enabled,
+                    max_items=args.concurrency,
+                    window_ms=args.group_commit_window_ms)
+                return run()
+            return configured
+
+        for name, run in (
+                (f"/upload x{args.concurrency} concurrent",
+                 with_group_commit(
+                     False, lambda: single(base_url, args.events, args.concurrency, "single"))),
+                (f"/upload x{args.concurrency} concurrent, group commit",
+                 with_group_commit(
+                     True, lambda: single(base_url, args.events, args.concurrency, "grouped"))),
+                (f"/upload/batch ({args.batch_size} per request)",
+                 with_group_commit(
+                     False, lambda: batch(base_url, args.events, args.batch_size)))):
+            t0 = time.perf_counter()
+            IOLoop.current().run_sync(run, timeout=3600)
+            elapsed = time.perf_counter() - t0
+            print(f"{name:40s} {args.events} events in {elapsed:.2f}s "
+                  f"({args.events / elapsed:.0f} events/s)")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
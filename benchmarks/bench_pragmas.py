@@ -0,0 +1,92 @@
+"""
+Measure read and write throughput with concurrent readers and a writer, using SQLite's default
+settings and the tuned sqlite_pragmas profile from config/app.config.
+
+    python benchmarks/bench_pragmas.py --archives 20000 --readers 4 --seconds 5
+"""
+import argparse
+import datetime as dt
+import os
+import tempfile
+import threading
+import time
+
+from arteria.configuration import ConfigurationService
+
+from archive_db.handlers.DbHandlers import QueryHandlerBase
+from archive_db.models.Model import Archive, Upload, init_db, db_proxy
+
+CONFIG = os.path.join(os.path.dirname(__file__), os.pardir, "config", "app.config")
+
+
+def populate(num_archives):
+    with db_proxy.atomic():
+        Archive.insert_many([{
+            "description": f"archive-descr-{i}",
+            "path": f"/data/host-{i % 4}/runfolders/archive-{i}",
+            "host": f"host-{i % 4}"} for i in range(num_archives)]).execute()
+        Upload.insert_many([{
+            "archive": i + 1,
+            "timestamp": dt.datetime(2020, 1, 1) + dt.timedelta(minutes=i)}
+            for i in range(num_archives)]).execute()
+
+
+def run(db_path, pragmas, num_archives, readers, seconds):
+    db = init_db(db_path, pragmas=pragmas)
+    populate(num_archives)
+    stop = threading.Event()
+    counts = {"reads": 0, "writes": 0}
+    lock = threading.Lock()
+
+    def reader():
+        while not stop.is_set():
+            list(QueryHandlerBase._filter_query(
+                QueryHandlerBase._db_query(), host="host-1", verified=False).limit(500))
+            with lock:
+                counts["reads"] += 1
+        db.close()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            Upload.record(
+                description=f"new-archive-descr-{i}",
+                path=f"/data/host-0/runfolders/new-archive-{i}",
+                host="host-0",
+                timestamp=dt.datetime.utcnow())
+            i += 1
+            with lock:
+                counts["writes"] += 1
+        db.close()
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    db.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=20000)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    tuned = ConfigurationService.read_yaml(CONFIG)["sqlite_pragmas"]
+    for name, pragmas in (("default", {}), ("sqlite_pragmas", tuned)):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            counts = run(
+                os.path.join(tmpdir, "bench.db"), pragmas, args.archives, args.readers,
+                args.seconds)
+        print(f"{name:16s} reads/s={counts['reads'] / args.seconds:8.1f} "
+              f"writes/s={counts['writes'] / args.seconds:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
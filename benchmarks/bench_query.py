@@ -0,0 +1,87 @@
+"""
+Compare the legacy fan-out join used by /view and /query with the one-row-per-archive query.
+
+    python benchmarks/bench_query.py --archives 2000 --uploads 5 --verifications 4
+"""
+import argparse
+import datetime as dt
+import os
+import tempfile
+import time
+
+from peewee import JOIN
+
+from archive_db.handlers.DbHandlers import QueryHandlerBase
+from archive_db.models.Model import Archive, Upload, Verification, Removal, init_db, db_proxy
+
+
+def legacy_query():
+    return Archive.select(
+        Archive.host,
+        Archive.path,
+        Archive.description,
+        Upload.timestamp.alias("uploaded"),
+        Verification.timestamp.alias("verified"),
+        Removal.timestamp.alias("removed")
+    ).join(
+        Upload, JOIN.LEFT_OUTER, on=(Upload.archive_id == Archive.id)
+    ).join(
+        Verification, JOIN.LEFT_OUTER, on=(Verification.archive_id == Archive.id)
+    ).join(
+        Removal, JOIN.LEFT_OUTER, on=(Removal.archive_id == Archive.id)
+    ).order_by(
+        Removal.timestamp.desc(),
+        Verification.timestamp.desc(),
+        Upload.timestamp.desc(),
+        Archive.path.asc())
+
+
+def populate(num_archives, uploads, verifications):
+    start = dt.datetime(2020, 1, 1)
+    with db_proxy.atomic():
+        Archive.insert_many([{
+            "description": f"archive-descr-{i}",
+            "path": f"/data/host-{i % 4}/runfolders/archive-{i}",
+            "host": f"host-{i % 4}"} for i in range(num_archives)]).execute()
+        for model, per_archive in ((Upload, uploads), (Verification, verifications)):
+            model.insert_many([{
+                "archive": i + 1,
+                "timestamp": start + dt.timedelta(days=i % 1000, hours=n)}
+                for i in range(num_archives) for n in range(per_archive)]).execute()
+
+
+def timed(query, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        rows = len(list(query.dicts()))
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=2000)
+    parser.add_argument("--uploads", type=int, default=5)
+    parser.add_argument("--verifications", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_db(os.path.join(tmpdir, "bench.db"))
+        populate(args.archives, args.uploads, args.verifications)
+        for name, query in (
+                ("fan-out join", legacy_query()),
+                ("one row per archive", QueryHandlerBase._db_query()),
+                ("filtered, one row per archive", QueryHandlerBase._filter_query(
+                    QueryHandlerBase._db_query(),
+                    host="host-1",
+                    uploaded_after="2021-01-01",
+                    verified=True))):
+            rows, elapsed = timed(query, args.repeat)
+            print(f"{name:32s} rows={rows:<10d} best of {args.repeat}: {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
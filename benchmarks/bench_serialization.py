@@ -0,0 +1,92 @@
+"""
+Measure the time to serialize an archive listing, as /view does, and the time to compress it
+and the size of the result, with each JSON library, timestamp format and content coding.
+Times and sizes are given per 100k rows.
+
+    python -m benchmarks.bench_serialization --archives 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from tornado.escape import json_encode
+
+from archive_db.handlers.Compression import CompressionTransform, _Brotli, _Gzip
+from archive_db.handlers.DbHandlers import QueryHandlerBase
+from archive_db.models.Model import init_db, db_proxy
+from archive_db.serialization import serializer, orjson
+from benchmarks import history
+
+PER = 100000
+
+
+def legacy(rows):
+    # the serialization before the timestamps were left to the serializer
+    return json_encode({"archives": [{
+        "host": row["host"],
+        "path": row["path"],
+        "description": row["description"],
+        "uploaded": str(row["uploaded"]) if row["uploaded"] else None,
+        "verified": str(row["verified"]) if row["verified"] else None,
+        "removed": str(row["removed"]) if row["removed"] else None}
+        for row in rows]}).encode()
+
+
+def current(rows):
+    return serializer.dumps({"archives": [
+        QueryHandlerBase._archive_as_json(row) for row in rows]})
+
+
+def best_of(repeat, fn, *args):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_db(os.path.join(tmpdir, "bench.db"))
+        history.generate(archives=args.archives)
+        rows = list(QueryHandlerBase._filter_query(QueryHandlerBase._db_query()))
+        db_proxy.close()
+    scale = PER / len(rows)
+    print(f"{len(rows)} rows, per {PER} rows:")
+
+    variants = [("legacy (tornado json_encode, str)", None, None)]
+    for library in ("json", "orjson") if orjson is not None else ("json",):
+        for timestamps in ("str", "iso"):
+            variants.append((f"{library}, {timestamps} timestamps", library, timestamps))
+    body = None
+    for name, library, timestamps in variants:
+        if library is None:
+            seconds, output = best_of(args.repeat, legacy, rows)
+        else:
+            serializer.configure(library=library, timestamps=timestamps)
+            seconds, output = best_of(args.repeat, current, rows)
+            if timestamps == "str":
+                body = output
+        print(f"  serialize {name:36s} {seconds * scale * 1000:8.1f}ms "
+              f"{len(output) * scale / 2**20:8.2f}MiB")
+
+    codings = [("gzip", _Gzip, CompressionTransform.gzip_level)]
+    if "br" in CompressionTransform.encodings():
+        codings.append(("br", _Brotli, CompressionTransform.brotli_quality))
+    for coding, compressor, level in codings:
+        seconds, output = best_of(
+            args.repeat, lambda: compressor(level).compress(body, True))
+        print(f"  compress  {coding + ' at level ' + str(level):36s} "
+              f"{seconds * scale * 1000:8.1f}ms {len(output) * scale / 2**20:8.2f}MiB")
+
+
+if __name__ == "__main__":
+    main()
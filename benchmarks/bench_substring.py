@@ -0,0 +1,63 @@
+"""
+Compare substring filters served by LIKE '%...%' scans with the trigram index, and prefix
+filters served by LIKE 'prefix%' with index range scans.
+
+    python benchmarks/bench_substring.py --archives 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from peewee import chunked
+
+from archive_db.handlers.DbHandlers import QueryHandlerBase
+from archive_db.models.Model import Archive, init_db, db_proxy
+
+
+def populate(num_archives):
+    rows = ({
+        "description": f"sc-{i:08d}-{i * 7919 % 100003:05d}",
+        "path": f"/data/host-{i % 16}/runfolders/{2015 + i % 10}0101_ST-E{i % 997:05d}_{i:07d}",
+        "host": f"host-{i % 16}"} for i in range(num_archives))
+    with db_proxy.atomic():
+        for chunk in chunked(rows, 10000):
+            Archive.insert_many(chunk).execute()
+
+
+def timed(query, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        rows = len(list(query.clone()))
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_db(os.path.join(tmpdir, "bench.db"))
+        t0 = time.perf_counter()
+        populate(args.archives)
+        print(f"populated {args.archives} archives in {time.perf_counter() - t0:.1f}s")
+
+        base = Archive.select(Archive.id)
+        for name, query in (
+                ("substring, LIKE", base.where(Archive.path.contains("E00042_00"))),
+                ("substring, trigram index", QueryHandlerBase._filter_query(
+                    base, path="E00042_00")),
+                ("prefix, LIKE", base.where(Archive.description.startswith("sc-000420"))),
+                ("prefix, index range scan", QueryHandlerBase._filter_query(
+                    base, description_prefix="sc-000420"))):
+            rows, elapsed = timed(query, args.repeat)
+            print(f"{name:28s} rows={rows:<8d} best of {args.repeat}: {elapsed * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Measure the latency of the hot path, i.e. the queries of the recent history and the writes of
+new events, before and after the events older than a horizon are moved to the cold tiers, and
+that of a query reaching back into the tiers. A small page cache mimics a database much larger
+than the memory at hand.
+
+    python -m benchmarks.bench_tiering --archives 300000 --horizon-days 730
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import tempfile
+import time
+
+from archive_db.handlers.DbHandlers import QueryHandlerBase, RandomUnverifiedArchiveHandler, \
+    VerificationPlanHandler
+from archive_db.models.Model import Upload, Verification, init_db, db_proxy
+from archive_db.models.Tiering import tiering
+from benchmarks import history
+
+END = dt.datetime(2024, 1, 1)
+
+
+def recent_query():
+    return QueryHandlerBase._filter_query(
+        QueryHandlerBase._db_query(), uploaded_after="2023-10-01", verified=False)
+
+
+def old_query():
+    return QueryHandlerBase._filter_query(
+        QueryHandlerBase._db_query(), uploaded_after="2016-01-01", uploaded_before="2016-03-31")
+
+
+def listing():
+    return QueryHandlerBase._filter_query(QueryHandlerBase._db_query()).limit(1000)
+
+
+def sample():
+    window = (END - dt.timedelta(days=90), END - dt.timedelta(days=30))
+    query = QueryHandlerBase._filter_query(QueryHandlerBase._db_query(), verified=False)
+    return RandomUnverifiedArchiveHandler._sample(query, window, 10, random.Random(1))
+
+
+def plan():
+    window = (END - dt.timedelta(days=90), END - dt.timedelta(days=30))
+    return list(VerificationPlanHandler._plan_query(window, END).dicts())
+
+
+def record():
+    record.count += 1
+    return Upload.record(
+        f"bench-tiering-{record.count}", f"/data/bench/runfolders/{record.count}", "bench", END)
+
+
+record.count = 0
+
+OPERATIONS = (
+    ("/query, uploads of the last quarter", lambda: len(list(recent_query()))),
+    ("/query, first 1000 archives", lambda: len(list(listing()))),
+    ("/randomarchive, 10 of the last quarter", lambda: len(sample())),
+    ("/verificationplan, last quarter", lambda: len(plan())),
+    ("/upload", lambda: 1 if record() else 0),
+    ("/query, uploads of 2016 Q1", lambda: len(list(old_query()))),
+)
+
+
+def timed(fn, repeat):
+    """
+    :return the number of rows returned by `fn` and its median and best time in seconds
+    """
+    times, rows = [], 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = fn()
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return rows, times[len(times) // 2], times[0]
+
+
+def measure(repeat):
+    return {name: timed(fn, repeat) for name, fn in OPERATIONS}
+
+
+def hot_size():
+    pages, = db_proxy.execute_sql("PRAGMA page_count").fetchone()
+    free, = db_proxy.execute_sql("PRAGMA freelist_count").fetchone()
+    size, = db_proxy.execute_sql("PRAGMA page_size").fetchone()
+    return (pages - free) * size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=100000)
+    parser.add_argument("--horizon-days", type=float, default=730)
+    parser.add_argument("--cache-mib", type=float, default=2,
+                        help="the page cache of each connection")
+    parser.add_argument("--repeat", type=int, default=21)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "bench.db")
+        init_db(db_path, pragmas={
+            "journal_mode": "wal", "cache_size": -int(args.cache_mib * 1024)})
+        history.generate(archives=args.archives)
+
+        counts = {"before": (Upload.select().count(), Verification.select().count(), hot_size())}
+        results = {"before": measure(args.repeat)}
+        tiering.configure(db_path, horizon_days=args.horizon_days, sleep=0)
+        info = tiering.run(now=END)
+        # as the autocheckpoints of a service would have done by the time of the next reads
+        db_proxy.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        counts["after"] = (Upload.select().count(), Verification.select().count(), hot_size())
+        results["after"] = measure(args.repeat)
+        db_proxy.close()
+
+    print(f"moved {info['upload']} uploads and {info['verification']} verifications to the "
+          f"tiers of {info['years']} in {info['seconds']:.1f}s")
+    for when, (uploads, verifications, size) in counts.items():
+        print(f"{when:6s} hot: {uploads} uploads, {verifications} verifications, "
+              f"{size / 2**20:.1f}MiB in use")
+    print(f"{'':40s} {'rows':>6s} {'median before':>14s} {'median after':>13s} "
+          f"{'best before':>12s} {'best after':>11s}")
+    for name, _ in OPERATIONS:
+        rows, median, best = results["before"][name]
+        _, median_after, best_after = results["after"][name]
+        print(f"{name:40s} {rows:6d} {median * 1000:12.2f}ms {median_after * 1000:11.2f}ms "
+              f"{best * 1000:10.2f}ms {best_after * 1000:9.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
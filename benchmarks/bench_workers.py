@@ -0,0 +1,55 @@
+"""
+Measure how the throughput of reads, and of writes, scales with the number of worker processes
+serving a shared database (the `workers` option of config/app.config). The response cache is
+disabled, so that every read runs its query and serializes its response.
+
+    python -m benchmarks.bench_workers --archives 100000 --workers 1,2,4 --concurrency 32
+"""
+import argparse
+import os
+import tempfile
+
+from arteria.configuration import ConfigurationService
+from peewee import fn
+
+from archive_db.models.DbExecutor import db_executor
+from archive_db.models.Model import Upload, init_db, db_proxy
+from benchmarks import history, load
+
+CONFIG = os.path.join(os.path.dirname(__file__), os.pardir, "config", "app.config")
+ROUTES = ("view", "query", "upload")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--archives", type=int, default=100000)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    pragmas = ConfigurationService.read_yaml(CONFIG)["sqlite_pragmas"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "bench.db")
+        init_db(db_path, pragmas=pragmas)
+        history.generate(archives=args.archives)
+        descriptions, hosts = load.sample_archives()
+        end = Upload.select(fn.MAX(Upload.timestamp)).scalar()
+        loads = load.workloads(descriptions, hosts, end)
+        db_executor.shutdown(wait=True)
+        db_proxy.close()
+
+        baseline = {}
+        for seed, workers in enumerate(int(workers) for workers in args.workers.split(",")):
+            results, _ = load.run_http(
+                [loads[route] for route in ROUTES], db_path, pragmas, args.requests,
+                args.concurrency, workers=workers, response_cache_entries=0, seed=seed)
+            for result in results:
+                route, throughput = result["route"], result["throughput"]
+                speedup = throughput / baseline.setdefault(route, throughput)
+                print(f"workers={workers:<3d} {route:8s} requests/s={throughput:8.1f} "
+                      f"({speedup:4.2f}x) p99={result['p99_ms']:8.1f}ms errors={result['errors']}")
+
+
+if __name__ == "__main__":
+    main()
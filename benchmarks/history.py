@@ -0,0 +1,129 @@
+"""
+Generate a synthetic, but realistically shaped, archive history: runfolders uploaded from a
+handful of hosts of skewed sizes, some of them uploaded again, most of them verified after a
+while (some repeatedly), and the older verified ones scheduled for removal and removed.
+
+    python -m benchmarks generate --db /tmp/bench.db --archives 300000
+"""
+import datetime as dt
+import random
+
+from peewee import chunked
+
+from archive_db.models.Model import Archive, Upload, Verification, Removal, write_transaction
+
+DEFAULTS = {
+    "archives": 100000,
+    "hosts": 8,
+    # archives are spread over the hosts with weights 1 / (rank + 1) ** host_skew
+    "host_skew": 1.2,
+    "span_days": 3650,
+    # chance that an archive is uploaded again, and again after that
+    "reupload_rate": 0.05,
+    "verification_rate": 0.9,
+    # chance that a verified archive is verified once more, and again after that
+    "reverification_rate": 0.3,
+    # chance that a verified archive has been scheduled for removal, and then removed
+    "scheduled_rate": 0.6,
+    "removal_rate": 0.9,
+    "seed": 42,
+}
+
+INSTRUMENTS = ("A00181", "A00689", "D00118", "E00459", "M04213", "NB551068", "ST-E00274")
+FLOWCELL_CHARACTERS = "ABCDEFGHJKLMNPRSTUVXY0123456789"
+CHUNK_SIZE = 10000
+
+
+def _repeats(rng, rate):
+    count = 0
+    while rng.random() < rate:
+        count += 1
+    return count
+
+
+def history(end=None, **params):
+    """
+    Yield the archives of a history generated from `params` (see DEFAULTS), each as a dict of
+    the archive and lists of the timestamps of its uploads, verifications and removals. The
+    same parameters always yield the same history.
+    """
+    params = {**DEFAULTS, **params}
+    rng = random.Random(params["seed"])
+    end = end or dt.datetime(2024, 1, 1)
+    start = end - dt.timedelta(days=params["span_days"])
+    span = (end - start).total_seconds()
+    hosts = [f"seq-{i:02d}" for i in range(params["hosts"])]
+    weights = [1 / (rank + 1) ** params["host_skew"] for rank in range(len(hosts))]
+    archives = params["archives"]
+
+    for i in range(archives):
+        # archives are registered in time order, as runfolders are finished
+        uploaded = start + dt.timedelta(seconds=span * (i + rng.random()) / archives)
+        host = rng.choices(hosts, weights)[0]
+        instrument = rng.choice(INSTRUMENTS)
+        flowcell = "".join(rng.choices(FLOWCELL_CHARACTERS, k=9))
+        name = "{0:%y%m%d}_{1}_{2:04d}_{3}".format(uploaded, instrument, i % 10000, flowcell)
+        uploads = [uploaded]
+        for _ in range(_repeats(rng, params["reupload_rate"])):
+            uploads.append(uploads[-1] + dt.timedelta(hours=rng.uniform(1, 72)))
+
+        verifications, removals = [], []
+        if rng.random() < params["verification_rate"]:
+            verified = uploads[-1] + dt.timedelta(days=rng.expovariate(1 / 14))
+            for _ in range(1 + _repeats(rng, params["reverification_rate"])):
+                if verified >= end:
+                    break
+                verifications.append(verified)
+                verified += dt.timedelta(days=rng.expovariate(1 / 180))
+        if verifications and rng.random() < params["scheduled_rate"]:
+            scheduled = verifications[0] + dt.timedelta(days=rng.expovariate(1 / 90))
+            if scheduled < end:
+                removed = scheduled + dt.timedelta(days=rng.expovariate(1 / 7))
+                if removed < end and rng.random() < params["removal_rate"]:
+                    removals.append((scheduled, removed))
+                else:
+                    removals.append((scheduled, None))
+
+        yield {
+            "description": "{0}-{1:08x}".format(name, rng.getrandbits(32)),
+            "path": f"/data/{host}/runfolders/{name}",
+            "host": host,
+            "uploads": uploads,
+            "verifications": verifications,
+            "removals": removals}
+
+
+def generate(**params):
+    """
+    Write the history generated from `params` (see DEFAULTS) to the database opened by
+    `init_db`, in batches. The archive state is kept by the triggers, as in production.
+
+    :return the number of archives, uploads, verifications and removals written
+    """
+    counts = {"archives": 0, "uploads": 0, "verifications": 0, "removals": 0}
+    for chunk in chunked(history(**params), CHUNK_SIZE):
+        with write_transaction():
+            ids = {
+                archive.description: archive.id
+                for archive in Archive.insert_many([{
+                    "description": archive["description"],
+                    "path": archive["path"],
+                    "host": archive["host"]} for archive in chunk]).returning(
+                        Archive.id, Archive.description).execute()}
+            for model, key in ((Upload, "uploads"), (Verification, "verifications")):
+                rows = [{"archive": ids[archive["description"]], "timestamp": timestamp}
+                        for archive in chunk for timestamp in archive[key]]
+                if rows:
+                    model.insert_many(rows).execute()
+                counts[key] += len(rows)
+            removals = [{
+                "archive": ids[archive["description"]],
+                "timestamp_scheduled": scheduled,
+                "timestamp": removed,
+                "done": removed is not None} for archive in chunk
+                for scheduled, removed in archive["removals"]]
+            if removals:
+                Removal.insert_many(removals).execute()
+            counts["removals"] += len(removals)
+        counts["archives"] += len(chunk)
+    return counts
@@ -0,0 +1,262 @@
+"""
+Drive every route of `archive_db.app.routes` with generated requests, either one request at a
+time against a server in this process, or with concurrent clients against a server in a
+separate process, and measure throughput and latency per route.
+"""
+import datetime as dt
+import itertools
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import time
+
+from tornado import gen
+from tornado.escape import json_encode
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+from tornado.web import Application
+
+from archive_db.app import routes, transforms, prepare_workers
+from archive_db.handlers.ResponseCache import response_cache
+from archive_db.models.Model import Archive, init_db, open_db
+
+
+class Workload:
+    """
+    The requests to one route. `request` takes a random.Random and a sequence number and
+    returns the path, relative to /api/1.0, and the JSON body, if any.
+    """
+
+    def __init__(self, route, method, request):
+        self.route = route
+        self.method = method
+        self.request = request
+
+
+def workloads(descriptions, hosts, end, last_change=0):
+    """
+    :param descriptions: descriptions of existing archives, for the requests referring to one
+    :param hosts: the hosts of the archives
+    :param end: the end of the history, for the date filters
+    :param last_change: the sequence number of the last change, for reading the change feed
+    :return a dict from route names to their Workload
+    """
+    def event(prefix):
+        def request(rng, i):
+            return prefix, {
+                "description": rng.choice(descriptions),
+                "path": "/data/{0}/runfolders/bench-{1}".format(rng.choice(hosts), i),
+                "host": rng.choice(hosts)}
+        return request
+
+    def new_upload(rng, i):
+        host = rng.choice(hosts)
+        return "/upload", {
+            "description": f"bench-{rng.getrandbits(64):016x}",
+            "path": f"/data/{host}/runfolders/bench-{i}",
+            "host": host}
+
+    def batch(prefix, size=100):
+        def request(rng, i):
+            items = [new_upload(rng, i * size + n)[1] for n in range(size)]
+            return prefix, items
+        return request
+
+    def date(rng, days):
+        return (end - dt.timedelta(days=rng.uniform(0, days))).strftime("%Y-%m-%d")
+
+    # the last 90 days of the history, which ends before today
+    window = {"age": str((dt.datetime.utcnow() - end).days + 90), "safety_margin": "3"}
+
+    return {workload.route: workload for workload in (
+        Workload("version", "GET", lambda rng, i: ("/version", None)),
+        Workload("upload", "POST", new_upload),
+        Workload("upload_batch", "POST", batch("/upload/batch")),
+        Workload("verification", "POST", event("/verification")),
+        Workload("verification_batch", "POST", batch("/verification/batch")),
+        Workload("randomarchive", "POST", lambda rng, i: (
+            "/randomarchive", {**window, "count": "10"})),
+        Workload("verificationplan", "POST", lambda rng, i: (
+            "/verificationplan", {**window, "count": "20"})),
+        Workload("removal", "GET", lambda rng, i: (
+            "/removal?page_size=1000&verified_before=" + date(rng, 365), None)),
+        Workload("view", "GET", lambda rng, i: (
+            "/view?page_size={0}".format(rng.choice((100, 1000))), None)),
+        Workload("query", "POST", lambda rng, i: ("/query", {
+            "host": rng.choice(hosts),
+            "uploaded_after": date(rng, 3650),
+            "verified": rng.choice(("True", "False")),
+            "page_size": 1000})),
+        Workload("export", "GET", lambda rng, i: (
+            "/export?table={0}&format={1}&uploaded_after={2}".format(
+                rng.choice(("archives", "uploads", "verifications")),
+                rng.choice(("csv", "ndjson")),
+                date(rng, 365)), None)),
+        # consumers catching up with the changes of the last day or so
+        Workload("changes", "GET", lambda rng, i: (
+            "/changes?limit=1000&since={0}".format(
+                max(0, last_change - rng.randint(0, 2000))), None)),
+        Workload("cache", "GET", lambda rng, i: ("/cache", None)),
+        Workload("metrics", "GET", lambda rng, i: ("/metrics", None)),
+        Workload("slowqueries", "GET", lambda rng, i: ("/admin/slowqueries", None)),
+        # listing the snapshots, backups aren't configured in the benchmarks
+        Workload("backup", "GET", lambda rng, i: ("/admin/backup", None)),
+    )}
+
+
+def check_workloads(loads):
+    """
+    Make sure that every route is benchmarked, so that new routes aren't forgotten
+    """
+    missing = {spec.name for spec in routes()} - set(loads)
+    if missing:
+        raise ValueError("No workload for the routes: {0}".format(", ".join(sorted(missing))))
+
+
+def sample_archives(count=10000, seed=0):
+    """
+    :return a sample of the descriptions, and all hosts, of the archives in the database
+    """
+    rng = random.Random(seed)
+    descriptions = [archive.description for archive in Archive.select(Archive.description)]
+    hosts = sorted({archive.host for archive in Archive.select(Archive.host).distinct()})
+    return rng.sample(descriptions, min(count, len(descriptions))), hosts
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_rss_kib(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss
+
+
+async def drive(base_url, workload, requests, concurrency, seed):
+    """
+    Send `requests` requests of `workload` to the server at `base_url`, from `concurrency`
+    concurrent clients
+
+    :return the results: the number of requests and errors, the elapsed time, the throughput
+    and the 50th and 99th percentiles of the latency
+    """
+    client = AsyncHTTPClient(max_clients=concurrency)
+    rng = random.Random(seed)
+    sequence = itertools.count()
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        while True:
+            i = next(sequence)
+            if i >= requests:
+                return
+            path, body = workload.request(rng, i)
+            started = time.perf_counter()
+            try:
+                await client.fetch(
+                    base_url + path,
+                    method=workload.method,
+                    body=json_encode(body) if body is not None else None,
+                    allow_nonstandard_methods=True,
+                    request_timeout=600)
+            except HTTPClientError as e:
+                if e.code >= 400:
+                    errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await gen.multi([worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    client.close()
+    return {
+        "route": workload.route,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3)}
+
+
+def _start_server(address="127.0.0.1", sockets=None):
+    sockets = sockets or bind_sockets(0, address)
+    server = HTTPServer(Application(routes(), transforms=transforms()))
+    server.add_sockets(sockets)
+    return server, "http://{0}:{1}/api/1.0".format(address, sockets[0].getsockname()[1])
+
+
+def run_in_process(loads, requests, seed=0):
+    """
+    Benchmark each workload against a server in this process, on the database opened by
+    `init_db`, one request at a time. Runs that write new archives need distinct seeds.
+    """
+    server, base_url = _start_server()
+    try:
+        return [
+            IOLoop.current().run_sync(
+                lambda: drive(base_url, workload, requests, 1, seed), timeout=3600)
+            for workload in loads]
+    finally:
+        server.stop()
+
+
+def _serve(db_path, pragmas, read_workers, workers, response_cache_entries, ready):
+    # a process group of its own, so that the workers are stopped along with it
+    os.setsid()
+    response_cache.configure(max_entries=response_cache_entries, shared=workers != 1)
+    if workers == 1:
+        init_db(db_path, read_workers=read_workers, pragmas=pragmas)
+        task_id, sockets = None, None
+    else:
+        prepare_workers(db_path, pragmas)
+        sockets = bind_sockets(0, "127.0.0.1")
+        task_id = fork_processes(workers)
+        open_db(db_path, read_workers=read_workers, pragmas=pragmas)
+    _, base_url = _start_server(sockets=sockets)
+    if not task_id:
+        IOLoop.current().add_callback(ready.send, base_url)
+    IOLoop.current().start()
+
+
+def run_http(loads, db_path, pragmas, requests, concurrency, read_workers=4, workers=1,
+             response_cache_entries=256, seed=0):
+    """
+    Benchmark each workload with `concurrency` concurrent clients against a server in a
+    separate process, which opens the database at `db_path`, and serves it from `workers`
+    pre-forked processes
+
+    :return a tuple of the results, and the peak RSS of the server in KiB. With several
+    workers, this is the RSS of the process that forked them.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_serve,
+        args=(db_path, pragmas, read_workers, workers, response_cache_entries, sender),
+        daemon=True)
+    process.start()
+    try:
+        if not receiver.poll(600):
+            raise RuntimeError("The benchmark server did not start")
+        base_url = receiver.recv()
+        results = [
+            IOLoop.current().run_sync(
+                lambda: drive(base_url, workload, requests, concurrency, seed), timeout=3600)
+            for workload in loads]
+    finally:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        process.join()
+    return results, peak_rss_kib(resource.RUSAGE_CHILDREN)
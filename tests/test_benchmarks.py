@@ -0,0 +1,34 @@
+import datetime
+import unittest
+
+from archive_db.models.Model import Archive, Removal, ArchiveState, init_db
+from benchmarks import history, load
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        init_db(":memory:")
+
+    def test_history(self):
+        params = {"archives": 500, "hosts": 4, "seed": 1}
+        self.assertEqual(list(history.history(**params)), list(history.history(**params)))
+
+        counts = history.generate(**params)
+        self.assertEqual(counts["archives"], 500)
+        self.assertEqual(Archive.select().count(), 500)
+        self.assertGreater(counts["uploads"], counts["archives"])
+        self.assertGreater(counts["verifications"], counts["archives"] / 2)
+        self.assertGreater(Removal.select().where(~Removal.done).count(), 0)
+        self.assertEqual(ArchiveState.check(), [])
+
+        # skewed: the first host has the most archives
+        hosts = [archive.host for archive in Archive.select(Archive.host)]
+        self.assertEqual(max(set(hosts), key=hosts.count), "seq-00")
+
+    def test_workloads_cover_routes(self):
+        loads = load.workloads(["descr"], ["host"], datetime.datetime(2024, 1, 1))
+        load.check_workloads(loads)
+        del loads["view"]
+        with self.assertRaises(ValueError):
+            load.check_workloads(loads)
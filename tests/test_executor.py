@@ -0,0 +1,74 @@
+import asyncio
+import threading
+
+from unittest import mock
+
+from archive_db.models.DbExecutor import DbExecutor, GroupCommitWriter
+
+from tornado.testing import AsyncTestCase, gen_test
+
+
+class TestDbExecutor(AsyncTestCase):
+
+    def setUp(self):
+        super(TestDbExecutor, self).setUp()
+        self.executor = DbExecutor(read_workers=2, write_workers=1)
+        self.addCleanup(self.executor.shutdown, True)
+
+    @gen_test
+    async def test_stream(self):
+        threads = set()
+
+        def rows(n):
+            for i in range(n):
+                threads.add(threading.get_ident())
+                yield i
+
+        batches = []
+        async for batch in self.executor.stream(rows, 10, batch_size=3):
+            batches.append(batch)
+        self.assertEqual(batches, [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]])
+        # the iterable is consumed on a single worker thread, off the IOLoop
+        self.assertEqual(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    @gen_test
+    async def test_stream_stops_producing_when_consumer_stops(self):
+        produced = []
+        done = threading.Event()
+
+        def rows():
+            try:
+                for i in range(10000):
+                    produced.append(i)
+                    yield i
+            finally:
+                done.set()
+
+        batches = self.executor.stream(rows, batch_size=10)
+        first = await batches.__anext__()
+        self.assertEqual(first, list(range(10)))
+        await batches.aclose()
+        self.assertTrue(done.wait(5))
+        self.assertLess(len(produced), 100)
+
+    @gen_test
+    async def test_stream_raises_errors(self):
+        def rows():
+            yield 1
+            raise ValueError("broken cursor")
+
+        with self.assertRaises(ValueError):
+            async for _ in self.executor.stream(rows, batch_size=1):
+                pass
+
+    @gen_test
+    async def test_group_commit_failure_answers_submitters(self):
+        writer = GroupCommitWriter(self.executor, lambda events: [event for _, event in events])
+        writer.configure(enabled=True, max_items=2, window_ms=50)
+        with mock.patch.object(writer, "_commit", side_effect=RuntimeError("write failed")):
+            futures = [writer.submit(None, i) for i in range(3)]
+            for future in futures:
+                with self.assertRaises(RuntimeError):
+                    await asyncio.wait_for(future, 5)
+        self.assertEqual(await writer.submit(None, 3), 3)
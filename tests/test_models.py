@@ -1,12 +1,47 @@
+import base64
+import collections
+import csv
 import datetime
+import fcntl
+import gc
+import gzip
+import importlib.util
+import io
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
 from importlib.metadata import version
+from unittest import mock
 
-from archive_db.models.Model import Archive, Upload, Verification, Removal, init_db
-from archive_db.app import routes
+from archive_db.models.Model import Archive, Upload, Verification, Removal, ArchiveState, \
+    ArchiveIndex, VerificationLease, Change, ImportCheckpoint, ColdTier, init_db, open_db, \
+    db_proxy, group_commit, checkpoint, write_transaction, MIGRATIONS, _autoincrement_event_ids
+import archive_db.export
+from archive_db import importer, metrics
+from archive_db.cli import export, import_events, tier
+from archive_db.app import routes, transforms, prepare_workers
+from archive_db.handlers.DbHandlers import QueryHandlerBase, RandomUnverifiedArchiveHandler, \
+    ChangesHandler
+from archive_db.models.SlowQueryLog import slow_query_log
+from archive_db.models.WriterLock import writer_lock
+from archive_db.models.Backup import Backup, backup, BackupError, BackupRunningError
+from archive_db.models.Tiering import tiering, TieringError
+from archive_db.handlers.ResponseCache import ResponseCache, response_cache
+from archive_db.handlers.Compression import CompressionTransform
+from archive_db.serialization import serializer
 
+from peewee import SqliteDatabase
+from tornado import gen
 from tornado.web import Application
 from tornado.escape import json_encode, json_decode
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, gen_test
 
 
 class TestDb(AsyncHTTPTestCase):
@@ -29,10 +64,11 @@ class TestDb(AsyncHTTPTestCase):
     def setUp(self):
         init_db(":memory:")
         # init_db("test.db")
+        response_cache.configure()
         super(TestDb, self).setUp()
 
     def get_app(self):
-        return Application(routes())
+        return Application(routes(), transforms=transforms())
 
     def go(self, target, method, body=None):
         return self.fetch(
@@ -71,6 +107,8 @@ class TestDb(AsyncHTTPTestCase):
                         archive=int(i+1),
                         timestamp=datetime.datetime.fromisoformat(archive[key])
                     )
+        # written behind the back of the handlers
+        response_cache.invalidate()
         return archives
 
     def test_db_model(self):
@@ -94,6 +132,38 @@ class TestDb(AsyncHTTPTestCase):
         self.assertEqual(len(verifications), 1)
         self.assertEqual(len(verifications), len(removals))
 
+    def test_archive_state(self):
+        archives = self.create_data()
+        archive = archives[self.second_archive]
+        body = {
+            "description": archive["description"],
+            "host": archive["host"],
+            "path": archive["path"],
+            "timestamp": (self.now + datetime.timedelta(days=1)).isoformat()
+        }
+        for target in ("/upload", "/verification"):
+            resp = self.go(target, method="POST", body=body)
+            self.assertEqual(resp.code, 200)
+
+        state = ArchiveState.get(ArchiveState.archive == self.second_archive + 1)
+        self.assertEqual(state.upload_count, 2)
+        self.assertEqual(state.verification_count, 2)
+        self.assertEqual(state.removal_count, 1)
+        self.assertEqual(state.last_uploaded, datetime.datetime.fromisoformat(body["timestamp"]))
+        self.assertEqual(state.last_verified, datetime.datetime.fromisoformat(body["timestamp"]))
+        self.assertEqual(state.last_removed, self.now)
+        self.assertEqual(ArchiveState.select().count(), self.num_archives)
+        self.assertEqual(ArchiveState.check(), [])
+
+        ArchiveState.update(upload_count=0).execute()
+        self.assertEqual(
+            sorted(ArchiveState.check()),
+            [i + 1 for i, archive in enumerate(archives) if archive["uploaded"]])
+        ArchiveState.rebuild()
+        self.assertEqual(ArchiveState.check(), [])
+        self.assertEqual(
+            ArchiveState.get(ArchiveState.archive == self.second_archive + 1).upload_count, 2)
+
     def test_create_new_archive_and_upload(self):
         test_data = next(self.example_data())
         body = {
@@ -106,6 +176,36 @@ class TestDb(AsyncHTTPTestCase):
         self.assertEqual(resp["status"], "created")
         self.assertEqual(resp["upload"]["description"], body["description"])
 
+    @gen_test
+    def test_group_commit(self):
+        group_commit.configure(enabled=True, max_items=4, window_ms=50)
+        self.addCleanup(group_commit.configure)
+        archives = list(self.example_data())
+
+        responses = yield [
+            self.http_client.fetch(
+                self.get_url(self.API_BASE + target),
+                method="POST",
+                body=json_encode({
+                    "description": archive["description"],
+                    "host": archive["host"],
+                    "path": archive["path"]}))
+            for archive in archives
+            for target in ("/upload", "/verification")]
+
+        # ten writes flushed in batches of max_items, the remainder when the window closes
+        self.assertEqual(group_commit.items, 2 * len(archives))
+        self.assertEqual(group_commit.batches, 3)
+        ids = {"upload": set(), "verification": set()}
+        for resp in responses:
+            resp = json_decode(resp.body)
+            self.assertEqual(resp["status"], "created")
+            key = "upload" if "upload" in resp else "verification"
+            ids[key].add(resp[key]["id"])
+        self.assertEqual(ids["upload"], set(range(1, len(archives) + 1)))
+        self.assertEqual(ids["verification"], set(range(1, len(archives) + 1)))
+        self.assertEqual(ArchiveState.check(), [])
+
     def test_failing_upload(self):
         test_data = next(self.example_data())
         body = {
@@ -130,6 +230,98 @@ class TestDb(AsyncHTTPTestCase):
             self.assertEqual(resp["upload"]["description"], body["description"])
             self.assertEqual(resp["upload"]["id"], upload_id)
 
+    @gen_test
+    def test_archive_mismatch(self):
+        test_data = next(self.example_data())
+        body = {key: test_data[key] for key in ("description", "host", "path")}
+        resp = yield self.http_client.fetch(
+            self.get_url(self.API_BASE + "/upload"), method="POST", body=json_encode(body))
+        self.assertEqual(resp.code, 200)
+
+        moved = dict(body, path="/data/elsewhere/runfolders/" + body["description"])
+        resp = yield self.http_client.fetch(
+            self.get_url(self.API_BASE + "/verification"), method="POST",
+            body=json_encode(moved), raise_error=False)
+        self.assertEqual(resp.code, 409)
+
+        # with group commit, the other events of the transaction are written all the same
+        group_commit.configure(enabled=True, max_items=2, window_ms=50)
+        self.addCleanup(group_commit.configure)
+        responses = yield [
+            self.http_client.fetch(
+                self.get_url(self.API_BASE + "/upload"), method="POST", body=json_encode(item),
+                raise_error=False)
+            for item in (body, dict(body, host="other-host"))]
+        self.assertEqual([resp.code for resp in responses], [200, 409])
+
+        resp = yield self.http_client.fetch(
+            self.get_url(self.API_BASE + "/upload/batch"), method="POST",
+            body=json_encode([moved, body]))
+        resp = json_decode(resp.body)
+        self.assertEqual(resp["status"], "partial")
+        self.assertEqual([result["status"] for result in resp["results"]], ["error", "created"])
+        self.assertIn(moved["path"], resp["results"][0]["reason"])
+
+        self.assertEqual(Archive.get().path, body["path"])
+        self.assertEqual(Upload.select().count(), 3)
+        self.assertEqual(Verification.select().count(), 0)
+        self.assertEqual(ArchiveState.check(), [])
+
+    def test_batch_upload(self):
+        archives = list(self.example_data())
+        body = [
+            {key: archive[key] for key in ("description", "host", "path")}
+            for archive in archives + archives[:2]]
+        body.insert(1, {"description": "missing-path-and-host"})
+        resp = self.go("/upload/batch", method="POST", body=body)
+        self.assertEqual(resp.code, 200)
+        resp = json_decode(resp.body)
+        self.assertEqual(resp["status"], "partial")
+        self.assertEqual(resp["created"], len(archives) + 2)
+        self.assertEqual(resp["failed"], 1)
+        self.assertEqual(len(resp["results"]), len(body))
+        self.assertEqual(resp["results"][1]["status"], "error")
+        for item, result in zip(body, resp["results"]):
+            if result["status"] == "created":
+                self.assertEqual(result["upload"]["description"], item["description"])
+                self.assertEqual(result["upload"]["path"], item["path"])
+                self.assertEqual(
+                    Upload.get_by_id(result["upload"]["id"]).archive.description,
+                    item["description"])
+
+        self.assertEqual(Archive.select().count(), len(archives))
+        self.assertEqual(Upload.select().count(), len(archives) + 2)
+        self.assertEqual(
+            [state.upload_count for state in ArchiveState.select().order_by(ArchiveState.archive)],
+            [2, 2] + [1] * (len(archives) - 2))
+
+    def test_batch_verification_ndjson(self):
+        archives = list(self.example_data())
+        body = "\n".join(
+            json_encode({
+                "description": archive["description"],
+                "host": archive["host"],
+                "path": archive["path"],
+                "timestamp": self.now.isoformat()})
+            for archive in archives)
+        resp = self.fetch(
+            self.API_BASE + "/verification/batch",
+            method="POST",
+            body=body,
+            headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(resp.code, 200)
+        resp = json_decode(resp.body)
+        self.assertEqual(resp["status"], "created")
+        self.assertEqual(
+            [result["verification"]["description"] for result in resp["results"]],
+            [archive["description"] for archive in archives])
+
+        resp = self.go("/query", method="POST", body={"verified": True})
+        self.assertEqual(len(json_decode(resp.body)["archives"]), len(archives))
+
+        resp = self.go("/verification/batch", method="POST", body={"not": "a list"})
+        self.assertEqual(resp.code, 400)
+
     def _verification_of_archive_helper(self, archive):
 
         body = {
@@ -211,12 +403,658 @@ class TestDb(AsyncHTTPTestCase):
         for key in ("description", "host", "path"):
             self.assertEqual(obs_archive[key], exp_archive[key])
 
+    def _random_archives(self, **params):
+        body = {
+            "age": "10",
+            "safety_margin": "0",
+            "today": self.now.date().isoformat(),
+            **params}
+        resp = self.go("/randomarchive", method="POST", body=body)
+        self.assertEqual(resp.code, 200)
+        return json_decode(resp.body)
+
+    def test_fetch_random_unverified_archives(self):
+        with db_proxy.atomic():
+            for i in range(100):
+                archive = Archive.create(
+                    description=f"archive-descr-{i}",
+                    path=f"/data/testhost/runfolders/archive-{i}",
+                    host="testhost")
+                # some archives have been uploaded more than once
+                for days in range(i % 3 + 1):
+                    Upload.create(
+                        archive=archive,
+                        timestamp=self.now - datetime.timedelta(days=days + 1))
+                if i % 2:
+                    Verification.create(archive=archive, timestamp=self.now)
+        unverified = {f"archive-descr-{i}" for i in range(0, 100, 2)}
+
+        picks = self._random_archives(count="10", seed="42")["archives"]
+        descriptions = [archive["description"] for archive in picks]
+        self.assertEqual(len(set(descriptions)), 10)
+        self.assertTrue(set(descriptions) <= unverified)
+        # the same seed gives the same picks
+        self.assertEqual(picks, self._random_archives(count="10", seed="42")["archives"])
+
+        # asking for more archives than there are returns all of them
+        picks = self._random_archives(count="80")["archives"]
+        self.assertEqual({archive["description"] for archive in picks}, unverified)
+
+        # all archives are picked, regardless of their number of uploads
+        picked = collections.Counter(
+            self._random_archives(seed=seed)["archive"]["description"] for seed in range(300))
+        self.assertEqual(set(picked), unverified)
+        self.assertLess(max(picked.values()), 20)
+
+        resp = self.go("/randomarchive", method="POST", body={
+            "age": "10", "safety_margin": "0", "count": "0"})
+        self.assertEqual(resp.code, 400)
+
+    def test_fetch_random_unverified_archive_when_sparse(self):
+        archives = self.create_data()
+        RandomUnverifiedArchiveHandler.PROBES_PER_ARCHIVE = 0
+        self.addCleanup(setattr, RandomUnverifiedArchiveHandler, "PROBES_PER_ARCHIVE", 16)
+        picks = self._random_archives(count="5")["archives"]
+        self.assertEqual(
+            sorted(archive["description"] for archive in picks),
+            [archives[i]["description"] for i in (self.first_archive, self.third_archive)])
+
+    def test_fetch_random_archives_when_sparse(self):
+        with db_proxy.atomic():
+            for i in range(500):
+                archive = Archive.create(
+                    description=f"archive-descr-{i}",
+                    path=f"/data/testhost/runfolders/archive-{i}",
+                    host="testhost")
+                Upload.create(archive=archive, timestamp=self.now - datetime.timedelta(days=1))
+                if i % 100:
+                    Verification.create(archive=archive, timestamp=self.now)
+
+        class Probes(random.Random):
+            made = 0
+
+            def randint(self, a, b):
+                self.made += 1
+                return super().randint(a, b)
+
+        rng = Probes(1)
+        window = (self.now - datetime.timedelta(days=10), self.now)
+        query = QueryHandlerBase._filter_query(QueryHandlerBase._db_query(), verified=False)
+        picks = RandomUnverifiedArchiveHandler._sample(
+            query, window, RandomUnverifiedArchiveHandler.MAX_COUNT, rng)
+        self.assertEqual(
+            sorted(row["description"] for row in picks),
+            sorted(f"archive-descr-{i}" for i in range(0, 500, 100)))
+        # the probes stop once they keep missing, rather than after 16 per requested archive
+        self.assertLess(rng.made, 500)
+
+        self.assertEqual(len(self._random_archives(count="1000")["archives"]), 5)
+        resp = self.go("/randomarchive", method="POST", body={
+            "age": "10", "safety_margin": "0", "count": "1001"})
+        self.assertEqual(resp.code, 400)
+
+    def _plan(self, **params):
+        body = {
+            "age": "21",
+            "safety_margin": "0",
+            "today": self.now.date().isoformat(),
+            **params}
+        return self.go("/verificationplan", method="POST", body=body)
+
+    def test_verification_plan(self):
+        # a busy host uploading 30 archives per week and a quiet one uploading 2, for 3 weeks
+        with db_proxy.atomic():
+            for host, per_week in (("busy", 30), ("quiet", 2)):
+                for week in range(3):
+                    for i in range(per_week):
+                        archive = Archive.create(
+                            description=f"{host}-{week}-{i}",
+                            path=f"/data/{host}/runfolders/{host}-{week}-{i}",
+                            host=host)
+                        Upload.create(
+                            archive=archive,
+                            timestamp=self.now - datetime.timedelta(weeks=week, days=1))
+
+        resp = self._plan(count="12", seed="1")
+        self.assertEqual(resp.code, 200)
+        plan = json_decode(resp.body)
+        self.assertEqual(len(plan["archives"]), 12)
+        self.assertEqual(len({archive["description"] for archive in plan["archives"]}), 12)
+        self.assertEqual(len(plan["strata"]), 6)
+        for stratum in plan["strata"]:
+            self.assertEqual(stratum["unverified"], 30 if stratum["host"] == "busy" else 2)
+            self.assertEqual(stratum["planned"], 2)
+        self.assertEqual(resp.body, self._plan(count="12", seed="1").body)
+
+        # leased archives are left out of other plans
+        leased = json_decode(self._plan(count="100", lease="3600").body)
+        self.assertEqual(len(leased["archives"]), 96)
+        self.assertEqual(VerificationLease.select().count(), 96)
+        self.assertEqual(self._plan().code, 204)
+        # until they are verified
+        archive = leased["archives"][0]
+        resp = self.go("/verification", method="POST", body={
+            key: archive[key] for key in ("description", "host", "path")})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(VerificationLease.select().count(), 95)
+        # or the lease expires
+        VerificationLease.update(expires=datetime.datetime(2000, 1, 1)).execute()
+        self.assertEqual(len(json_decode(self._plan(lease="60").body)["archives"]), 10)
+        self.assertEqual(VerificationLease.select().count(), 10)
+
+        resp = self._plan(lease="forever")
+        self.assertEqual(resp.code, 400)
+
+    def test_removal(self):
+        archives = self.create_data()
+        for i in (0, 2):
+            resp = self.go("/verification", method="POST", body={
+                key: archives[i][key] for key in ("description", "host", "path")})
+            self.assertEqual(resp.code, 200)
+
+        # archives 0 and 2 have been verified, and archive 3 has been verified and removed
+        resp = self.fetch(self.API_BASE + "/removal")
+        self.assertEqual(resp.code, 200)
+        removable = json_decode(resp.body)
+        self.assertEqual(
+            [archive["description"] for archive in removable["archives"]],
+            [archives[i]["description"] for i in (0, 2)])
+        self.assertIsNone(removable["next_cursor"])
+
+        descr = archives[2]["description"]
+        for _ in range(2):
+            resp = self.go("/removal", method="POST", body={
+                "description": descr, "action": "set_removable"})
+            self.assertEqual(resp.code, 200)
+            removal = json_decode(resp.body)
+            self.assertEqual(removal["status"], "scheduled")
+            self.assertFalse(removal["removal"]["done"])
+            self.assertIsNone(removal["removal"]["timestamp"])
+        # scheduling twice doesn't schedule the removal twice
+        self.assertEqual(Removal.select().where(Removal.done == False).count(), 1)
+
+        resp = self.fetch(self.API_BASE + "/removal?scheduled=true")
+        scheduled = json_decode(resp.body)["archives"]
+        self.assertEqual([archive["description"] for archive in scheduled], [descr])
+        self.assertEqual(scheduled[0]["scheduled"], removal["removal"]["timestamp_scheduled"])
+        resp = self.fetch(self.API_BASE + "/removal?scheduled=false&page_size=1")
+        self.assertEqual(
+            [archive["description"] for archive in json_decode(resp.body)["archives"]],
+            [archives[0]["description"]])
+        # scheduled removals aren't removals
+        resp = self.go("/query", method="POST", body={"removed": "True"})
+        self.assertEqual(len(json_decode(resp.body)["archives"]), 1)
+
+        resp = self.go("/removal", method="POST", body={
+            "description": descr, "action": "set_removed"})
+        self.assertEqual(resp.code, 200)
+        removal = json_decode(resp.body)
+        self.assertEqual(removal["status"], "removed")
+        self.assertTrue(removal["removal"]["done"])
+        self.assertIsNotNone(removal["removal"]["timestamp_scheduled"])
+        self.assertIsNotNone(removal["removal"]["timestamp"])
+        resp = self.fetch(self.API_BASE + "/removal")
+        self.assertEqual(
+            [archive["description"] for archive in json_decode(resp.body)["archives"]],
+            [archives[0]["description"]])
+
+        # removing an archive that wasn't scheduled
+        resp = self.go("/removal", method="POST", body={
+            "description": archives[0]["description"], "action": "set_removed"})
+        self.assertEqual(json_decode(resp.body)["removal"]["done"], True)
+        self.assertEqual(self.fetch(self.API_BASE + "/removal").code, 204)
+        self.assertEqual(ArchiveState.check(), [])
+
+        resp = self.go("/removal", method="POST", body={
+            "description": "no-such-archive", "action": "set_removed"})
+        self.assertEqual(resp.code, 404)
+        resp = self.go("/removal", method="POST", body={
+            "description": descr, "action": "delete"})
+        self.assertEqual(resp.code, 400)
+
+    def test_removal_pagination(self):
+        with db_proxy.atomic():
+            for i in range(25):
+                archive = Archive.create(
+                    description=f"archive-descr-{i}",
+                    path=f"/data/testhost/runfolders/archive-{i}",
+                    host="testhost")
+                Verification.create(
+                    archive=archive, timestamp=self.now - datetime.timedelta(days=i))
+        descriptions = []
+        cursor = None
+        while True:
+            url = "/removal?page_size=10&verified_before=2023-06-10"
+            if cursor:
+                url += f"&cursor={cursor}"
+            page = json_decode(self.fetch(self.API_BASE + url).body)
+            descriptions.extend(archive["description"] for archive in page["archives"])
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(descriptions, [f"archive-descr-{i}" for i in range(5, 25)])
+
+    def test_timestamps(self):
+        archive = next(self.example_data())
+        for timestamp in ("2023-06-15T16:50:23+02:00", "2023-06-15 14:50:23", "2023-06-14Z"):
+            resp = self.go("/upload", method="POST", body={
+                "description": archive["description"],
+                "host": archive["host"],
+                "path": archive["path"],
+                "timestamp": timestamp})
+            self.assertEqual(resp.code, 200)
+        # normalized to UTC
+        self.assertEqual(
+            [str(upload.timestamp) for upload in Upload.select().order_by(Upload.id)],
+            ["2023-06-15 14:50:23", "2023-06-15 14:50:23", "2023-06-14 00:00:00"])
+        self.assertEqual(
+            db_proxy.execute_sql("SELECT DISTINCT typeof(timestamp) FROM upload").fetchall(),
+            [("integer",)])
+
+        resp = self.go("/query", method="POST", body={"uploaded_after": "2023-06-15"})
+        self.assertEqual(
+            json_decode(resp.body)["archives"][0]["uploaded"], "2023-06-15 14:50:23")
+        resp = self.go("/query", method="POST", body={"uploaded_before": "2023-06-13"})
+        self.assertEqual(resp.code, 204)
+
+        for timestamp in ("yesterday", 1686840623):
+            resp = self.go("/upload", method="POST", body={
+                "description": archive["description"],
+                "host": archive["host"],
+                "path": archive["path"],
+                "timestamp": timestamp})
+            self.assertEqual(resp.code, 400)
+        resp = self.go("/upload/batch", method="POST", body=[
+            {"description": "descr-1", "host": "host", "path": "/path/1", "timestamp": "2023-06-15"},
+            {"description": "descr-2", "host": "host", "path": "/path/2", "timestamp": "June"}])
+        results = json_decode(resp.body)["results"]
+        self.assertEqual(results[0]["upload"]["timestamp"], "2023-06-15 00:00:00")
+        self.assertEqual(results[1]["status"], "error")
+
     def test_version(self):
         resp = self.go("/version", method="GET")
         self.assertEqual(resp.code, 200)
         resp = json_decode(resp.body)
         self.assertEqual(resp["version"], version("archive_db"))
 
+    @gen_test(timeout=30)
+    def test_version_responsive_during_large_view(self):
+        num_archives = 20000
+        with db_proxy.atomic():
+            Archive.insert_many([{
+                "description": f"archive-descr-{i}",
+                "path": f"/data/testhost/runfolders/archive-{i}",
+                "host": "testhost"} for i in range(num_archives)]).execute()
+            Upload.insert_many([{
+                "archive": i + 1,
+                "timestamp": self.now - datetime.timedelta(minutes=i)}
+                for i in range(num_archives)]).execute()
+
+        finished = {}
+        started = time.monotonic()
+
+        async def timed_fetch(target):
+            resp = await self.http_client.fetch(self.get_url(self.API_BASE + target))
+            finished[target] = time.monotonic() - started
+            return resp
+
+        view = gen.convert_yielded(timed_fetch("/view"))
+        # give the /view request a head start so that its query is already running
+        yield gen.sleep(0.05)
+        version_resp, view_resp = yield [timed_fetch("/version"), view]
+
+        self.assertEqual(version_resp.code, 200)
+        self.assertEqual(len(json_decode(view_resp.body)["archives"]), num_archives)
+        self.assertLess(finished["/version"], finished["/view"])
+
+    def test_response_cache(self):
+        self.create_data()
+
+        def _fetch(target, method="GET", body=None, headers=None):
+            return self.fetch(
+                self.API_BASE + target,
+                method=method,
+                body=json_encode(body) if method == "POST" else None,
+                headers=headers)
+
+        # a generation of its own second, which can be validated by date as well
+        later = response_cache.last_modified + datetime.timedelta(minutes=1)
+        with mock.patch.object(ResponseCache, "_now", return_value=later):
+            response_cache.invalidate()
+        first = _fetch("/view")
+        second = _fetch("/view")
+        self.assertEqual(first.code, 200)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.headers["Etag"], second.headers["Etag"])
+        self.assertEqual(
+            json_decode(_fetch("/cache").body)["hits"], 1)
+
+        # the key is normalized, so the order of the filters doesn't matter
+        _fetch("/query", "POST", {"host": "testhost", "verified": "True"})
+        resp = _fetch("/query", "POST", {"verified": "True", "host": "testhost"})
+        self.assertEqual(resp.code, 200)
+        stats = json_decode(_fetch("/cache").body)
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (2, 2, 2))
+
+        resp = _fetch("/view", headers={"If-None-Match": first.headers["Etag"]})
+        self.assertEqual(resp.code, 304)
+        # the same contents in another content coding, which the tag is weak for
+        self.assertTrue(first.headers["Etag"].startswith('W/"'))
+        resp = _fetch("/view", headers={
+            "If-None-Match": first.headers["Etag"], "Accept-Encoding": "gzip"})
+        self.assertEqual(resp.code, 304)
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        resp = _fetch("/view", headers={"If-Modified-Since": first.headers["Last-Modified"]})
+        self.assertEqual(resp.code, 304)
+        # the conditional headers only apply to GET and HEAD
+        resp = self.fetch(
+            self.API_BASE + "/query", method="POST", body=json_encode({"host": "testhost"}),
+            headers={"If-None-Match": first.headers["Etag"]})
+        self.assertEqual(resp.code, 200)
+
+        self.go("/upload", method="POST", body={
+            "description": "new-archive", "path": "/data/testhost/runfolders/new-archive",
+            "host": "testhost"})
+        resp = _fetch("/view", headers={"If-None-Match": first.headers["Etag"]})
+        self.assertEqual(resp.code, 200)
+        self.assertNotEqual(resp.headers["Etag"], first.headers["Etag"])
+        self.assertIn(
+            "new-archive",
+            [archive["description"] for archive in json_decode(resp.body)["archives"]])
+        stats = json_decode(_fetch("/cache").body)
+        self.assertEqual((stats["entries"], stats["generation"]), (1, 3))
+        # the upload was written within the second of the first response, which has the same
+        # date but isn't current anymore
+        self.assertEqual(resp.headers["Last-Modified"], first.headers["Last-Modified"])
+        resp = _fetch("/view", headers={"If-Modified-Since": first.headers["Last-Modified"]})
+        self.assertEqual(resp.code, 200)
+        resp = _fetch("/view", headers={"If-None-Match": resp.headers["Etag"]})
+        self.assertEqual(resp.code, 304)
+
+    def test_response_cache_external_writes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, "archive.db")
+            db = init_db(db_path)
+            self.addCleanup(db.close)
+            self.create_data()
+            response_cache.configure(db_path=db_path)
+            first = self.fetch(self.API_BASE + "/view")
+            self.assertEqual(first.code, 200)
+
+            # an import by the command line tool is seen by the service
+            uploads = os.path.join(tmpdir, "uploads.csv")
+            with open(uploads, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("description", "path", "host", "timestamp"))
+                writer.writerow(("imported", "/data/testhost/imported", "testhost",
+                                 "2023-06-01T00:00:00Z"))
+            self.assertEqual(
+                import_events([uploads, "--event", "upload", "--db", db_path]), 0)
+            resp = self.fetch(
+                self.API_BASE + "/view", headers={"If-None-Match": first.headers["Etag"]})
+            self.assertEqual(resp.code, 200)
+            self.assertIn("imported", [
+                archive["description"] for archive in json_decode(resp.body)["archives"]])
+
+            # as are writes made in quick succession
+            etag = resp.headers["Etag"]
+            ResponseCache.touch(db_path)
+            self.assertNotEqual(response_cache.etag(), etag)
+            etag = response_cache.etag()
+            ResponseCache.touch(db_path)
+            self.assertNotEqual(response_cache.etag(), etag)
+
+    def test_response_cache_bounds(self):
+        cache = ResponseCache(max_entries=2, max_bytes=10)
+        cache.put("a", 0, 200, b"1234")
+        cache.put("b", 0, 200, b"1234")
+        self.assertIsNotNone(cache.get("a"))
+        # evicts the least recently used "b" by number of entries
+        cache.put("c", 0, 204)
+        self.assertIsNone(cache.get("b"))
+        # evicts "a" to fit in the bytes
+        cache.put("d", 0, 200, b"12345678")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), (204, None))
+        # too large to be cached, or read from an earlier generation
+        cache.put("e", 0, 200, b"12345678901")
+        cache.invalidate()
+        cache.put("f", 0, 200, b"1")
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_shared_response_cache(self):
+        cache = ResponseCache(max_entries=2, max_bytes=10)
+        cache.configure(max_entries=2, max_bytes=10, shared=True)
+        cache.put("a", 0, 200, b"1234")
+        etag = cache.etag()
+        # a write through another worker invalidates the entries of this one
+        process = multiprocessing.get_context("fork").Process(target=cache.invalidate)
+        process.start()
+        process.join()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.generation, 1)
+        self.assertNotEqual(cache.etag(), etag)
+        self.assertEqual(len(cache), 0)
+
+    def test_changes(self):
+        archives = self.create_data()
+        resp = self.go("/removal", method="POST", body={
+            "description": archives[self.second_archive]["description"],
+            "action": "set_removable"})
+        self.assertEqual(resp.code, 200)
+        self.go("/removal", method="POST", body={
+            "description": archives[self.second_archive]["description"],
+            "action": "set_removed"})
+
+        resp = self.fetch(self.API_BASE + "/changes")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        changes = body["changes"]
+        self.assertEqual([change["seq"] for change in changes], list(range(1, len(changes) + 1)))
+        self.assertEqual(body["last_seq"], len(changes))
+        expected = collections.Counter(
+            {event: sum(1 for archive in archives if archive[key])
+             for event, key in (("upload", "uploaded"), ("verification", "verified"),
+                                ("removal", "removed"))})
+        expected.update(["removal_scheduled", "removal"])
+        self.assertEqual(collections.Counter(change["event"] for change in changes), expected)
+        self.assertEqual(changes[-1]["event"], "removal")
+        self.assertEqual(changes[-1]["description"], archives[self.second_archive]["description"])
+        first = next(archive for archive in archives if archive["uploaded"])
+        self.assertEqual(
+            (changes[0]["event"], changes[0]["description"], changes[0]["timestamp"]),
+            ("upload", first["description"], first["uploaded"]))
+
+        # only the changes after `since`, up to `limit`
+        resp = self.fetch(self.API_BASE + "/changes?since=2&limit=3")
+        self.assertEqual(
+            [change["seq"] for change in json_decode(resp.body)["changes"]], [3, 4, 5])
+        resp = self.fetch(self.API_BASE + "/changes?since={0}".format(len(changes)))
+        self.assertEqual(json_decode(resp.body), {"changes": [], "last_seq": len(changes)})
+        for args in ("since=-1", "limit=0", "timeout=1000", "since=first"):
+            self.assertEqual(self.fetch(self.API_BASE + "/changes?" + args).code, 400)
+
+    @gen_test(timeout=10)
+    def test_changes_long_poll(self):
+        self.create_data()
+        last = Change.last()
+
+        def changes(since, timeout):
+            return self.http_client.fetch(self.get_url(
+                self.API_BASE + "/changes?since={0}&timeout={1}".format(since, timeout)))
+
+        started = time.monotonic()
+        poll = changes(last, 5)
+        yield gen.sleep(0.1)
+        yield self.http_client.fetch(
+            self.get_url(self.API_BASE + "/upload"), method="POST", body=json_encode({
+                "description": "new-archive", "path": "/data/testhost/runfolders/new-archive",
+                "host": "testhost"}))
+        resp = yield poll
+        self.assertLess(time.monotonic() - started, 2)
+        body = json_decode(resp.body)
+        self.assertEqual(body["last_seq"], last + 1)
+        self.assertEqual(
+            [(change["event"], change["description"]) for change in body["changes"]],
+            [("upload", "new-archive")])
+
+        # writes that aren't notified, e.g. by other workers, are seen when polling
+        ChangesHandler.POLL_INTERVAL = 0.1
+        self.addCleanup(setattr, ChangesHandler, "POLL_INTERVAL", 1.0)
+        poll = changes(last + 1, 5)
+        yield gen.sleep(0.1)
+        Verification.record(
+            description="new-archive", path="/data/testhost/runfolders/new-archive",
+            host="testhost", timestamp=datetime.datetime.utcnow())
+        resp = yield poll
+        self.assertEqual(json_decode(resp.body)["changes"][0]["event"], "verification")
+
+        # nothing new before the timeout
+        started = time.monotonic()
+        resp = yield changes(last + 2, 0.3)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(json_decode(resp.body), {"changes": [], "last_seq": last + 2})
+
+    def test_compression(self):
+        self.create_data()
+        self.addCleanup(CompressionTransform.configure)
+        CompressionTransform.configure(min_length=100)
+
+        def view(accept_encoding):
+            return self.fetch(
+                self.API_BASE + "/view", headers={"Accept-Encoding": accept_encoding},
+                decompress_response=False)
+
+        resp = view("gzip, deflate")
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertEqual(len(json_decode(gzip.decompress(resp.body))["archives"]), 5)
+        # refused by the client, or too short
+        self.assertNotIn("Content-Encoding", view("gzip;q=0, identity").headers)
+        CompressionTransform.configure(min_length=10000)
+        resp = view("gzip")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(len(json_decode(resp.body)["archives"]), 5)
+        # streamed responses are compressed regardless of their size
+        resp = self.fetch(
+            self.API_BASE + "/view?stream=true", headers={"Accept-Encoding": "gzip"},
+            decompress_response=False)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(len(json_decode(gzip.decompress(resp.body))["archives"]), 5)
+
+        self.assertEqual(CompressionTransform.negotiate(""), None)
+        self.assertEqual(CompressionTransform.negotiate("*"), CompressionTransform.encodings()[0])
+        self.assertEqual(CompressionTransform.negotiate("br;q=0.5, gzip;q=0.8"), "gzip")
+
+    def test_serializer(self):
+        self.addCleanup(serializer.configure)
+        timestamp = datetime.datetime(2023, 6, 1, 12, 0, 0, 500000)
+        libraries = ["json"] + (["orjson"] if importlib.util.find_spec("orjson") else [])
+        for library in libraries:
+            serializer.configure(library=library)
+            self.assertEqual(
+                json_decode(serializer.dumps({"uploaded": timestamp, "removed": None})),
+                {"uploaded": "2023-06-01 12:00:00.500000", "removed": None})
+            serializer.configure(library=library, timestamps="iso")
+            self.assertEqual(
+                json_decode(serializer.dumps([timestamp])), ["2023-06-01T12:00:00.500000"])
+        with self.assertRaises(ValueError):
+            serializer.configure(timestamps="epoch")
+
+    def test_metrics(self):
+        for metric in metrics.REGISTRY:
+            metric.clear()
+        self.create_data()
+        self.go("/upload", method="POST", body={
+            "description": "new-archive", "path": "/data/testhost/runfolders/new-archive",
+            "host": "testhost"})
+        self.go("/view", method="GET")
+        self.go("/view", method="GET")
+
+        resp = self.fetch(self.API_BASE + "/metrics")
+        self.assertEqual(resp.code, 200)
+        self.assertTrue(resp.headers["Content-Type"].startswith("text/plain"))
+        samples = {}
+        for line in resp.body.decode().splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+
+        self.assertEqual(
+            samples['archive_db_requests_total{route="view",method="GET",status="200"}'], 2)
+        self.assertEqual(
+            samples['archive_db_request_duration_seconds_count{route="view"}'], 2)
+        self.assertEqual(
+            samples['archive_db_response_size_bytes_bucket{route="upload",le="+Inf"}'], 1)
+        self.assertGreater(samples['archive_db_response_size_bytes_sum{route="view"}'], 0)
+        # the database work is attributed to the route it was done for
+        self.assertGreater(
+            samples['archive_db_db_statement_duration_seconds_count{route="upload"}'], 0)
+        self.assertEqual(samples['archive_db_db_lock_wait_seconds_count{route="upload"}'], 1)
+        self.assertGreater(
+            samples['archive_db_db_rows_total{route="upload",operation="written"}'], 0)
+        self.assertEqual(
+            samples['archive_db_db_rows_total{route="view",operation="read"}'],
+            self.num_archives + 1)
+        self.assertEqual(
+            samples['archive_db_db_task_duration_seconds_count{route="view",pool="read"}'], 1)
+        self.assertEqual(samples['archive_db_response_cache_events_total{event="hit"}'], 1)
+
+    def test_slow_query_log(self):
+        self.create_data()
+        slow_query_log.configure(threshold_ms=0)
+        self.addCleanup(slow_query_log.configure)
+
+        with self.assertLogs("archive_db.models.SlowQueryLog", "WARNING") as logs:
+            for uploaded_after in ("2023-01-01", "2023-02-01"):
+                resp = self.go("/query", method="POST", body={
+                    "uploaded_after": uploaded_after, "host_prefix": "test"})
+                self.assertEqual(resp.code, 200)
+        self.assertTrue(any("Slow query" in line for line in logs.output))
+
+        resp = self.fetch(self.API_BASE + "/admin/slowqueries?count=100")
+        self.assertEqual(resp.code, 200)
+        resp = json_decode(resp.body)
+        self.assertEqual(resp["threshold_ms"], 0)
+        queries = resp["queries"]
+        self.assertEqual(
+            [query["max_ms"] for query in queries],
+            sorted((query["max_ms"] for query in queries), reverse=True))
+        # both queries have the same shape, and its plan has been captured once
+        query = next(query for query in queries if "archive_state" in query["shape"]
+                     and query["shape"].startswith("SELECT"))
+        self.assertEqual(query["count"], 2)
+        self.assertIn("upload_timestamp", "\n".join(query["plan"]))
+        self.assertIn("test", query["max_params"])
+
+        resp = self.fetch(self.API_BASE + "/admin/slowqueries?count=0")
+        self.assertEqual(resp.code, 400)
+
+        # a cursor dropped before all its rows were fetched is timed, but not explained
+        slow_query_log.clear()
+        cursor = db_proxy.execute_sql("SELECT id FROM archive ORDER BY id")
+        self.assertEqual(cursor.fetchone(), (1,))
+        with mock.patch.object(slow_query_log, "_explain") as explain:
+            del cursor
+            gc.collect()
+        explain.assert_not_called()
+        query, = slow_query_log.top()
+        self.assertEqual((query["count"], query["max_rows"], query["plan"]), (1, 1, None))
+
+    def test_backup_endpoint(self):
+        self.addCleanup(backup.configure)
+        backup.configure()
+        self.assertEqual(self.go("/admin/backup", method="POST").code, 400)
+        resp = self.fetch(self.API_BASE + "/admin/backup")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(json_decode(resp.body)["snapshots"], [])
+
+        # an in-memory database can't be backed up to a snapshot
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backup.configure(db_path=":memory:", directory=tmpdir)
+            self.assertEqual(self.go("/admin/backup", method="POST").code, 400)
+
     def test_view(self):
         resp = self.go("/view", method="GET")
         self.assertEqual(resp.code, 204)
@@ -242,6 +1080,232 @@ class TestDb(AsyncHTTPTestCase):
         for observed_archive in observed_archives:
             self.assertIn(observed_archive, expected_archives)
 
+    def test_substring_and_prefix_filters(self):
+        archives = self.create_data()
+        Archive.update(
+            path="/data/otherhost/runfolders/archive-4"
+        ).where(Archive.description == "archive-descr-4").execute()
+        archives[4]["path"] = "/data/otherhost/runfolders/archive-4"
+        self.assertTrue(ArchiveIndex.enabled)
+
+        def _descriptions(body):
+            resp = self.go("/query", method="POST", body=body)
+            if resp.code == 204:
+                return []
+            return sorted(archive["description"] for archive in json_decode(resp.body)["archives"])
+
+        for body, expected in (
+                ({"path": "OTHERHOST/run"}, [4]),
+                ({"path": "testhost"}, [0, 1, 2, 3]),
+                ({"path": "-4"}, [4]),
+                ({"description": 'descr-"1'}, []),
+                ({"path_prefix": "/data/testhost/runfolders/archive-"}, [0, 1, 2, 3]),
+                ({"path_prefix": "/data/TESTHOST"}, []),
+                ({"description_prefix": "archive-descr-3"}, [3]),
+                ({"host_prefix": "test", "path": "archive-2"}, [2])):
+            self.assertEqual(
+                _descriptions(body),
+                [archives[i]["description"] for i in expected],
+                msg=body)
+
+    def test_one_row_per_archive(self):
+        archive = next(self.example_data())
+        self.create_data(data=[archive])
+        timestamps = [self.now - datetime.timedelta(days=d) for d in (0, 10)]
+        for tbl in (Upload, Verification):
+            for timestamp in timestamps:
+                tbl.create(archive=1, timestamp=timestamp)
+
+        for target, method, body in (
+                ("/view", "GET", None),
+                ("/query", "POST", {}),
+                ("/query", "POST", {"verified": True, "removed": False})):
+            resp = self.go(target, method=method, body=body)
+            self.assertEqual(resp.code, 200)
+            observed_archives = json_decode(resp.body)["archives"]
+            self.assertEqual(len(observed_archives), 1)
+            self.assertEqual(observed_archives[0]["uploaded"], str(max(timestamps)))
+            self.assertEqual(observed_archives[0]["verified"], str(max(timestamps)))
+            self.assertIsNone(observed_archives[0]["removed"])
+
+        # the upload date filters must be satisfied by a single upload
+        resp = self.go(
+            "/query",
+            method="POST",
+            body={
+                "uploaded_after": (self.now - datetime.timedelta(days=7)).strftime("%Y-%m-%d"),
+                "uploaded_before": (self.now - datetime.timedelta(days=3)).strftime("%Y-%m-%d")})
+        self.assertEqual(resp.code, 204)
+
+    def test_pagination(self):
+        archives = self.create_data()
+        # add a few archives sharing their sort values, to exercise the tie-breaking
+        for i in range(3):
+            Archive.create(
+                description=f"archive-descr-tie-{i}",
+                path="/data/testhost/runfolders/archive-tie",
+                host="testhost")
+            Upload.create(archive=self.num_archives + i + 1, timestamp=self.now)
+        resp = self.go("/view", method="GET")
+        expected = json_decode(resp.body)["archives"]
+        self.assertEqual(len(expected), len(archives) + 3)
+
+        def _walk(fetch_page):
+            observed, cursor, pages = [], None, 0
+            while True:
+                resp = json_decode(fetch_page(cursor).body)
+                observed.extend(resp["archives"])
+                pages += 1
+                cursor = resp["next_cursor"]
+                if cursor is None:
+                    return observed, pages
+
+        observed, pages = _walk(
+            lambda cursor: self.go(
+                "/view?page_size=3" + (f"&cursor={cursor}" if cursor else ""), method="GET"))
+        self.assertEqual(observed, expected)
+        self.assertEqual(pages, 3)
+
+        observed, pages = _walk(
+            lambda cursor: self.go(
+                "/query",
+                method="POST",
+                body={"page_size": 2, "cursor": cursor, "verified": False}))
+        self.assertEqual(observed, [archive for archive in expected if not archive["verified"]])
+        self.assertEqual(pages, 4)
+
+        resp = self.go("/view?page_size=0", method="GET")
+        self.assertEqual(resp.code, 400)
+        resp = self.go("/query", method="POST", body={"cursor": "not-a-cursor"})
+        self.assertEqual(resp.code, 400)
+        # well-formed cursors with values that can't be those of a listing
+        for values in ([{"a": 1}] * 5, [None, None, 1, "/path"], [None, None, 1, "/path", None],
+                       [None, None, "1", "/path", 1], [True, None, 1, "/path", 1]):
+            cursor = base64.urlsafe_b64encode(json_encode(values).encode()).decode()
+            resp = self.go("/query", method="POST", body={"page_size": 2, "cursor": cursor})
+            self.assertEqual(resp.code, 400)
+
+    def test_streaming(self):
+        self.assertEqual(self.go("/view?stream=true", method="GET").code, 204)
+        archives = self.create_data()
+        expected = json_decode(self.go("/view", method="GET").body)["archives"]
+
+        QueryHandlerBase.STREAM_BATCH_SIZE = 2
+        self.addCleanup(setattr, QueryHandlerBase, "STREAM_BATCH_SIZE", 1000)
+
+        resp = self.go("/view?stream=true", method="GET")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(json_decode(resp.body)["archives"], expected)
+
+        resp = self.go("/query", method="POST", body={"stream": True, "verified": False})
+        self.assertEqual(
+            json_decode(resp.body)["archives"],
+            [archive for archive in expected if not archive["verified"]])
+
+        resp = self.fetch(
+            self.API_BASE + "/view",
+            headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers["Content-Type"], "application/x-ndjson")
+        lines = resp.body.decode().splitlines()
+        self.assertEqual([json_decode(line) for line in lines], expected)
+        self.assertEqual(len(lines), len(archives))
+
+    def test_export(self):
+        archives = self.create_data()
+        listed = json_decode(self.go("/view", method="GET").body)["archives"]
+
+        resp = self.fetch(self.API_BASE + "/export?format=csv")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.headers["Content-Type"], "text/csv; charset=utf-8")
+        rows = list(csv.DictReader(io.StringIO(resp.body.decode())))
+        self.assertEqual(
+            rows,
+            [{key: archive[key] or "" for key in rows[0]} for archive in listed])
+
+        resp = self.go("/export", method="POST", body={
+            "table": "uploads", "format": "ndjson", "verified": "True"})
+        self.assertEqual(resp.code, 200)
+        uploads = [json_decode(line) for line in resp.body.decode().splitlines()]
+        self.assertEqual(
+            [(upload["description"], upload["timestamp"]) for upload in uploads],
+            [(archive["description"], archive["uploaded"]) for archive in archives
+             if archive["verified"]])
+
+        resp = self.fetch(self.API_BASE + "/export?table=removals&format=csv")
+        removals = list(csv.DictReader(io.StringIO(resp.body.decode())))
+        self.assertEqual(
+            [(removal["description"], removal["done"]) for removal in removals],
+            [(archives[self.second_archive]["description"], "True")])
+
+        for query in ("format=xml", "table=archive", "uploaded_after=yesterday",
+                      "verified=maybe"):
+            resp = self.fetch(self.API_BASE + "/export?" + query)
+            self.assertEqual(resp.code, 400)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_export_parquet(self):
+        import pyarrow.parquet
+
+        self.create_data()
+        # several row groups
+        self.addCleanup(setattr, archive_db.export, "BATCH_SIZE", archive_db.export.BATCH_SIZE)
+        archive_db.export.BATCH_SIZE = 2
+        resp = self.fetch(self.API_BASE + "/export?table=archives&format=parquet")
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(pyarrow.parquet.ParquetFile(io.BytesIO(resp.body)).num_row_groups, 3)
+        table = pyarrow.parquet.read_table(io.BytesIO(resp.body))
+        self.assertEqual(table.num_rows, self.num_archives)
+        self.assertEqual(
+            table.column_names,
+            ["description", "path", "host", "uploaded", "verified", "removed"])
+        self.assertEqual(
+            sorted(filter(None, table.column("uploaded").to_pylist())),
+            sorted(self.now - datetime.timedelta(days=i) for i in (
+                self.first_archive, self.second_archive, self.third_archive)))
+
+    def test_too_many_tiers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, "archive.db")
+            db = init_db(db_path)
+            self.addCleanup(tiering.configure)
+            for year in range(2008, 2023):
+                Upload.record(
+                    description=f"descr-{year}", path=f"/data/host/descr-{year}", host="host",
+                    timestamp=datetime.datetime(year, 6, 1))
+            tiering.configure(db_path, horizon_days=365, sleep=0)
+            tiering.run(now=datetime.datetime(2024, 1, 1))
+            self.assertGreater(ColdTier.select().count(), ColdTier.MAX_ATTACHED)
+
+            window = {"uploaded_before": "2023-01-01"}
+            for target, body in (("/query", window), ("/query", dict(window, stream="true")),
+                                 ("/randomarchive", {"age": "10000", "safety_margin": "0"})):
+                resp = self.go(target, method="POST", body=body)
+                self.assertEqual(resp.code, 400)
+            resp = self.fetch(self.API_BASE + "/export?uploaded_before=2023-01-01")
+            self.assertEqual(resp.code, 400)
+            # a window within the limit is answered
+            resp = self.go("/query", method="POST", body={
+                "uploaded_after": "2018-01-01", "uploaded_before": "2023-01-01"})
+            self.assertEqual(len(json_decode(resp.body)["archives"]), 5)
+            db.close()
+
+    def test_export_cli(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, "archive.db")
+            init_db(db_path)
+            archives = self.create_data()
+            output = os.path.join(tmpdir, "uploads.csv")
+            self.assertEqual(
+                export(["uploads", "--format", "csv", "--output", output, "--db", db_path,
+                        "--host-prefix", "test"]), 0)
+            with open(output) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(
+                sorted(row["description"] for row in rows),
+                sorted(archive["description"] for archive in archives if archive["uploaded"]))
+            db_proxy.close()
+
     def test_query(self):
         def _assert_response(resp, expected_code, expected_archives):
             self.assertEqual(resp.code, expected_code)
@@ -334,3 +1398,499 @@ class TestDb(AsyncHTTPTestCase):
                 "path": "this-will-not-match-anything"
             })
         self.assertEqual(resp.code, 204)
+
+
+class TestInitDb(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.db_path = os.path.join(tmpdir.name, "archive.db")
+
+    def test_sqlite_pragmas(self):
+        pragmas = {
+            "journal_mode": "wal",
+            "synchronous": "normal",
+            "cache_size": -2048,
+            "mmap_size": 1048576,
+            "temp_store": "memory",
+            "busy_timeout": 1234}
+        db = init_db(self.db_path, pragmas=pragmas)
+        self.addCleanup(db.close)
+
+        self.assertEqual(db.journal_mode, "wal")
+        self.assertEqual(db.synchronous, 1)
+        self.assertEqual(db.cache_size, -2048)
+        self.assertEqual(db.mmap_size, 1048576)
+        self.assertEqual(db.pragma("temp_store"), 2)
+        self.assertEqual(db.pragma("busy_timeout"), 1234)
+
+        Archive.create(description="descr", path="/path", host="host")
+        busy, log_pages, checkpointed = checkpoint("truncate")
+        self.assertEqual(busy, 0)
+        self.assertEqual(log_pages, checkpointed)
+        with self.assertRaises(ValueError):
+            checkpoint("everything")
+
+    def test_migrate_legacy_db(self):
+        # the schema of databases created before there were any migrations
+        legacy = SqliteDatabase(self.db_path)
+        for sql in (
+                "CREATE TABLE archive (id INTEGER NOT NULL PRIMARY KEY, "
+                "description VARCHAR(255) NOT NULL, path VARCHAR(255) NOT NULL, "
+                "host VARCHAR(255) NOT NULL)",
+                *(f"CREATE TABLE {table} (id INTEGER NOT NULL PRIMARY KEY, "
+                  f"archive_id INTEGER NOT NULL, timestamp DATETIME NOT NULL, "
+                  f"FOREIGN KEY (archive_id) REFERENCES archive (id))"
+                  for table in ("upload", "verification", "removal")),
+                *(f"CREATE INDEX {table}_archive_id ON {table} (archive_id)"
+                  for table in ("upload", "verification", "removal")),
+                "CREATE TABLE archive_state (archive_id INTEGER NOT NULL PRIMARY KEY, "
+                "last_uploaded DATETIME, last_verified DATETIME, last_removed DATETIME, "
+                "upload_count INTEGER NOT NULL, verification_count INTEGER NOT NULL, "
+                "removal_count INTEGER NOT NULL, "
+                "FOREIGN KEY (archive_id) REFERENCES archive (id))",
+                "INSERT INTO archive VALUES (1, 'descr', '/path', 'host')",
+                # timestamps were stored in whatever format the clients sent them
+                "INSERT INTO upload VALUES (1, 1, '2023-06-01 11:00:00')",
+                "INSERT INTO upload VALUES (2, 1, '2023-06-01T12:00:00+02:00')",
+                "INSERT INTO verification VALUES (1, 1, '2023-06-01T11:00:00.5')",
+                "INSERT INTO removal VALUES (1, 1, '2023-06-02 00:00:00')",
+                # and the latest of them was picked by comparing them as text, so that the
+                # upload at 10:00 UTC came out as the latest, since "T" sorts after " "
+                "INSERT INTO archive_state VALUES (1, '2023-06-01T12:00:00+02:00', "
+                "'2023-06-01T11:00:00.5', '2023-06-02 00:00:00', 2, 1, 1)"):
+            legacy.execute_sql(sql)
+        legacy.close()
+
+        db = init_db(self.db_path)
+        self.addCleanup(db.close)
+        self.assertEqual(db.pragma("user_version"), len(MIGRATIONS))
+        removal = Removal.get()
+        self.assertTrue(removal.done)
+        self.assertIsNone(removal.timestamp_scheduled)
+        state = ArchiveState.get()
+        self.assertEqual(state.removal_count, 1)
+        self.assertEqual(state.last_removed, datetime.datetime(2023, 6, 2))
+        self.assertIsNone(state.removal_scheduled)
+        self.assertEqual(ArchiveState.check(), [])
+
+        # the timestamps are stored as integers, in UTC
+        for table in ("upload", "verification", "removal", "archive_state"):
+            self.assertEqual(
+                db.execute_sql(
+                    f"SELECT count(*) FROM {table} WHERE typeof("
+                    f"{'last_uploaded' if table == 'archive_state' else 'timestamp'}) != 'integer'"
+                ).fetchone()[0], 0)
+        self.assertEqual(
+            [upload.timestamp for upload in Upload.select().order_by(Upload.id)],
+            [datetime.datetime(2023, 6, 1, 11), datetime.datetime(2023, 6, 1, 10)])
+        # the state is rebuilt from the converted history
+        self.assertEqual(state.last_uploaded, datetime.datetime(2023, 6, 1, 11))
+        self.assertEqual(state.path, "/path")
+        self.assertEqual(
+            state.last_verified, datetime.datetime(2023, 6, 1, 11, 0, 0, 500000))
+        indexes = [index.name for index in db.get_indexes("upload")]
+        self.assertIn("upload_archive_timestamp", indexes)
+        self.assertIn("upload_timestamp", indexes)
+        self.assertNotIn("upload_archive_id", indexes)
+        # scheduled removals can be recorded in the migrated table
+        Removal.create(archive=1, done=False, timestamp_scheduled=datetime.datetime(2023, 6, 3))
+        self.assertEqual(ArchiveState.get().removal_scheduled, datetime.datetime(2023, 6, 3))
+
+    def test_concurrent_writers(self):
+        # several connections registering events for the same new archives at once
+        db = init_db(self.db_path, pragmas={"journal_mode": "wal", "busy_timeout": 10000})
+        self.addCleanup(db.close)
+        descriptions = [f"archive-descr-{i % 5}" for i in range(200)]
+
+        def upload(description):
+            upload = Upload.record(
+                description=description,
+                path=f"/data/testhost/runfolders/{description}",
+                host="testhost",
+                timestamp=datetime.datetime.utcnow())
+            db.close()
+            return upload
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            uploads = list(executor.map(upload, descriptions))
+
+        self.assertEqual([upload.archive.description for upload in uploads], descriptions)
+        self.assertEqual(Archive.select().count(), 5)
+        self.assertEqual(
+            len({(upload.archive.id, upload.archive.description) for upload in uploads}), 5)
+        self.assertEqual(Upload.select().count(), len(descriptions))
+        self.assertEqual(ArchiveState.check(), [])
+
+    def test_import(self):
+        uploads = os.path.join(os.path.dirname(self.db_path), "uploads.csv")
+        with open(uploads, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(("description", "path", "host", "timestamp"))
+            for i in range(10):
+                writer.writerow((f"descr-{i % 4}", f"/data/host/runfolders/descr-{i % 4}",
+                                 "host", f"2023-06-01T00:00:0{i}Z"))
+        events = os.path.join(os.path.dirname(self.db_path), "events.ndjson")
+        with open(events, "w") as f:
+            for i in range(6):
+                f.write(json_encode({
+                    "event": "verification", "description": f"descr-{i}",
+                    "path": f"/data/host/runfolders/descr-{i}", "host": "host",
+                    "timestamp": f"2023-07-01T00:00:0{i}Z"}) + "\n")
+            f.write("not json\n")
+
+        db = init_db(self.db_path)
+        self.addCleanup(db.close)
+        Upload.record(description="descr-0", path="/data/host/runfolders/descr-0", host="host",
+                      timestamp=datetime.datetime(2023, 5, 1))
+        # the malformed line stops the import of its input after the committed batches
+        self.assertEqual(import_events(
+            [uploads, events, "--event", "upload", "--batch-size", "4", "--db", self.db_path]),
+            1)
+        self.assertEqual(Upload.select().count(), 11)
+        self.assertEqual(Verification.select().count(), 4)
+        self.assertEqual(
+            ImportCheckpoint.get(ImportCheckpoint.source.startswith(events + "#")).position, 4)
+        # what was imported is in the state all the same
+        self.assertEqual(ArchiveState.check(), [])
+
+        self.assertEqual(import_events(
+            [uploads, events, "--event", "upload", "--batch-size", "4", "--skip-invalid",
+             "--db", self.db_path]), 0)
+        self.assertEqual(Upload.select().count(), 11)
+        self.assertEqual(Verification.select().count(), 6)
+        self.assertEqual(Archive.select().count(), 6)
+        self.assertEqual(ArchiveState.check(), [])
+        self.assertEqual(ArchiveState.get(ArchiveState.archive == Archive.get(
+            Archive.description == "descr-1")).upload_count, 3)
+        self.assertIn("upload_archive_timestamp", [index.name for index in db.get_indexes("upload")])
+        # the triggers are back in place
+        Verification.record(description="descr-0", path="/data/host/runfolders/descr-0",
+                            host="host", timestamp=datetime.datetime(2023, 8, 1))
+        self.assertEqual(ArchiveState.check(), [])
+        if ArchiveIndex.enabled:
+            self.assertEqual(ArchiveIndex.select().count(), 6)
+
+        # records added to an input are imported, and new contents under an old name as well
+        with open(events, "a") as f:
+            f.write(json_encode({
+                "event": "verification", "description": "descr-6",
+                "path": "/data/host/runfolders/descr-6", "host": "host",
+                "timestamp": "2023-07-01T00:00:06Z"}) + "\n")
+        with open(uploads, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(("description", "path", "host", "timestamp"))
+            writer.writerow(("descr-7", "/data/host/runfolders/descr-7", "host",
+                             "2023-06-02T00:00:00Z"))
+        self.assertEqual(import_events(
+            [uploads, events, "--event", "upload", "--skip-invalid", "--db", self.db_path]), 0)
+        self.assertEqual(Upload.select().count(), 12)
+        self.assertEqual(Verification.select().count(), 8)
+        self.assertEqual(ArchiveState.check(), [])
+        # standard input has no name of its own
+        self.assertEqual(import_events(["-", "--format", "ndjson", "--db", self.db_path]), 1)
+        self.assertEqual(importer.import_records("tsm", [json_encode({
+            "event": "upload", "description": "descr-8", "path": "/data/host/runfolders/descr-8",
+            "host": "host", "timestamp": "2023-06-03T00:00:00Z"})])["imported"], 1)
+        self.assertEqual(importer.import_records("tsm", [json_encode({
+            "event": "upload", "description": "descr-9", "path": "/data/host/runfolders/descr-9",
+            "host": "host", "timestamp": "2023-06-04T00:00:00Z"})])["imported"], 1)
+        # an archive keeps the path and host it was registered with
+        moved = [json_encode({
+            "event": "upload", "description": "descr-9", "path": "/data/elsewhere/descr-9",
+            "host": "host", "timestamp": "2023-06-05T00:00:00Z"})]
+        with self.assertRaises(ValueError):
+            importer.import_records("moved", moved)
+        self.assertEqual(
+            importer.import_records("moved", moved, skip_invalid=True)["invalid"], 1)
+        self.assertEqual(Archive.get(Archive.description == "descr-9").path,
+                         "/data/host/runfolders/descr-9")
+
+    def test_interrupted_import(self):
+        db = init_db(self.db_path)
+        importer.prepare(db)
+        importer.import_records("backfill", ({
+            "event": "upload", "description": f"descr-{i}", "path": f"/data/host/descr-{i}",
+            "host": "host", "timestamp": "2023-06-01T00:00:00Z"} for i in range(3)))
+        # the process dies before the import finishes
+        db.close()
+
+        db = init_db(self.db_path)
+        self.addCleanup(db.close)
+        self.assertEqual(ArchiveState.check(), [])
+        self.assertEqual(
+            len(QueryHandlerBase._filter_query(QueryHandlerBase._db_query(), host="host")), 3)
+        Upload.record(description="descr-0", path="/data/host/descr-0", host="host",
+                      timestamp=datetime.datetime(2023, 7, 1))
+        self.assertEqual(ArchiveState.check(), [])
+
+    def test_workers(self):
+        pragmas = {"journal_mode": "wal", "busy_timeout": 100}
+        with self.assertRaises(ValueError):
+            prepare_workers(self.db_path)
+        prepare_workers(self.db_path, pragmas)
+        self.addCleanup(writer_lock.configure)
+
+        def work(task_id):
+            # every write waits for the writer lock rather than for SQLite's busy handler,
+            # which would give up after 100ms
+            db = open_db(self.db_path, pragmas=pragmas)
+            for i in range(40):
+                Upload.record(
+                    description=f"archive-descr-{i % 5}",
+                    path=f"/data/testhost/runfolders/archive-descr-{i % 5}",
+                    host="testhost",
+                    timestamp=datetime.datetime.utcnow())
+                with write_transaction():
+                    time.sleep(0.005)
+            db.close()
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=work, args=(i,)) for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([process.exitcode for process in processes], [0] * 4)
+
+        db = open_db(self.db_path, pragmas=pragmas)
+        self.addCleanup(db.close)
+        self.assertEqual(Upload.select().count(), 160)
+        self.assertEqual(Archive.select().count(), 5)
+        self.assertEqual(ArchiveState.check(), [])
+
+    def test_backup(self):
+        pragmas = {"journal_mode": "wal", "busy_timeout": 10000}
+        db = init_db(self.db_path, pragmas=pragmas)
+        self.addCleanup(db.close)
+        directory = os.path.join(os.path.dirname(self.db_path), "backups")
+        self.addCleanup(backup.configure)
+        # a step per page, so that the writes interleave with the backup
+        backup.configure(self.db_path, directory, keep=2, pages=1, sleep=0.001)
+        with self.assertRaises(BackupError):
+            Backup().run()
+        with write_transaction():
+            for i in range(500):
+                Upload.record(
+                    description=f"archive-descr-{i}",
+                    path=f"/data/testhost/runfolders/archive-descr-{i}",
+                    host="testhost",
+                    timestamp=datetime.datetime(2023, 6, 1))
+
+        stop = threading.Event()
+
+        def write():
+            i = 0
+            while not stop.is_set():
+                Upload.record(
+                    description=f"archive-descr-{i % 500}",
+                    path=f"/data/testhost/runfolders/archive-descr-{i % 500}",
+                    host="testhost",
+                    timestamp=datetime.datetime.utcnow())
+                i += 1
+            db.close()
+            return i
+
+        ok = metrics.backups._values.get(("ok",), 0)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            writes = executor.submit(write)
+            infos = [backup.run() for _ in range(3)]
+            stop.set()
+            self.assertGreater(writes.result(), 0)
+
+        self.assertEqual(metrics.backups._values[("ok",)], ok + 3)
+        self.assertGreater(infos[-1]["steps"], 1)
+        self.assertEqual(infos[-1]["removed"], [infos[0]["file"]])
+        self.assertEqual(
+            [snapshot["file"] for snapshot in backup.snapshots()],
+            [infos[2]["file"], infos[1]["file"]])
+        self.assertEqual(backup.last, infos[-1])
+        self.assertFalse(os.path.exists(infos[0]["file"]))
+        for info in infos[1:]:
+            snapshot = sqlite3.connect(info["file"])
+            self.addCleanup(snapshot.close)
+            self.assertEqual(info["bytes"], os.path.getsize(info["file"]))
+            self.assertEqual(snapshot.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+            self.assertEqual(snapshot.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+            # a consistent snapshot, with every upload counted in the archive state
+            uploads = snapshot.execute("SELECT count(*) FROM upload").fetchone()[0]
+            self.assertGreaterEqual(uploads, 500)
+            self.assertEqual(
+                snapshot.execute("SELECT sum(upload_count) FROM archive_state").fetchone()[0],
+                uploads)
+
+        # one backup at a time
+        with open(os.path.join(directory, ".backup.lock"), "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            with self.assertRaises(BackupRunningError):
+                backup.run()
+        self.assertEqual(len(backup.snapshots()), 2)
+
+    def test_tiering(self):
+        db = init_db(self.db_path, pragmas={"journal_mode": "wal"})
+        self.addCleanup(db.close)
+        self.addCleanup(tiering.configure)
+        now = datetime.datetime(2024, 1, 1)
+        uploads, verifications = [], []
+        with write_transaction():
+            # more years than there can be tiers attached at once
+            for i in range(40):
+                uploaded = now - datetime.timedelta(days=150 * i + 1)
+                uploads.append(uploaded)
+                Upload.record(
+                    description=f"archive-descr-{i}",
+                    path=f"/data/testhost/runfolders/archive-descr-{i}",
+                    host="testhost",
+                    timestamp=uploaded)
+                if i % 2:
+                    verifications.append(uploaded + datetime.timedelta(days=30))
+                    Verification.record(
+                        description=f"archive-descr-{i}",
+                        path=f"/data/testhost/runfolders/archive-descr-{i}",
+                        host="testhost",
+                        timestamp=verifications[-1])
+
+        windows = [
+            {"uploaded_after": "2023-06-01"},
+            {"uploaded_after": "2019-01-01", "uploaded_before": "2020-06-30"},
+            {"uploaded_after": "2012-01-01", "uploaded_before": "2021-01-01", "verified": "True"}]
+
+        def listed(**filters):
+            return [row["description"] for row in QueryHandlerBase._filter_query(
+                QueryHandlerBase._db_query(), **filters)]
+
+        before = [listed(**window) for window in windows]
+        state = list(ArchiveState.select().order_by(ArchiveState.archive).dicts())
+
+        with self.assertRaises(TieringError):
+            tiering.run(now=now)
+        tiering.configure(self.db_path, horizon_days=365, batch_size=7, sleep=0)
+        info = tiering.run(now=now)
+        horizon = now - datetime.timedelta(days=365)
+        old = [uploaded for uploaded in uploads if uploaded < horizon]
+        old_verifications = [verified for verified in verifications if verified < horizon]
+        self.assertEqual(info["upload"], len(old))
+        self.assertEqual(info["verification"], len(old_verifications))
+        self.assertEqual(
+            info["years"], sorted({timestamp.year for timestamp in old + old_verifications}))
+        self.assertGreater(len(info["years"]), ColdTier.MAX_ATTACHED)
+        self.assertEqual(Upload.select().count(), 40 - len(old))
+        self.assertEqual([tier.year for tier in ColdTier.select()], info["years"])
+        for year in info["years"]:
+            self.assertTrue(os.path.exists(os.path.join(
+                os.path.dirname(self.db_path), f"archive-cold-{year}.db")))
+
+        # the same archives are found, and the latest events of each are kept
+        self.assertEqual([listed(**window) for window in windows], before)
+        self.assertEqual(listed(cold="false", **windows[1]), [])
+        with self.assertRaises(ValueError):
+            listed(uploaded_before="2021-01-01")
+        self.assertEqual(
+            list(ArchiveState.select().order_by(ArchiveState.archive).dicts()), state)
+        # the full history is read a tier at a time
+        self.assertEqual(ArchiveState.check(), [])
+        ArchiveState.rebuild()
+        self.assertEqual(
+            list(ArchiveState.select().order_by(ArchiveState.archive).dicts()), state)
+        rows = list(archive_db.export.Export("uploads").query)
+        self.assertEqual(sorted(row["id"] for row in rows), list(range(1, 41)))
+        self.assertEqual(
+            sorted(row["timestamp"] for row in rows), sorted(uploads))
+        self.assertEqual(
+            len(list(archive_db.export.Export("uploads", cold="false").query)), 40 - len(old))
+
+        # the tiers are backed up with the database
+        self.addCleanup(backup.configure)
+        backup.configure(self.db_path, os.path.join(os.path.dirname(self.db_path), "backups"))
+        taken = backup.run()
+        self.assertEqual(len(taken["tiers"]), len(ColdTier.select()))
+        self.assertEqual(backup.snapshots()[0]["tiers"], taken["tiers"])
+        backed_up = 0
+        for file in [taken["file"], *taken["tiers"]]:
+            snapshot = sqlite3.connect(file)
+            self.addCleanup(snapshot.close)
+            self.assertEqual(snapshot.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+            backed_up += snapshot.execute("SELECT count(*) FROM upload").fetchone()[0]
+        self.assertEqual(backed_up, 40)
+        # the uploads of the archives selected by an upload window in the tiers
+        rows = list(archive_db.export.Export("uploads", **windows[1]).query)
+        self.assertEqual(sorted(row["description"] for row in rows), sorted(before[1]))
+
+        # nothing is left to move, and a batch copied to its tier but not yet deleted from the
+        # table is read once, and deleted by the next run
+        self.assertEqual(tiering.run(now=now)["upload"], 0)
+        tiering._tier(2023, datetime.datetime(2023, 1, 1), now)
+        cold = ColdTier.event_model(Upload, 2023)
+        cold.insert_many(
+            Upload.select(Upload.id, Upload.archive, Upload.timestamp).tuples(),
+            fields=[cold.id, cold.archive, cold.timestamp]).execute()
+        self.assertEqual(listed(**windows[0]), before[0])
+        self.assertEqual(ArchiveState.check(), [])
+        self.assertEqual(len(list(archive_db.export.Export("uploads", cold="true").query)), 40)
+
+        # and runs wait for the readers of the full history
+        with ColdTier.held():
+            with self.assertRaises(TieringError):
+                tiering.run(now=now)
+        self.assertEqual(tier([
+            "--db", self.db_path, "--horizon-days", "1", "--batch-size", "3",
+            "--sleep-ms", "0"]), 0)
+        self.assertEqual(Upload.select().count(), 0)
+        self.assertEqual(len(list(archive_db.export.Export("uploads", cold="true").query)), 40)
+        self.assertEqual([listed(**window) for window in windows], before)
+        self.assertEqual(ArchiveState.check(), [])
+
+    def test_tiering_keeps_ids(self):
+        db = init_db(self.db_path)
+        self.addCleanup(db.close)
+        self.addCleanup(tiering.configure)
+        now = datetime.datetime(2024, 1, 1)
+
+        def upload(i, timestamp):
+            return Upload.record(
+                description=f"descr-{i}", path=f"/data/host/descr-{i}", host="host",
+                timestamp=timestamp)
+
+        for i in range(3):
+            upload(i, now - datetime.timedelta(days=1))
+        # the latest ids are those of the oldest events, which are moved to a tier
+        for i in range(3, 6):
+            upload(i, datetime.datetime(2020, 6, 1))
+        tiering.configure(self.db_path, horizon_days=365, sleep=0)
+        self.assertEqual(tiering.run(now=now)["upload"], 3)
+        self.assertEqual([upload(i, now).id for i in range(6, 9)], [7, 8, 9])
+        self.assertEqual(ArchiveState.check(), [])
+        ArchiveState.rebuild()
+        self.assertEqual(
+            [state.upload_count for state in ArchiveState.select().order_by(ArchiveState.archive)],
+            [1] * 9)
+        rows = list(archive_db.export.Export("uploads").query)
+        self.assertEqual(sorted(row["id"] for row in rows), list(range(1, 10)))
+
+        # a database whose ids could be reused is migrated, taking the ids in the tiers into
+        # account
+        db.execute_sql("DELETE FROM upload WHERE id > 6")
+        db.execute_sql("DELETE FROM archive WHERE id > 6")
+        db.execute_sql("ALTER TABLE upload RENAME TO upload_autoincrement")
+        db.execute_sql(
+            "CREATE TABLE upload (id INTEGER NOT NULL PRIMARY KEY, archive_id INTEGER NOT NULL "
+            "REFERENCES archive (id), timestamp INTEGER NOT NULL)")
+        db.execute_sql("INSERT INTO upload SELECT * FROM upload_autoincrement")
+        db.execute_sql("DROP TABLE upload_autoincrement")
+        db.execute_sql("DELETE FROM sqlite_sequence WHERE name = 'upload'")
+        db.pragma("user_version", MIGRATIONS.index(_autoincrement_event_ids))
+        db.close()
+        db = init_db(self.db_path)
+        self.addCleanup(db.close)
+        self.assertEqual(Upload.select().count(), 3)
+        self.assertIn("AUTOINCREMENT", db.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE name = 'upload'").fetchone()[0])
+        self.assertIn("upload_timestamp", [index.name for index in db.get_indexes("upload")])
+        self.assertEqual(upload(6, now).id, 7)
+        self.assertEqual(ArchiveState.check(), [])
+
+    def test_default_pragmas(self):
+        db = init_db(self.db_path)
+        self.addCleanup(db.close)
+        self.assertEqual(db.journal_mode, "delete")